@@ -0,0 +1,261 @@
+from __future__ import print_function
+
+import argparse
+import math
+import sys
+import time
+import torch
+
+from models import cifar_resnet, initializers, vgg
+from sparselearning.core import Masking, CosineDecay
+from sparselearning.sampler import sample_mask
+from sparselearning.sparse_layers import convert_to_sparse
+from sparselearning.growth import grow, neuron_growth
+
+
+def build_model(name, device):
+    if name.startswith('vgg'):
+        return vgg.VGG(depth=int(name[-2:]), dataset='cifar10', batchnorm=True).to(device)
+    if name == 'resnet50':
+        from torchvision.models import resnet50
+        return resnet50().to(device)
+    return cifar_resnet.Model.get_model_from_name(name, initializers.initializations('kaiming_normal', 1.0), outputs=10).to(device)
+
+
+def build_masking(model, density, args):
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9, nesterov=True)
+    masking_args = argparse.Namespace(sparse_mode='DST', fix=True, update_frequency=None, final_prune_time=0.8,
+                                      initial_prune_time=0.1, packed_masks=args.packed_masks)
+    mask = Masking(optimizer, death_rate_decay=CosineDecay(0.5, 1), args=masking_args)
+    mask.modules.append(model)
+    mask.layers.add_module(model)
+    for name, tensor in model.named_parameters():
+        if len(tensor.shape) not in [2, 4]: continue
+        mask.masks[name] = (torch.rand(tensor.shape, device=tensor.device) < density).float()
+    return mask, optimizer
+
+
+def timeit(fn, steps, device, warmup=5):
+    for _ in range(warmup): fn()
+    if device.type == 'cuda': torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(steps): fn()
+    if device.type == 'cuda': torch.cuda.synchronize()
+    return (time.time() - start) / steps
+
+
+def legacy_apply_mask(mask):
+    # apply_mask as it was before the (param, mask) pairs were cached
+    for module in mask.modules:
+        for name, tensor in module.named_parameters():
+            if name in mask.masks:
+                tensor.data = tensor.data*mask.masks[name]
+
+
+def count_calls(fn):
+    # number of Python and C function calls made by fn()
+    calls = [0]
+    def profiler(frame, event, arg):
+        if event in ('call', 'c_call'): calls[0] += 1
+    sys.setprofile(profiler)
+    try:
+        fn()
+    finally:
+        sys.setprofile(None)
+    return calls[0]
+
+
+def legacy_scan(mask):
+    # the named_parameters() walk the masking code did before the layer registry
+    for module in mask.modules:
+        for name, weight in module.named_parameters():
+            if name not in mask.masks: continue
+
+
+def registry_scan(mask):
+    for name, weight in mask.layers.named_parameters():
+        pass
+
+
+def bench_registry(args, device):
+    for model_name in args.models:
+        model = build_model(model_name, device)
+        mask, optimizer = build_masking(model, args.density, args)
+        for p in model.parameters(): p.grad = torch.zeros_like(p)
+        print('{0:<20} masked layers {1}, parameters {2}'.format(model_name, len(mask.layers), len(list(model.parameters()))))
+        for label, fn in [('legacy scan', lambda: legacy_scan(mask)), ('registry scan', lambda: registry_scan(mask)), ('step()', mask.step)]:
+            print('  {0:<14} {1:>7} calls  {2:8.3f} ms'.format(label, count_calls(fn), timeit(fn, args.steps, device)*1000))
+
+
+# distinct conv/fc weight shapes of WideResNet-50-2
+WRN50_SHAPES = [(64, 3, 7, 7),
+                (128, 64, 1, 1), (128, 256, 1, 1), (128, 128, 3, 3), (256, 128, 1, 1), (256, 64, 1, 1),
+                (256, 256, 1, 1), (256, 512, 1, 1), (256, 256, 3, 3), (512, 256, 1, 1),
+                (512, 512, 1, 1), (512, 1024, 1, 1), (512, 512, 3, 3), (1024, 512, 1, 1),
+                (1024, 1024, 1, 1), (1024, 2048, 1, 1), (1024, 1024, 3, 3), (2048, 1024, 1, 1),
+                (1000, 2048)]
+
+
+def legacy_magnitude_death(masking, mask, weight, name):
+    # magnitude_death as it was before partial selection: a full sort per layer
+    num_remove = math.ceil(masking.death_rate*masking.name2nonzeros[name])
+    if num_remove == 0.0: return weight.data != 0.0
+    x, idx = torch.sort(torch.abs(weight.data.view(-1)))
+    k = math.ceil(masking.name2zeros[name] + num_remove)
+    threshold = x[k-1].item()
+    return (torch.abs(weight.data) > threshold)
+
+
+def bench_death(args, device):
+    for density in args.densities:
+        masking = argparse.Namespace(death_rate=0.5, name2nonzeros={}, name2zeros={})
+        layers = []
+        for i, shape in enumerate(WRN50_SHAPES):
+            mask = (torch.rand(shape, device=device) < density).float()
+            weight = torch.randn(shape, device=device) * mask
+            masking.name2nonzeros[i] = mask.sum().item()
+            masking.name2zeros[i] = mask.numel() - masking.name2nonzeros[i]
+            layers.append((i, mask, weight))
+        def update(death):
+            for name, mask, weight in layers:
+                death(masking, mask, weight, name)
+        legacy = timeit(lambda: update(legacy_magnitude_death), args.steps, device, warmup=1)
+        partial = timeit(lambda: update(Masking.magnitude_death), args.steps, device, warmup=1)
+        print('density {0:.3f}  sort {1:9.2f} ms  kthvalue {2:9.2f} ms  speedup {3:.2f}x'.format(
+            density, legacy*1000, partial*1000, legacy/partial))
+
+
+def bench_sampler(args, device):
+    for density in args.densities:
+        def legacy():
+            for shape in WRN50_SHAPES:
+                (torch.rand(shape) < density).float().data.to(device)
+        def exact():
+            for shape in WRN50_SHAPES:
+                sample_mask(shape, density, device)
+        legacy_time = timeit(legacy, args.steps, device, warmup=1)
+        exact_time = timeit(exact, args.steps, device, warmup=1)
+        print('density {0:.3f}  rand {1:9.2f} ms  exact {2:9.2f} ms  speedup {3:.2f}x'.format(
+            density, legacy_time*1000, exact_time*1000, legacy_time/exact_time))
+
+
+def bench_sparse_layers(args, device):
+    for model_name in args.models:
+        for density in args.densities:
+            model = build_model(model_name, device)
+            mask, _ = build_masking(model, density, args)
+            mask.apply_mask()
+            data = torch.randn(args.batch_size, 3, 32, 32, device=device)
+            def step():
+                model.zero_grad()
+                model(data).sum().backward()
+            dense = timeit(step, args.steps, device, warmup=2)
+            convert_to_sparse(model, mask.masks)
+            sparse = timeit(step, args.steps, device, warmup=2)
+            print('{0:<20} density {1:.3f}  dense {2:9.2f} ms  sparse {3:9.2f} ms  speedup {4:.2f}x'.format(
+                model_name, density, dense*1000, sparse*1000, dense/sparse))
+
+
+def legacy_momentum_growth(new_mask, grad, total_regrowth):
+    # momentum_growth as it was before the batched engine: a full sort per layer
+    grad = grad*(new_mask==0).float()
+    y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
+    new_mask.data.view(-1)[idx[:total_regrowth]] = 1.0
+    return new_mask
+
+
+def bench_growth(args, device):
+    for density in args.densities:
+        masks = [(torch.rand(shape, device=device) < density).float() for shape in WRN50_SHAPES]
+        grads = [torch.randn(shape, device=device) for shape in WRN50_SHAPES]
+        quotas = [int(mask.sum().item() * 0.3) for mask in masks]
+        def legacy():
+            for mask, grad, quota in zip(masks, grads, quotas):
+                legacy_momentum_growth(mask.clone(), grad, quota)
+        legacy_time = timeit(legacy, args.steps, device, warmup=1)
+        batched_time = timeit(lambda: grow(masks, grads, quotas), args.steps, device, warmup=1)
+        print('density {0:.3f}  per-layer sort {1:9.2f} ms  grow {2:9.2f} ms  speedup {3:.2f}x'.format(
+            density, legacy_time*1000, batched_time*1000, legacy_time/batched_time))
+
+
+def legacy_neuron_growth(new_mask, grad, total_regrowth):
+    # momentum_neuron_growth as it was before vectorization: a sort and .item() calls per neuron
+    M = torch.abs(grad)
+    sum_dim = [1] if len(M.shape) == 2 else [1, 2, 3]
+    v = M.mean(sum_dim).data
+    v /= v.sum()
+    slots_per_neuron = (new_mask==0).sum(sum_dim)
+    M = M*(new_mask==0).float()
+    for i, fraction in enumerate(v):
+        neuron_regrowth = min(math.floor(fraction.item()*total_regrowth), slots_per_neuron[i].item())
+        y, idx = torch.sort(M[i].flatten())
+        threshold = y[-(neuron_regrowth)].item()
+        if threshold == 0.0: continue
+        if neuron_regrowth < 10: continue
+        new_mask[i] = new_mask[i] | (M[i] > threshold)
+    return new_mask
+
+
+def bench_neuron_growth(args, device):
+    for channels in args.channels:
+        shape = (channels, args.in_channels, 3, 3)
+        mask = (torch.rand(shape, device=device) < args.density).bool()
+        grad = torch.randn(shape, device=device)
+        total_regrowth = int(mask.sum().item() * 0.3)
+        legacy = timeit(lambda: legacy_neuron_growth(mask.clone(), grad, total_regrowth), args.steps, device, warmup=1)
+        batched = timeit(lambda: neuron_growth(mask, grad, total_regrowth), args.steps, device, warmup=1)
+        print('out channels {0:>5}  per-neuron loop {1:9.2f} ms  row-wise top-k {2:9.2f} ms  speedup {3:.2f}x'.format(
+            channels, legacy*1000, batched*1000, legacy/batched))
+
+
+def bench_apply_mask(args, device):
+    for model_name in args.models:
+        model = build_model(model_name, device)
+        mask, _ = build_masking(model, args.density, args)
+        legacy = timeit(lambda: legacy_apply_mask(mask), args.steps, device)
+        fused = timeit(mask.apply_mask, args.steps, device)
+        print('{0:<20} layers {1:>4}  legacy {2:8.3f} ms  fused {3:8.3f} ms  speedup {4:.2f}x'.format(
+            model_name, len(mask.masks), legacy*1000, fused*1000, legacy/fused))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for sparse training')
+    parser.add_argument('--no-cuda', action='store_true', default=False, help='disables CUDA training')
+    parser.add_argument('--steps', type=int, default=100, help='timed iterations per measurement')
+    parser.add_argument('--density', type=float, default=0.05, help='density of the random masks')
+    parser.add_argument('--packed-masks', action='store_true', help='Benchmark with bit-packed masks.')
+    subparsers = parser.add_subparsers(dest='bench')
+
+    p = subparsers.add_parser('apply_mask', help='per-step cost of Masking.apply_mask')
+    p.add_argument('--models', nargs='+', default=['cifar_resnet_110', 'resnet50'])
+
+    p = subparsers.add_parser('registry', help='Python-side overhead of the layer scans and of Masking.step')
+    p.add_argument('--models', nargs='+', default=['cifar_resnet_110'])
+
+    p = subparsers.add_parser('death', help='magnitude death latency on WideResNet-50-2 layer shapes (use --no-cuda for CPU)')
+    p.add_argument('--densities', nargs='+', type=float, default=[0.01, 0.05, 0.1, 0.2, 0.5])
+
+    p = subparsers.add_parser('sampler', help='random mask init on WideResNet-50-2 layer shapes')
+    p.add_argument('--densities', nargs='+', type=float, default=[0.01, 0.05, 0.1, 0.2, 0.5])
+
+    p = subparsers.add_parser('sparse_layers', help='forward+backward time of dense layers vs SparseConv2d/SparseLinear (use --no-cuda for CPU)')
+    p.add_argument('--models', nargs='+', default=['cifar_resnet_32', 'vgg16'])
+    p.add_argument('--densities', nargs='+', type=float, default=[0.05, 0.1])
+    p.add_argument('--batch-size', type=int, default=64)
+
+    p = subparsers.add_parser('growth', help='momentum growth of all WideResNet-50-2 layer shapes: per-layer sort vs sync-free per-layer top-k (growth.grow)')
+    p.add_argument('--densities', nargs='+', type=float, default=[0.01, 0.05, 0.1, 0.2, 0.5])
+
+    p = subparsers.add_parser('neuron_growth', help='momentum_neuron growth time vs number of output channels')
+    p.add_argument('--channels', nargs='+', type=int, default=[64, 256, 512, 1024, 2048])
+    p.add_argument('--in-channels', type=int, default=256)
+
+    args = parser.parse_args()
+    use_cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+
+    benches = {'apply_mask': bench_apply_mask, 'registry': bench_registry, 'death': bench_death, 'sampler': bench_sampler, 'sparse_layers': bench_sparse_layers, 'growth': bench_growth, 'neuron_growth': bench_neuron_growth}
+    if args.bench not in benches:
+        parser.print_help()
+    else:
+        benches[args.bench](args, device)
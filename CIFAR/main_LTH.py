@@ -15,7 +15,10 @@ import numpy as np
 import sparselearning
 from models import cifar_resnet, initializers, vgg
 from sparselearning.core import Masking, CosineDecay
-from sparselearning.utils import get_mnist_dataloaders, get_cifar10_dataloaders, get_cifar100_dataloaders
+from sparselearning.compact import CompactSGD
+from sparselearning.sparse_layers import convert_to_sparse
+from sparselearning.prefetch import Prefetcher
+from sparselearning.utils import get_mnist_dataloaders, get_cifar10_dataloaders, get_cifar100_dataloaders, configure_cpu, autocast
 
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -61,6 +64,10 @@ def print_and_log(msg):
     print(msg)
     logger.info(msg)
 
+def prefetcher(args, loader, device):
+    return Prefetcher(loader, device, depth=args.prefetch, channels_last=args.channels_last,
+                      dtype=torch.half if args.fp16 else None)
+
 # gradient_norm = []
 def train(args, model, device, train_loader, optimizer, epoch, mask=None):
     model.train()
@@ -68,12 +75,13 @@ def train(args, model, device, train_loader, optimizer, epoch, mask=None):
     correct = 0
     n = 0
     # global gradient_norm
-    for batch_idx, (data, target) in enumerate(train_loader):
+    loader = prefetcher(args, train_loader, device)
+    for batch_idx, (data, target) in enumerate(loader):
 
-        data, target = data.to(device), target.to(device)
-        if args.fp16: data = data.half()
         optimizer.zero_grad()
-        output = model(data)
+        with autocast(device, args.bf16):
+            output = model(data)
+        output = output.float()
 
         loss = F.nll_loss(output, target)
 
@@ -101,6 +109,10 @@ def train(args, model, device, train_loader, optimizer, epoch, mask=None):
     print_and_log('\n{}: Average loss: {:.4f}, Accuracy: {}/{} ({:.3f}%)\n'.format(
         'Training summary' ,
         train_loss/batch_idx, correct, n, 100. * correct / float(n)))
+    # the epoch's weights are evaluated and saved with the masks of all updates started in it
+    if mask is not None: mask.finish_topology_update()
+    if mask is not None: print_and_log(mask.step_timer.summary())
+    print_and_log(loader.summary())
 
 def evaluate(args, model, device, test_loader, is_test_set=False):
     model.eval()
@@ -108,11 +120,11 @@ def evaluate(args, model, device, test_loader, is_test_set=False):
     correct = 0
     n = 0
     with torch.no_grad():
-        for data, target in test_loader:
-            data, target = data.to(device), target.to(device)
-            if args.fp16: data = data.half()
+        for data, target in prefetcher(args, test_loader, device):
             model.t = target
-            output = model(data)
+            with autocast(device, args.bf16):
+                output = model(data)
+            output = output.float()
             test_loss += F.nll_loss(output, target, reduction='sum').item() # sum up batch loss
             pred = output.argmax(dim=1, keepdim=True) # get the index of the max log-probability
             correct += pred.eq(target.view_as(pred)).sum().item()
@@ -147,7 +159,7 @@ def main():
     parser.add_argument('--seed', type=int, default=17, metavar='S', help='random seed (default: 17)')
     parser.add_argument('--log-interval', type=int, default=100, metavar='N',
                         help='how many batches to wait before logging training status')
-    parser.add_argument('--optimizer', type=str, default='sgd', help='The optimizer to use. Default: sgd. Options: sgd, adam.')
+    parser.add_argument('--optimizer', type=str, default='sgd', help='The optimizer to use. Default: sgd. Options: sgd, adam, compact_sgd (momentum kept only for active weights, needs --sparse; weights and gradients stay dense).')
     randomhash = ''.join(str(time.time()).split('.'))
     parser.add_argument('--save', type=str, default=randomhash + '.pt',
                         help='path to save the final model')
@@ -163,6 +175,12 @@ def main():
     parser.add_argument('--save-features', action='store_true', help='Resumes a saved model and saves its feature data to disk for plotting.')
     parser.add_argument('--bench', action='store_true', help='Enables the benchmarking of layers and estimates sparse speedups')
     parser.add_argument('--max-threads', type=int, default=10, help='How many threads to use for data loading.')
+    parser.add_argument('--tensor-loader', nargs='?', const='cpu', default=None, metavar='DEVICE', help='Keep the dataset in memory as one uint8 tensor on DEVICE (default: cpu) and augment whole batches with tensor ops instead of per-image DataLoader workers.')
+    parser.add_argument('--prefetch', type=int, default=2, help='Batches moved to the device ahead of time by a background thread (0: inline). Default: 2.')
+    parser.add_argument('--threads', type=int, default=None, help='Number of intra-op threads for CPU training (torch.set_num_threads). Default: torch default.')
+    parser.add_argument('--channels-last', action='store_true', help='Use the channels_last memory format for the model and inputs (faster convolutions on CPU).')
+    parser.add_argument('--bf16', action='store_true', help='Run forward passes under bf16 autocast (CPUs with bf16 support).')
+    parser.add_argument('--sparse-kernels', action='store_true', help='Run masked conv/linear layers with sparse (CSR) kernels instead of dense ones. Meant for CPU at low density; use with --growth random.')
     parser.add_argument('--scaled', action='store_true', help='scale the initialization by 1/density')
 
     # sparse hyperparameters
@@ -180,9 +198,20 @@ def main():
     parser.add_argument('--imp_iters', type=int, default=11,  help='IMP iterations')
     parser.add_argument('--final_prune_time', type=float, default=0.8, help='The density of the overall sparse network.')
     parser.add_argument('--initial_prune_time', type=float, default=0.1, help='The density of the overall sparse network.')
+    parser.add_argument('--packed-masks', action='store_true', help='Keep masks as packed bits (1 bit per weight) instead of float tensors. Saves memory, costs an unpack per mask access.')
+    parser.add_argument('--mask-seed', type=int, default=None, help='Seed the random masks per layer (by layer name), so the initial topology does not depend on the global RNG state.')
+    parser.add_argument('--async-update', type=int, default=0, metavar='K', help='With --sparse_mode DST: compute each topology update in a background thread and swap the new masks in K steps later. 0 (default) updates synchronously.')
 
 
     args = parser.parse_args()
+    if args.sparse_kernels and not hasattr(torch, 'sparse_csr_tensor'):
+        parser.error('--sparse-kernels needs torch.sparse_csr_tensor (PyTorch >= 1.10), found torch {0}'.format(torch.__version__))
+    if args.sparse_kernels and args.sparse_mode == 'DST' and args.growth in ('momentum', 'momentum_neuron', 'gradient'):
+        # sparse kernels leave the gradients of inactive weights at zero, which these growth modes score
+        parser.error('--sparse-kernels needs --growth random or random_unfired with --sparse_mode DST, got --growth {0}'.format(args.growth))
+    if args.optimizer == 'compact_sgd' and args.sparse_mode == 'DST' and args.growth in ('momentum', 'momentum_neuron'):
+        # CompactSGD keeps no momentum for inactive weights, so momentum growth would score every candidate 0
+        parser.error('--optimizer compact_sgd needs --growth random, random_unfired or gradient with --sparse_mode DST, got --growth {0}'.format(args.growth))
     setup_logger(args)
     print_and_log(args)
 
@@ -195,6 +224,7 @@ def main():
 
     use_cuda = not args.no_cuda and torch.cuda.is_available()
     device = torch.device("cuda" if use_cuda else "cpu")
+    configure_cpu(args, device)
 
     print_and_log('\n\n')
     print_and_log('='*80)
@@ -232,6 +262,7 @@ def main():
             model = vgg.VGG(depth=int(args.model[-2:]), dataset=args.data, batchnorm=True).to(device)
         else:
             model = cifar_resnet.Model.get_model_from_name(args.model, initializers.initializations(init_type, 1-args.sparsity), outputs=output).to(device)
+        if args.channels_last: model = model.to(memory_format=torch.channels_last)
 
         print_and_log(model)
         print_and_log('=' * 60)
@@ -250,6 +281,8 @@ def main():
             optimizer = optim.SGD(model.parameters(),lr=args.lr,momentum=args.momentum,weight_decay=args.l2, nesterov=True)
         elif args.optimizer == 'adam':
             optimizer = optim.Adam(model.parameters(),lr=args.lr,weight_decay=args.l2)
+        elif args.optimizer == 'compact_sgd':
+            optimizer = CompactSGD(model.parameters(),lr=args.lr,momentum=args.momentum,weight_decay=args.l2, nesterov=True)
         else:
             print('Unknown optimizer: {0}'.format(args.optimizer))
             raise Exception('Unknown optimizer.')
@@ -292,6 +325,8 @@ def main():
             mask = Masking(optimizer, death_rate=args.death_rate, death_mode=args.death, death_rate_decay=decay, growth_mode=args.growth,
                            redistribution_mode=args.redistribution, args=args,train_loader=train_loader)
             mask.add_module(model, sparse_init=args.sparse_init, density=1-args.sparsity)
+            if args.sparse_kernels:
+                print_and_log('Sparse kernels for: {0}'.format(', '.join(convert_to_sparse(model, mask.masks))))
 
             print('loading pretrained weights')
             model.load_state_dict(torch.load(os.path.join(args.output_dir, "Initialization_seed{}".format(args.seed), "initialization_rewinding.ckpt")))
@@ -0,0 +1,183 @@
+import copy
+import time
+import threading
+from collections import defaultdict
+import numpy as np
+import torch
+from sparselearning.mask_store import MaskStore
+from sparselearning.exploration import ExplorationTracker
+
+
+class _SnapshotLayers(object):
+    """Stands in for the SparseLayerRegistry, over copies of the masked parameters."""
+    def __init__(self, named_parameters):
+        self._named = list(named_parameters)
+
+    def named_parameters(self):
+        return self._named
+
+    def numel(self):
+        return sum(param.numel() for name, param in self._named)
+
+
+class _SnapshotOptimizer(object):
+    """Stands in for the optimizer: holds copies of the per-parameter state only."""
+    def __init__(self, state):
+        self.state = state
+
+    def dense_momentum(self, param):
+        return self.state[param]['momentum_buffer']
+
+
+def _state_snapshot(optimizer, param):
+    state = optimizer.state[param]
+    if 'compact_momentum' in state:
+        # CompactSGD keeps the momentum of the active weights only
+        return {'momentum_buffer': optimizer.dense_momentum(param).clone()}
+    return {key: value.clone() if torch.is_tensor(value) else value for key, value in state.items()}
+
+
+class AsyncTopologyUpdate(object):
+    """Runs Masking.truncate_weights on a snapshot in a worker thread while training continues.
+
+    start() copies the masks, the masked weights (with their gradients) and the
+    optimizer state of the masked layers, and runs the truncate_weights of a
+    shallow copy of the Masking that only sees these copies, on a side CUDA
+    stream when the model is on the GPU. Its host syncs (.item(), nonzero())
+    then block the worker instead of the training loop.
+
+    The shadow also gets its own copies of the Masking's dicts and lists
+    (per-layer statistics, removal counts, growth adjustments, ...) and of the
+    ExplorationTracker, so the worker never mutates state the training loop
+    can see.
+
+    finish() waits for the worker and swaps the new masks in at a step
+    boundary. apply_mask() then zeroes the weights pruned by the update, which
+    kept training in the meantime, while regrown weights start from zero as in
+    the synchronous path. The copied containers and every attribute the
+    update rebinds are then committed to the Masking; if the update failed,
+    the Masking is left exactly as it was. Decisions are made on weights that
+    are `delay` steps old. flush() finishes a pending update early, e.g. when
+    training ends.
+    """
+    _SWAPPED = ('masks', 'layers', 'optimizer', 'apply_mask')
+
+    def __init__(self, masking, delay):
+        self.masking = masking
+        self.delay = delay
+        self.started = None
+        self._thread = None
+        self._shadow = None
+        self._before = None
+        self._copied = None
+        self._error = None
+        self._stream = None
+
+    def pending(self):
+        return self._thread is not None
+
+    def due(self, step):
+        return self.pending() and step - self.started >= self.delay
+
+    def flush(self):
+        """Finishes the pending update, if any; returns True if there was one."""
+        if not self.pending(): return False
+        self.finish()
+        return True
+
+    def start(self, step):
+        if self.pending(): self.finish()
+        masking = self.masking
+        with torch.no_grad():
+            named, state = [], defaultdict(dict)
+            for name, weight in masking.layers.named_parameters():
+                param = weight.detach().clone()
+                if weight.grad is not None: param.grad = weight.grad.detach().clone()
+                named.append((name, param))
+                state[param] = _state_snapshot(masking.optimizer, weight)
+            masks = MaskStore(masking.masks.device, packed=masking.masks.packed)
+            for name in masking.masks:
+                masks[name] = masking.masks[name]
+
+        shadow = copy.copy(masking)
+        shadow.masks = masks
+        shadow.layers = _SnapshotLayers(named)
+        shadow.optimizer = _SnapshotOptimizer(state)
+        shadow.apply_mask = lambda: None
+        # copy.copy shares the containers, which truncate_weights updates in place
+        copied = []
+        for key, value in vars(masking).items():
+            if key in self._SWAPPED or key.startswith('_'): continue
+            if isinstance(value, ExplorationTracker):
+                setattr(shadow, key, copy.deepcopy(value))
+            elif isinstance(value, (dict, list)):
+                setattr(shadow, key, copy.copy(value))
+            else:
+                continue
+            copied.append(key)
+        self._shadow, self._before, self._copied = shadow, dict(vars(shadow)), copied
+
+        if masking.device.type == 'cuda':
+            if self._stream is None: self._stream = torch.cuda.Stream(device=masking.device)
+            self._stream.wait_stream(torch.cuda.current_stream(masking.device))
+        self.started = step
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            if self._stream is None:
+                self._shadow.truncate_weights()
+            else:
+                with torch.cuda.stream(self._stream):
+                    self._shadow.truncate_weights()
+        except Exception as e:
+            self._error = e
+
+    def finish(self):
+        self._thread.join()
+        self._thread = None
+        shadow, before, copied = self._shadow, self._before, self._copied
+        self._shadow = self._before = self._copied = None
+        if self._error is not None:
+            print('Asynchronous topology update failed, the masks and the Masking state are left unchanged.')
+            raise self._error
+
+        masking = self.masking
+        if self._stream is not None:
+            torch.cuda.current_stream(masking.device).wait_stream(self._stream)
+        for name in shadow.masks:
+            masking.masks[name] = shadow.masks[name]
+        if self._stream is not None:
+            # later side-stream work must not reuse the snapshot memory before the swap has read it
+            self._stream.wait_stream(torch.cuda.current_stream(masking.device))
+        for key, value in vars(shadow).items():
+            if key in self._SWAPPED: continue
+            if key in copied or key not in before or before[key] is not value:
+                setattr(masking, key, value)
+        masking.apply_mask()
+
+
+class StepTimer(object):
+    """Host wall time between successive training steps, to compare the step-time jitter of update modes."""
+    def __init__(self):
+        self.times = []
+        self._last = None
+
+    def tick(self):
+        now = time.perf_counter()
+        if self._last is not None: self.times.append(now - self._last)
+        self._last = now
+
+    def reset(self):
+        self.times = []
+        self._last = None
+
+    def summary(self, reset=True):
+        if len(self.times) == 0: return 'Step time: no steps recorded.'
+        times = np.array(self.times) * 1000.0
+        val = 'Step time (ms): mean {0:.2f}, std {1:.2f}, p50 {2:.2f}, p99 {3:.2f}, max {4:.2f} over {5} steps.'.format(
+            times.mean(), times.std(), np.percentile(times, 50), np.percentile(times, 99), times.max(), len(times))
+        if reset: self.reset()
+        return val
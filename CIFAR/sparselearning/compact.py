@@ -0,0 +1,112 @@
+import torch
+from torch.optim.optimizer import Optimizer, required
+
+
+def _channels_last(p):
+    return p.dim() == 4 and not p.is_contiguous() and p.is_contiguous(memory_format=torch.channels_last)
+
+
+def _flat(t, p):
+    """t flattened in the memory order of p (a view for p itself, also when p is channels_last)."""
+    if _channels_last(p):
+        return t.permute(0, 2, 3, 1).reshape(-1)
+    return t.reshape(-1)
+
+
+class CompactSGD(Optimizer):
+    """SGD (momentum, nesterov, weight decay) that only updates the active weights of masked layers.
+
+    For a masked parameter the state holds the flat indices of its active
+    weights ('indices') and a momentum vector of the same length
+    ('compact_momentum'). This replaces the dense momentum_buffer, so only the
+    optimizer state and the momentum/weight update arithmetic scale with the
+    density. The weights, their gradients and the forward/backward passes
+    stay dense; growth therefore cannot score inactive weights by momentum.
+    Parameters that are not masked (biases, batch norms) use plain SGD.
+
+    Masking calls compact() whenever the masks change. Momentum is carried over
+    for weights that stay active, and regrown weights start with zero momentum.
+    Indices follow the memory order of the parameter, so channels_last weights
+    are updated in place as well.
+    """
+    def __init__(self, params, lr=required, momentum=0, dampening=0, weight_decay=0, nesterov=False):
+        if nesterov and (momentum <= 0 or dampening != 0):
+            raise ValueError("Nesterov momentum requires a momentum and zero dampening")
+        defaults = dict(lr=lr, momentum=momentum, dampening=dampening, weight_decay=weight_decay, nesterov=nesterov)
+        super(CompactSGD, self).__init__(params, defaults)
+
+    def compact(self, params, masks):
+        """(Re)builds the index sets from the current masks, keeping the momentum of surviving weights."""
+        with torch.no_grad():
+            for p, mask in zip(params, masks):
+                state = self.state[p]
+                indices = (_flat(mask, p) != 0).nonzero().view(-1)
+                momentum = None
+                if 'compact_momentum' in state:
+                    old_indices, old_momentum = state['indices'], state['compact_momentum']
+                    momentum = torch.zeros(indices.numel(), dtype=p.dtype, device=p.device)
+                    if old_indices.numel() > 0:
+                        pos = torch.searchsorted(old_indices, indices).clamp_(max=old_indices.numel()-1)
+                        kept = old_indices[pos] == indices
+                        momentum[kept] = old_momentum[pos[kept]]
+                elif 'momentum_buffer' in state:
+                    momentum = _flat(state.pop('momentum_buffer'), p)[indices]
+                state['indices'] = indices
+                if momentum is not None:
+                    state['compact_momentum'] = momentum
+
+    def dense_momentum(self, p):
+        """The momentum of p as a dense tensor (zeros for inactive weights)."""
+        state = self.state[p]
+        if 'compact_momentum' not in state:
+            return state['momentum_buffer'] if 'momentum_buffer' in state else torch.zeros_like(p)
+        dense = torch.zeros_like(p)
+        _flat(dense, p)[state['indices']] = state['compact_momentum']
+        return dense
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            weight_decay = group['weight_decay']
+            momentum = group['momentum']
+            dampening = group['dampening']
+            nesterov = group['nesterov']
+
+            for p in group['params']:
+                if p.grad is None: continue
+                state = self.state[p]
+                if 'indices' in state:
+                    indices = state['indices']
+                    flat = _flat(p, p)
+                    d_p = _flat(p.grad, p).index_select(0, indices)
+                    if weight_decay != 0:
+                        d_p.add_(flat.index_select(0, indices), alpha=weight_decay)
+                    key = 'compact_momentum'
+                else:
+                    d_p = p.grad
+                    if weight_decay != 0:
+                        d_p = d_p.add(p, alpha=weight_decay)
+                    key = 'momentum_buffer'
+
+                if momentum != 0:
+                    if key not in state:
+                        buf = state[key] = torch.clone(d_p).detach()
+                    else:
+                        buf = state[key]
+                        buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
+                    if nesterov:
+                        d_p = d_p.add(buf, alpha=momentum)
+                    else:
+                        d_p = buf
+
+                if key == 'compact_momentum':
+                    flat.index_add_(0, indices, d_p.mul(-group['lr']))
+                else:
+                    p.add_(d_p, alpha=-group['lr'])
+
+        return loss
@@ -3,6 +3,16 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from sparselearning.snip import SNIP, GraSP
+from sparselearning.mask_store import MaskStore, masked_mul_
+from sparselearning.registry import SparseLayerRegistry
+from sparselearning.selection import kth_largest
+from sparselearning.compact import CompactSGD
+from sparselearning.density import layerwise_density
+from sparselearning.sampler import sample_mask, layer_generator, num_ones
+from sparselearning.growth import grow, neuron_growth
+from sparselearning.stats import SparsityStats
+from sparselearning.exploration import ExplorationTracker
+from sparselearning.async_update import AsyncTopologyUpdate, StepTimer
 import numpy as np
 import math
 
@@ -44,7 +54,7 @@ class Masking(object):
 
         self.train_loader = train_loader
         self.args = args
-        self.device = torch.device("cuda")
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.growth_mode = growth_mode
         self.death_mode = death_mode
         self.growth_death_ratio = growth_death_ratio
@@ -57,7 +67,10 @@ class Masking(object):
         self.final_prune_time = int(self.total_step * args.final_prune_time)
         self.initial_prune_time = int(self.total_step * args.initial_prune_time)
 
-        self.masks = {}
+        self.masks = MaskStore(self.device, packed=getattr(args, 'packed_masks', False))
+        self.mask_seed = getattr(args, 'mask_seed', None)
+        self.layers = SparseLayerRegistry(self.masks, optimizer)
+        self._masked_version = -1
         self.modules = []
         self.names = []
         self.optimizer = optimizer
@@ -66,6 +79,8 @@ class Masking(object):
         self.name2zeros = {}
         self.num_remove = {}
         self.name2nonzeros = {}
+        # weights that have been active at some point (ITOP)
+        self.exploration = ExplorationTracker()
         self.death_rate = death_rate
         self.steps = 0
 
@@ -73,101 +88,88 @@ class Masking(object):
         if args.fix: self.update_frequency = None
         else: self.update_frequency = args.update_frequency
 
+        # DST updates computed in the background and swapped in async_update steps later (0: synchronous)
+        self.async_update = getattr(args, 'async_update', 0)
+        self.topology_update = AsyncTopologyUpdate(self, self.async_update) if self.async_update > 0 else None
+        self.step_timer = StepTimer()
+
+    def random_mask(self, name, shape, density):
+        """Random mask of a layer with exactly num_ones(numel, density) active weights, built on self.device."""
+        generator = None
+        if self.mask_seed is not None:
+            generator = layer_generator(self.mask_seed, name, self.device)
+        return sample_mask(shape, density, self.device, generator)
+
     def init(self, mode='ERK', density=0.05, erk_power_scale=1.0):
         self.density = density
 
         if mode == 'dense':
             print('initialized with dense model')
             self.baseline_nonzero = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = torch.ones_like(weight, dtype=torch.float32, requires_grad=False).to('cuda')
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = torch.ones_like(weight, dtype=torch.float32, requires_grad=False).to(self.device)
 
         elif mode == 'one_shot_gm':
             print('initialize by one_shot_gm')
             self.baseline_nonzero = 0
 
-            weight_abs = []
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    weight_abs.append(torch.abs(weight))
-
-            # Gather all scores in a single vector and normalise
-            all_scores = torch.cat([torch.flatten(x) for x in weight_abs])
-            num_params_to_keep = int(len(all_scores) * density)
-
-            threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-            acceptable_score = threshold[-1]
+            # exact global threshold, streamed layer by layer instead of concatenating all scores
+            weight_abs = lambda: (torch.abs(weight) for name, weight in self.layers.named_parameters())
+            num_params_to_keep = int(self.layers.numel() * density)
+            acceptable_score = kth_largest(weight_abs, num_params_to_keep)
 
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = ((torch.abs(weight)) > acceptable_score).float().data.to('cuda')
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = ((torch.abs(weight)) > acceptable_score).float().data.to(self.device)
 
         elif mode == 'one_shot_gm_cpu':
             print('initialize by one_shot_gm')
             self.baseline_nonzero = 0
 
-            weight_abs = []
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    weight_abs.append(torch.abs(weight.cpu()))
-
-            # Gather all scores in a single vector and normalise
-            all_scores = torch.cat([torch.flatten(x) for x in weight_abs])
-            num_params_to_keep = int(len(all_scores) * density)
+            # exact global threshold, streamed layer by layer instead of concatenating all scores
+            weight_abs = lambda: (torch.abs(weight.cpu()) for name, weight in self.layers.named_parameters())
+            num_params_to_keep = int(self.layers.numel() * density)
+            acceptable_score = kth_largest(weight_abs, num_params_to_keep)
 
-            threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-            acceptable_score = threshold[-1]
-
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = ((torch.abs(weight)) > acceptable_score).float().data.to('cuda')
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = ((torch.abs(weight)) > acceptable_score).float().data.to(self.device)
 
         elif mode == 'random':
             print('initialize by random pruning')
             self.baseline_nonzero = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = (torch.rand(weight.shape) < density).float().data.to('cuda')
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = self.random_mask(name, weight.shape, density)
+
+        elif mode in ['ERK', 'ER', 'uniform']:
+            print('initialize by {0}'.format(mode))
+            shapes = [(name, weight.shape) for name, weight in self.layers.named_parameters()]
+            density_dict = layerwise_density(shapes, density, mode, erk_power_scale)
+            self.baseline_nonzero = 0
+            for name, shape in shapes:
+                if density_dict[name] == 1.0 and mode != 'uniform':
+                    print(f"Sparsity of var:{name} had to be set to 0.")
+                self.masks[name] = self.random_mask(name, shape, density_dict[name])
+                self.baseline_nonzero += num_ones(shape.numel(), density_dict[name])
 
         if mode == 'iterative_gm':
             print('initialized by iterative_gm')
-            total_num_nonzoros = 0
-            dense_nonzeros = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = (weight != 0).cuda()
-                    self.name2nonzeros[name] = (weight != 0).sum().item()
-                    total_num_nonzoros += self.name2nonzeros[name]
-                    dense_nonzeros += weight.numel()
-                    print(f'sparsity of layer {name} is {self.name2nonzeros[name] / weight.numel()}')
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = (weight != 0).to(self.device)
+            stats = SparsityStats(self.layers.named_parameters())
+            self.name2nonzeros.update(stats.nonzeros())
+            for name, density_ in stats.density().items():
+                print(f'sparsity of layer {name} is {density_}')
+            total_num_nonzoros = stats.total_nonzeros()
+            dense_nonzeros = stats.total_numel()
 
             print(f'sparsity level of current model is {1 - total_num_nonzoros / dense_nonzeros}')
 
-            weight_abs = []
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    weight_abs.append(torch.abs(weight))
-
-            # Gather all scores in a single vector and normalise
-            all_scores = torch.cat([torch.flatten(x) for x in weight_abs])
+            # exact global threshold, streamed layer by layer instead of concatenating all scores
+            weight_abs = lambda: (torch.abs(weight) for name, weight in self.layers.named_parameters())
             num_params_to_keep = int(total_num_nonzoros * density)
+            acceptable_score = kth_largest(weight_abs, num_params_to_keep)
 
-            threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-            acceptable_score = threshold[-1]
-
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = ((torch.abs(weight)) > acceptable_score).float().data.to('cuda')
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = ((torch.abs(weight)) > acceptable_score).float().data.to(self.device)
 
 
         elif mode == 'snip':
@@ -175,35 +177,34 @@ class Masking(object):
             layer_wise_sparsities = SNIP(self.module, self.density, self.train_loader, self.device)
             # re-sample mask positions
             for sparsity_, name in zip(layer_wise_sparsities, self.masks):
-                self.masks[name][:] = (torch.rand(self.masks[name].shape) < (1-sparsity_)).float().data.cuda()
+                self.masks[name] = self.random_mask(name, self.masks.shape(name), 1-sparsity_)
 
         elif mode == 'GraSP':
             print('initialize by GraSP')
             layer_wise_sparsities = GraSP(self.module, self.density, self.train_loader, self.device)
             # re-sample mask positions
             for sparsity_, name in zip(layer_wise_sparsities, self.masks):
-                self.masks[name][:] = (torch.rand(self.masks[name].shape) < (1-sparsity_)).float().data.cuda()
+                self.masks[name] = self.random_mask(name, self.masks.shape(name), 1-sparsity_)
 
         self.apply_mask()
 
-        total_size = 0
-        sparse_size = 0
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name in self.masks:
-                    print(name, 'density:',(weight!=0).sum().item()/weight.numel())
-                    total_size += weight.numel()
-                    sparse_size += (weight != 0).sum().int().item()
+        stats = SparsityStats(self.layers.named_parameters())
+        for name, density_ in stats.density().items():
+            print(name, 'density:', density_)
+        total_size = stats.total_numel()
+        sparse_size = stats.total_nonzeros()
         print('Total Model parameters:', total_size)
         print('Total parameters under sparsity level of {0}: {1}'.format(self.density, sparse_size / total_size))
 
-        # self.fired_masks = copy.deepcopy(self.masks) # used for ITOP
+        self.exploration.update(self.masks) # used for ITOP
         # self.print_nonzero_counts()
 
 
     def step(self):
+        self.step_timer.tick()
         self.optimizer.step()
-        self.apply_mask()
+        # CompactSGD never touches inactive weights, so there is nothing to mask
+        if not isinstance(self.optimizer, CompactSGD): self.apply_mask()
         self.death_rate_decay.step()
         self.death_rate = self.death_rate_decay.get_dr()
         self.steps += 1
@@ -233,6 +234,14 @@ class Masking(object):
                     self.gradual_oBERT_pruning(current_prune_rate)
                     self.print_status()
 
+            elif self.sparse_mode == 'DST' and self.topology_update is not None:
+                if self.topology_update.due(self.steps):
+                    self.topology_update.finish()
+                    self.print_nonzero_counts()
+                if self.steps % self.update_frequency == 0:
+                    print('*********************************Dynamic Sparsity (async)************************')
+                    self.topology_update.start(self.steps)
+
             elif self.sparse_mode == 'DST':
                 if self.steps % self.update_frequency == 0:
                     print('*********************************Dynamic Sparsity********************************')
@@ -246,9 +255,13 @@ class Masking(object):
     def add_module(self, module, density, sparse_init='ER'):
         self.modules.append(module)
         self.module = module
+        # masks and everything derived from them live on the device of the model
+        self.device = next(module.parameters()).device
+        self.masks.device = self.device
+        self.layers.add_module(module)
         for name, tensor in module.named_parameters():
             self.names.append(name)
-            self.masks[name] = torch.ones_like(tensor, dtype=torch.float32, requires_grad=False).cuda()
+            self.masks[name] = torch.ones_like(tensor, dtype=torch.float32, requires_grad=False).to(self.device)
 
         print('Removing biases...')
         self.remove_weight_partial_name('bias')
@@ -297,60 +310,81 @@ class Masking(object):
                 if isinstance(module, nn_type):
                     self.remove_weight(name)
 
-    def apply_mask(self):
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name in self.masks:
-                    tensor.data = tensor.data*self.masks[name]
-
-    def truncate_weights(self):
+    def masked_parameters(self):
+        """Returns ([param], [mask]) for all masked parameters.
+
+        The lists are rebuilt only when the masks change (MaskStore.version),
+        so apply_mask does not walk named_parameters() on every step. Masks are
+        cast to the dtype of their parameter once per topology.
+        """
+        if self._masked_version != self.masks.version:
+            self._masked_params = []
+            self._masked_names = []
+            for name, tensor in self.layers.named_parameters():
+                self._masked_params.append(tensor)
+                self._masked_names.append(name)
+            self._masked_masks = None
+            if not self.masks.packed:
+                self._masked_masks = [self.masks[name].to(tensor.dtype) for name, tensor in zip(self._masked_names, self._masked_params)]
+            if isinstance(self.optimizer, CompactSGD):
+                self.optimizer.compact(self._masked_params, [self.masks[name] for name in self._masked_names])
+            self._masked_version = self.masks.version
+        if self._masked_masks is None:
+            # packed masks are unpacked on every call to keep the memory saving
+            return self._masked_params, [self.masks[name].to(tensor.dtype) for name, tensor in zip(self._masked_names, self._masked_params)]
+        return self._masked_params, self._masked_masks
 
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
-                self.name2nonzeros[name] = mask.sum().item()
-                self.name2zeros[name] = mask.numel() - self.name2nonzeros[name]
-
-                # death
-                if self.death_mode == 'magnitude':
-                    new_mask = self.magnitude_death(mask, weight, name)
-                elif self.death_mode == 'SET':
-                    new_mask = self.magnitude_and_negativity_death(mask, weight, name)
-                elif self.death_mode == 'Taylor_FO':
-                    new_mask = self.taylor_FO(mask, weight, name)
-                elif self.death_mode == 'threshold':
-                    new_mask = self.threshold_death(mask, weight, name)
-
-                self.num_remove[name] = int(self.name2nonzeros[name] - new_mask.sum().item())
-                self.masks[name][:] = new_mask
+    def apply_mask(self):
+        params, masks = self.masked_parameters()
+        masked_mul_(params, masks)
 
+    def mask_stats(self):
+        """Nonzero counts of all masks, see stats.SparsityStats."""
+        return SparsityStats((name, self.masks[name]) for name, weight in self.layers.named_parameters())
 
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
+    def truncate_weights(self):
+        stats = self.mask_stats()
+        self.name2nonzeros.update(stats.nonzeros())
+        self.name2zeros.update(stats.zeros())
+
+        for name, weight in self.layers.named_parameters():
+            mask = self.masks[name]
+
+            # death
+            if self.death_mode == 'magnitude':
+                new_mask = self.magnitude_death(mask, weight, name)
+            elif self.death_mode == 'SET':
+                new_mask = self.magnitude_and_negativity_death(mask, weight, name)
+            elif self.death_mode == 'Taylor_FO':
+                new_mask = self.taylor_FO(mask, weight, name)
+            elif self.death_mode == 'threshold':
+                new_mask = self.threshold_death(mask, weight, name)
+
+            self.masks[name] = new_mask
+        self.num_remove.update(self.mask_stats().removed(stats))
+
+
+        grown = None
+        if self.growth_mode in ['random', 'momentum', 'gradient']:
+            grown = self.batched_growth()
+        else:
+            for name, weight in self.layers.named_parameters():
                 new_mask = self.masks[name].data.byte()
 
                 # growth
-                if self.growth_mode == 'random':
-                    new_mask = self.random_growth(name, new_mask, weight)
-
                 if self.growth_mode == 'random_unfired':
                     new_mask = self.random_unfired_growth(name, new_mask, weight)
 
-                elif self.growth_mode == 'momentum':
-                    new_mask = self.momentum_growth(name, new_mask, weight)
-
-                elif self.growth_mode == 'gradient':
-                    new_mask = self.gradient_growth(name, new_mask, weight)
-
-                new_nonzero = new_mask.sum().item()
-
                 # exchanging masks
-                self.masks.pop(name)
-                self.masks[name] = new_mask.float()
+                self.masks[name] = new_mask
 
         self.apply_mask()
+        if grown is None:
+            self.exploration.update(self.masks)
+        else:
+            # only the grown weights can have fired for the first time
+            for name in grown:
+                self.exploration.update_grown(name, grown[name])
 
 
     '''
@@ -364,10 +398,13 @@ class Masking(object):
 
         num_remove = math.ceil(self.death_rate * self.name2nonzeros[name])
         num_zeros = self.name2zeros[name]
-        k = math.ceil(num_zeros + num_remove)
 
-        x, idx = torch.sort((weight.data * weight.grad).pow(2).flatten())
-        mask.data.view(-1)[idx[:k]] = 0.0
+        # the k = num_zeros + num_remove smallest scores are the inactive entries (score 0)
+        # plus the num_remove smallest active ones, so only the active entries are selected from
+        active = mask.data.view(-1).nonzero().view(-1)
+        score = (weight.data * weight.grad).pow(2).flatten()[active]
+        _, idx = torch.topk(score, min(num_remove, active.numel()), largest=False)
+        mask.data.view(-1)[active[idx]] = 0.0
 
         return mask
 
@@ -377,11 +414,10 @@ class Masking(object):
         if num_remove == 0.0: return weight.data != 0.0
         num_zeros = self.name2zeros[name]
 
-        x, idx = torch.sort(torch.abs(weight.data.view(-1)))
-        n = idx.shape[0]
-
-        k = math.ceil(num_zeros + num_remove)
-        threshold = x[k-1].item()
+        # the num_zeros inactive weights are zero, so the k-th smallest magnitude overall
+        # is the num_remove-th smallest magnitude among the active weights
+        active = torch.abs(weight.data[mask != 0])
+        threshold = torch.kthvalue(active, min(num_remove, active.numel()))[0].item()
 
         return (torch.abs(weight.data) > threshold)
 
@@ -392,20 +428,20 @@ class Masking(object):
 
         # find magnitude threshold
         # remove all weights which absolute value is smaller than threshold
-        x, idx = torch.sort(weight[weight > 0.0].data.view(-1))
+        x = weight[weight > 0.0].data.view(-1)
         k = math.ceil(num_remove/2.0)
         if k >= x.shape[0]:
             k = x.shape[0]
 
-        threshold_magnitude = x[k-1].item()
+        threshold_magnitude = torch.kthvalue(x, k)[0].item() if k > 0 else x.max().item()
 
         # find negativity threshold
         # remove all weights which are smaller than threshold
-        x, idx = torch.sort(weight[weight < 0.0].view(-1))
+        x = weight[weight < 0.0].data.view(-1)
         k = math.ceil(num_remove/2.0)
         if k >= x.shape[0]:
             k = x.shape[0]
-        threshold_negativity = x[k-1].item()
+        threshold_negativity = torch.kthvalue(x, k)[0].item() if k > 0 else x.max().item()
 
 
         pos_mask = (weight.data > threshold_magnitude) & (weight.data > 0.0)
@@ -423,81 +459,45 @@ class Masking(object):
         total_regrowth = self.num_remove[name]
         n = (new_mask == 0).sum().item()
         if n == 0: return new_mask
-        num_nonfired_weights = (self.fired_masks[name]==0).sum().item()
+        num_nonfired_weights = self.exploration.unfired_count(name)
 
         if total_regrowth <= num_nonfired_weights:
-            idx = (self.fired_masks[name].flatten() == 0).nonzero()
-            indices = torch.randperm(len(idx))[:total_regrowth]
-
-            # idx = torch.nonzero(self.fired_masks[name].flatten())
-            new_mask.data.view(-1)[idx[indices]] = 1.0
+            new_mask.data.view(-1)[self.exploration.sample_unfired(name, total_regrowth)] = 1.0
         else:
-            new_mask[self.fired_masks[name]==0] = 1.0
+            new_mask[self.exploration.unfired_mask(name)] = 1.0
             n = (new_mask == 0).sum().item()
             expeced_growth_probability = ((total_regrowth-num_nonfired_weights) / n)
-            new_weights = torch.rand(new_mask.shape).cuda() < expeced_growth_probability
+            new_weights = torch.rand(new_mask.shape, device=new_mask.device) < expeced_growth_probability
             new_mask = new_mask.byte() | new_weights
         return new_mask
 
+    def growth_scores(self, weight):
+        if self.growth_mode == 'momentum': return self.get_momentum_for_weight(weight)
+        if self.growth_mode == 'gradient': return self.get_gradient_for_weights(weight)
+        return None
+
+    def batched_growth(self):
+        """random/momentum/gradient growth of all layers at once, see growth.grow; returns name -> grown indices."""
+        names = [name for name, weight in self.layers.named_parameters()]
+        scores = [self.growth_scores(weight) for name, weight in self.layers.named_parameters()]
+        new_masks, grown = grow([self.masks[name] for name in names], scores, [self.num_remove[name] for name in names], return_grown=True)
+        for name, new_mask in zip(names, new_masks):
+            self.masks[name] = new_mask
+        return dict(zip(names, grown))
+
     def random_growth(self, name, new_mask, weight):
-        total_regrowth = self.num_remove[name]
-        n = (new_mask==0).sum().item()
-        if n == 0: return new_mask
-        expeced_growth_probability = (total_regrowth/n)
-        new_weights = torch.rand(new_mask.shape).cuda() < expeced_growth_probability
-        new_mask_ = new_mask.byte() | new_weights
-        if (new_mask_!=0).sum().item() == 0:
-            new_mask_ = new_mask
-        return new_mask_
+        return grow([new_mask], [None], [self.num_remove[name]])[0]
 
     def momentum_growth(self, name, new_mask, weight):
-        total_regrowth = self.num_remove[name]
-        grad = self.get_momentum_for_weight(weight)
-        grad = grad*(new_mask==0).float()
-        y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
-        new_mask.data.view(-1)[idx[:total_regrowth]] = 1.0
-
-        return new_mask
+        return grow([new_mask], [self.get_momentum_for_weight(weight)], [self.num_remove[name]])[0]
 
     def gradient_growth(self, name, new_mask, weight):
-        total_regrowth = self.num_remove[name]
-        grad = self.get_gradient_for_weights(weight)
-        grad = grad*(new_mask==0).float()
-
-        y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
-        new_mask.data.view(-1)[idx[:total_regrowth]] = 1.0
-
-        return new_mask
+        return grow([new_mask], [self.get_gradient_for_weights(weight)], [self.num_remove[name]])[0]
 
 
 
     def momentum_neuron_growth(self, name, new_mask, weight):
-        total_regrowth = self.num_remove[name]
-        grad = self.get_momentum_for_weight(weight)
-
-        M = torch.abs(grad)
-        if len(M.shape) == 2: sum_dim = [1]
-        elif len(M.shape) == 4: sum_dim = [1, 2, 3]
-
-        v = M.mean(sum_dim).data
-        v /= v.sum()
-
-        slots_per_neuron = (new_mask==0).sum(sum_dim)
-
-        M = M*(new_mask==0).float()
-        for i, fraction  in enumerate(v):
-            neuron_regrowth = math.floor(fraction.item()*total_regrowth)
-            available = slots_per_neuron[i].item()
-
-            y, idx = torch.sort(M[i].flatten())
-            if neuron_regrowth > available:
-                neuron_regrowth = available
-            threshold = y[-(neuron_regrowth)].item()
-            if threshold == 0.0: continue
-            if neuron_regrowth < 10: continue
-            new_mask[i] = new_mask[i] | (M[i] > threshold)
-
-        return new_mask
+        return neuron_growth(new_mask, self.get_momentum_for_weight(weight), self.num_remove[name])
 
     '''
                 UTILITY
@@ -509,35 +509,32 @@ class Masking(object):
             grad = adam_m1/(torch.sqrt(adam_m2) + 1e-08)
         elif 'momentum_buffer' in self.optimizer.state[weight]:
             grad = self.optimizer.state[weight]['momentum_buffer']
+        elif 'compact_momentum' in self.optimizer.state[weight]:
+            grad = self.optimizer.dense_momentum(weight)
         return grad
 
     def get_gradient_for_weights(self, weight):
         grad = weight.grad.clone()
         return grad
 
+    def finish_topology_update(self):
+        """Swaps in a pending asynchronous topology update now, e.g. at the end of an epoch or of training."""
+        if self.topology_update is not None and self.topology_update.flush():
+            self.print_nonzero_counts()
+
     def print_nonzero_counts(self):
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
-                num_nonzeros = (mask != 0).sum().item()
-                val = '{0}: {1}->{2}, density: {3:.3f}'.format(name, self.name2nonzeros[name], num_nonzeros, num_nonzeros/float(mask.numel()))
-                print(val)
+        stats = self.mask_stats()
+        for name, num_nonzeros, density in zip(stats.names, stats.counts(), stats.density().values()):
+            val = '{0}: {1}->{2}, density: {3:.3f}'.format(name, self.name2nonzeros[name], num_nonzeros, density)
+            print(val)
         print('Prune rate: {0}\n'.format(self.death_rate))
 
     def fired_masks_update(self):
-        ntotal_fired_weights = 0.0
-        ntotal_weights = 0.0
-        layer_fired_weights = {}
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                self.fired_masks[name] = self.masks[name].data.byte() | self.fired_masks[name].data.byte()
-                ntotal_fired_weights += float(self.fired_masks[name].sum().item())
-                ntotal_weights += float(self.fired_masks[name].numel())
-                layer_fired_weights[name] = float(self.fired_masks[name].sum().item())/float(self.fired_masks[name].numel())
-                print('Layerwise percentage of the fired weights of', name, 'is:', layer_fired_weights[name])
-        total_fired_weights = ntotal_fired_weights/ntotal_weights
+        self.exploration.update(self.masks)
+        layer_fired_weights, total_fired_weights = self.exploration.rates()
+        layer_fired_weights = dict(layer_fired_weights)
+        for name in layer_fired_weights:
+            print('Layerwise percentage of the fired weights of', name, 'is:', layer_fired_weights[name])
         print('The percentage of the total fired weights is:', total_fired_weights)
         return layer_fired_weights, total_fired_weights
 
@@ -559,38 +556,19 @@ class Masking(object):
         return threshold
 
     def gradual_magnitude_pruning(self, current_pruning_rate, cpu=False):
-        weight_abs = []
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                if cpu:
-                    weight_abs.append(torch.abs(weight.cpu()))
-                else:
-                    weight_abs.append(torch.abs(weight))
-
-        # Gather all scores in a single vector and normalise
-        all_scores = torch.cat([torch.flatten(x) for x in weight_abs])
-        num_params_to_keep = int(len(all_scores) * (1 - current_pruning_rate))
-
-        threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-        acceptable_score = threshold[-1]
+        # exact global threshold, streamed layer by layer instead of concatenating all scores
+        weight_abs = lambda: (torch.abs(weight.cpu() if cpu else weight) for name, weight in self.layers.named_parameters())
+        num_params_to_keep = int(self.layers.numel() * (1 - current_pruning_rate))
+        acceptable_score = kth_largest(weight_abs, num_params_to_keep)
 
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                self.masks[name] = ((torch.abs(weight)) > acceptable_score).float().data.to(self.device)
+        for name, weight in self.layers.named_parameters():
+            self.masks[name] = ((torch.abs(weight)) > acceptable_score).float().data.to(self.device)
         self.apply_mask()
 
     def print_status(self):
-        total_size = 0
-        sparse_size = 0
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                dense_weight_num = weight.numel()
-                sparse_weight_num = (weight != 0).sum().int().item()
-                total_size += dense_weight_num
-                sparse_size += sparse_weight_num
-                layer_density = sparse_weight_num / dense_weight_num
-                print(f'sparsity of layer {name} with tensor {weight.size()} is {1-layer_density}')
+        stats = SparsityStats(self.layers.named_parameters())
+        for (name, weight), layer_density in zip(self.layers.named_parameters(), stats.density().values()):
+            print(f'sparsity of layer {name} with tensor {weight.size()} is {1-layer_density}')
+        total_size = stats.total_numel()
+        sparse_size = stats.total_nonzeros()
         print('Final sparsity level of {0}: {1}'.format(1-self.density, 1 - sparse_size / total_size))
@@ -5,6 +5,14 @@ import torch.nn.functional as F
 import torch.optim as optim
 import copy
 from sparselearning.snip import SNIP
+from sparselearning.mask_store import MaskStore, masked_mul_
+from sparselearning.registry import SparseLayerRegistry
+from sparselearning.selection import kth_largest
+from sparselearning.density import layerwise_density
+from sparselearning.sampler import sample_mask, layer_generator, num_ones
+from sparselearning.growth import grow, neuron_growth
+from sparselearning.stats import SparsityStats
+from sparselearning.exploration import ExplorationTracker
 import numpy as np
 import math
 
@@ -76,7 +84,7 @@ class Masking(object):
         self.train_loader = train_loader
         self.args = args
         self.LAMBDA_KER_DIST = self.args.LAMBDA_KER_DIST
-        self.device = torch.device("cuda")
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.growth_mode = growth_mode
         self.death_mode = death_mode
         self.growth_death_ratio = growth_death_ratio
@@ -85,7 +93,10 @@ class Masking(object):
         self.reini = args.reini
         self.mu = args.mu
 
-        self.masks = {}
+        self.masks = MaskStore(self.device, packed=getattr(args, 'packed_masks', False))
+        self.mask_seed = getattr(args, 'mask_seed', None)
+        self.layers = SparseLayerRegistry(self.masks, optimizer)
+        self._masked_version = -1
         self.modules = []
         self.names = []
         self.optimizer = optimizer
@@ -94,6 +105,8 @@ class Masking(object):
         self.name2zeros = {}
         self.num_remove = {}
         self.name2nonzeros = {}
+        # weights that have been active at some point (ITOP)
+        self.exploration = ExplorationTracker()
         self.death_rate = death_rate
         self.steps = 0
 
@@ -101,40 +114,37 @@ class Masking(object):
         if self.args.fix: self.prune_every_k_steps = None
         else: self.prune_every_k_steps = self.args.update_frequency
 
+    def random_mask(self, name, shape, density):
+        """Random mask of a layer with exactly num_ones(numel, density) active weights, built on self.device."""
+        generator = None
+        if self.mask_seed is not None:
+            generator = layer_generator(self.mask_seed, name, self.device)
+        return sample_mask(shape, density, self.device, generator)
+
     def init(self, mode='ERK', density=0.05, erk_power_scale=1.0):
         self.density = density
         if mode == 'global_magnitude':
             print('initialize by global magnitude')
-            weight_abs = []
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    weight_abs.append(torch.abs(weight))
-
-            # Gather all scores in a single vector and normalise
-            all_scores = torch.cat([torch.flatten(x) for x in weight_abs])
-            num_params_to_keep = int(len(all_scores) * self.density)
+            # exact global threshold, streamed layer by layer instead of concatenating all scores
+            weight_abs = lambda: (torch.abs(weight) for name, weight in self.layers.named_parameters())
+            num_params_to_keep = int(self.layers.numel() * self.density)
+            acceptable_score = kth_largest(weight_abs, num_params_to_keep)
 
-            threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-            acceptable_score = threshold[-1]
-
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name][:] = ((torch.abs(weight)) >= acceptable_score).float()
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = ((torch.abs(weight)) >= acceptable_score).float()
 
         elif mode == 'l1_authogonal':
             masks = self.l1_authogonal(mu=self.mu, density=density)
             for mask, name in zip(masks, self.masks):
                 assert (mask.shape == self.masks[name].shape)
-                self.masks[name][:] = mask
+                self.masks[name] = mask
 
         elif mode == 'snip':
             print('initialize by snip')
             snip_masks = SNIP(self.module, self.density, self.train_loader, self.device)
             for snip_mask, name in zip(snip_masks, self.masks):
                 assert (snip_mask.shape == self.masks[name].shape)
-                self.masks[name][:] = snip_mask
+                self.masks[name] = snip_mask
 
         elif mode == 'uniform_plus':
             print('initialize by uniform+')
@@ -151,28 +161,22 @@ class Masking(object):
                 total_sparse_params = total_sparse_params - self.masks['fc.weight'].numel() * 0.2
                 self.density = float(total_sparse_params / total_params)
 
-                for module in self.modules:
-                    for name, weight in module.named_parameters():
-                        if name not in self.masks: continue
-                        if name != 'fc.weight':
-                            self.masks[name][:] = (torch.rand(weight.shape) < self.density).float().data.cuda()
-                        else:
-                            self.masks[name][:] = (torch.rand(weight.shape) < 0.2).float().data.cuda()
+                for name, weight in self.layers.named_parameters():
+                    if name != 'fc.weight':
+                        self.masks[name] = self.random_mask(name, weight.shape, self.density)
+                    else:
+                        self.masks[name] = self.random_mask(name, weight.shape, 0.2)
             else:
-                for module in self.modules:
-                    for name, weight in module.named_parameters():
-                        if name not in self.masks: continue
-                        self.masks[name][:] = (torch.rand(weight.shape) < self.density).float().data.cuda()
+                for name, weight in self.layers.named_parameters():
+                    self.masks[name] = self.random_mask(name, weight.shape, self.density)
 
         elif mode == 'uniform':
             print('initialize by uniform')
             self.baseline_nonzero = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name][:] = (torch.rand(weight.shape) < self.density).float().data.cuda() #lsw
-                    # self.masks[name][:] = (torch.rand(weight.shape) < density).float().data #lsw
-                    self.baseline_nonzero += weight.numel()*density
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = self.random_mask(name, weight.shape, self.density) #lsw
+                # self.masks[name] = (torch.rand(weight.shape) < density).float().data #lsw
+                self.baseline_nonzero += num_ones(weight.numel(), density)
 
         elif mode == 'modifide_ERK':
 
@@ -194,112 +198,23 @@ class Masking(object):
             self.masks.pop('fc.weight')
 
 
-            is_epsilon_valid = False
-
-            dense_layers = set()
-
-            while not is_epsilon_valid:
-
-                divisor = 0
-
-                rhs = 0
-
-                raw_probabilities = {}
-
-                for name, mask in self.masks.items():
-
-                    n_param = np.prod(mask.shape)
-
-                    n_zeros = n_param * (1 - density)
-
-                    n_ones = n_param * density
-
-                    if name in dense_layers:
-
-                        # See `- default_sparsity * (N_3 + N_4)` part of the equation above.
-
-                        rhs -= n_zeros
-
-                    else:
-                        rhs += n_ones
-
-
-                        if len(mask.shape) != 2:
-
-                            raw_probabilities[name] = (
-
-                                                              np.sum(mask.shape[:-1]) / np.prod(mask.shape[:-1])
-
-                                                      ) ** erk_power_scale
-                        else:
-
-                            raw_probabilities[name] = (
-
-                                                              np.sum(mask.shape) / np.prod(mask.shape)
-
-                                                      ) ** erk_power_scale
-
-
-
-                        divisor += raw_probabilities[name] * n_param
-
-                epsilon = rhs / divisor
-
-                max_prob = np.max(list(raw_probabilities.values()))
-
-                max_prob_one = max_prob * epsilon
-
-                if max_prob_one > 1:
-
-                    is_epsilon_valid = False
-
-                    for mask_name, mask_raw_prob in raw_probabilities.items():
-
-                        if mask_raw_prob == max_prob:
-                            print(f"Sparsity of var:{mask_name} had to be set to 0.")
-
-                            dense_layers.add(mask_name)
-
-                else:
-
-                    is_epsilon_valid = True
-
-            density_dict = {}
+            shapes = [(name, self.masks.shape(name)) for name in self.masks]
+            density_dict = layerwise_density(shapes, density, 'modified_ERK', erk_power_scale)
 
             total_nonzero = 0.0
-
-            # With the valid epsilon, we can set sparsities of the remaning layers.
-
-            for name, mask in self.masks.items():
-
-                n_param = np.prod(mask.shape)
-
-                if name in dense_layers:
-
-                    density_dict[name] = 1.0
-
-                else:
-
-                    probability_one = epsilon * raw_probabilities[name]
-
-                    density_dict[name] = probability_one
-
-                print(
-
-                    f"layer: {name}, shape: {mask.shape}, density: {density_dict[name]}"
-
-                )
-
-                self.masks[name][:] = (torch.rand(mask.shape) < density_dict[name]).float().data.cuda()
-
-                total_nonzero += density_dict[name] * mask.numel()
+            for name, shape in shapes:
+                if density_dict[name] == 1.0:
+                    print(f"Sparsity of var:{name} had to be set to 0.")
+                print(f"layer: {name}, shape: {shape}, density: {density_dict[name]}")
+                self.masks[name] = self.random_mask(name, shape, density_dict[name])
+                total_nonzero += num_ones(shape.numel(), density_dict[name])
 
             for name, weight in self.module.named_parameters():
 
                 if name == 'fc.weight':
-                    self.masks[name] = (torch.rand(weight.shape) < 2 * self.density).float().data.cuda()
+                    self.masks[name] = self.random_mask(name, weight.shape, 2 * self.density)
 
-                    total_nonzero += 2 * self.density * weight.numel()
+                    total_nonzero += num_ones(weight.numel(), 2 * self.density)
 
             print(f"Overall sparsity {total_nonzero / total_params}")
 
@@ -310,69 +225,28 @@ class Masking(object):
             total_params = 0
             for name, weight in self.masks.items():
                 total_params += weight.numel()
-            is_epsilon_valid = False
-
-            dense_layers = set()
-            while not is_epsilon_valid:
+            shapes = [(name, self.masks.shape(name)) for name in self.masks]
+            density_dict = layerwise_density(shapes, self.density, 'ERK', erk_power_scale)
 
-                divisor = 0
-                rhs = 0
-                raw_probabilities = {}
-                for name, mask in self.masks.items():
-                    n_param = np.prod(mask.shape)
-                    n_zeros = n_param * (1 - self.density)
-                    n_ones = n_param * self.density
-
-                    if name in dense_layers:
-                        rhs -= n_zeros
-                    else:
-                        rhs += n_ones
-                        raw_probabilities[name] = (
-                                                          np.sum(mask.shape) / np.prod(mask.shape)
-                                                  ) ** erk_power_scale
-                        divisor += raw_probabilities[name] * n_param
-                epsilon = rhs / divisor
-                max_prob = np.max(list(raw_probabilities.values()))
-                max_prob_one = max_prob * epsilon
-                if max_prob_one > 1:
-                    is_epsilon_valid = False
-                    for mask_name, mask_raw_prob in raw_probabilities.items():
-                        if mask_raw_prob == max_prob:
-                            print(f"Sparsity of var:{mask_name} had to be set to 0.")
-                            dense_layers.add(mask_name)
-                else:
-                    is_epsilon_valid = True
-
-            density_dict = {}
             total_nonzero = 0.0
-            # With the valid epsilon, we can set sparsities of the remaning layers.
-            for name, mask in self.masks.items():
-                n_param = np.prod(mask.shape)
-                if name in dense_layers:
-                    density_dict[name] = 1.0
-                else:
-                    probability_one = epsilon * raw_probabilities[name]
-                    density_dict[name] = probability_one
-                print(
-                    f"layer: {name}, shape: {mask.shape}, density: {density_dict[name]}"
-                )
-                self.masks[name][:] = (torch.rand(mask.shape) < density_dict[name]).float().data.cuda()
-
-                total_nonzero += density_dict[name] * mask.numel()
+            for name, shape in shapes:
+                if density_dict[name] == 1.0:
+                    print(f"Sparsity of var:{name} had to be set to 0.")
+                print(f"layer: {name}, shape: {shape}, density: {density_dict[name]}")
+                self.masks[name] = self.random_mask(name, shape, density_dict[name])
+                total_nonzero += num_ones(shape.numel(), density_dict[name])
             print(f"Overall sparsity {total_nonzero / total_params}")
 
         self.apply_mask()
 
-        total_size = 0
-        sparse_size = 0
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name in self.masks:
-                    print(name, 'density:', (weight != 0).sum().item() / weight.numel())
-                    total_size += weight.numel()
-                    sparse_size += (weight != 0).sum().int().item()
+        stats = SparsityStats(self.layers.named_parameters())
+        for name, density_ in stats.density().items():
+            print(name, 'density:', density_)
+        total_size = stats.total_numel()
+        sparse_size = stats.total_nonzeros()
         print('Total Model parameters:', total_size)
         print('Total parameters under sparsity level of {0}: {1}'.format(self.density, sparse_size / total_size))
+        self.exploration.update(self.masks) # used for ITOP
 
     def step(self):
         self.optimizer.step()
@@ -392,6 +266,10 @@ class Masking(object):
         self.module = module
         self.modules.append(module)
         self.dense_model = copy.deepcopy(module)
+        # masks and everything derived from them live on the device of the model
+        self.device = next(module.parameters()).device
+        self.masks.device = self.device
+        self.layers.add_module(module)
         for name, tensor in module.named_parameters():
             self.names.append(name)
             self.masks[name] = torch.ones_like(tensor, dtype=torch.float32, requires_grad=False).to(self.device)
@@ -449,14 +327,38 @@ class Masking(object):
                 if isinstance(module, nn_type):
                     self.remove_weight(name)
 
+    def masked_parameters(self):
+        """Returns ([param], [mask]) for all masked parameters.
+
+        The lists are rebuilt only when the masks change (MaskStore.version),
+        so apply_mask does not walk named_parameters() on every step. Masks are
+        cast to the dtype of their parameter once per topology.
+        """
+        if self._masked_version != self.masks.version:
+            self._masked_params = []
+            self._masked_names = []
+            for name, tensor in self.layers.named_parameters():
+                self._masked_params.append(tensor)
+                self._masked_names.append(name)
+            self._masked_masks = None
+            if not self.masks.packed:
+                self._masked_masks = [self.masks[name].to(tensor.dtype) for name, tensor in zip(self._masked_names, self._masked_params)]
+            self._masked_version = self.masks.version
+        if self._masked_masks is None:
+            # packed masks are unpacked on every call to keep the memory saving
+            return self._masked_params, [self.masks[name].to(tensor.dtype) for name, tensor in zip(self._masked_names, self._masked_params)]
+        return self._masked_params, self._masked_masks
+
     def apply_mask(self):
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name in self.masks:
-                    tensor.data = tensor.data * self.masks[name]
-                    if 'momentum_buffer' in self.optimizer.state[tensor]:
-                        self.optimizer.state[tensor]['momentum_buffer'] = self.optimizer.state[tensor][
-                                                                              'momentum_buffer'] * self.masks[name]
+        params, masks = self.masked_parameters()
+        masked_mul_(params, masks)
+        buffers, buffer_masks = [], []
+        for tensor, mask in zip(params, masks):
+            buffer = self.optimizer.state[tensor].get('momentum_buffer')
+            if buffer is not None:
+                buffers.append(buffer)
+                buffer_masks.append(mask)
+        masked_mul_(buffers, buffer_masks)
 
     def truncate_weights_GMP(self, epoch):
         '''
@@ -471,73 +373,72 @@ class Masking(object):
             prune_decay = (1 - ((curr_prune_epoch - self.args.multiplier * self.args.init_prune_epoch) / total_prune_epochs)) ** 3
             curr_prune_rate = prune_rate - (prune_rate * prune_decay)
 
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
+            for name, weight in self.layers.named_parameters():
 
-                    x, idx = torch.sort(torch.abs(weight.data.view(-1)))
-                    p = int(curr_prune_rate * weight.numel())
-                    self.masks[name].data.view(-1)[idx[:p]] = 0.0
+                p = int(curr_prune_rate * weight.numel())
+                mask = self.masks[name]
+                # the inactive weights are zero and already among the p smallest magnitudes
+                active = mask.data.view(-1).nonzero().view(-1)
+                num_remove = min(max(p - (weight.numel() - active.numel()), 0), active.numel())
+                _, idx = torch.topk(torch.abs(weight.data.view(-1))[active], num_remove, largest=False)
+                mask.data.view(-1)[active[idx]] = 0.0
+                self.masks[name] = mask
             self.apply_mask()
-        total_size = 0
-        for name, weight in self.masks.items():
-            total_size += weight.numel()
+        stats = SparsityStats(self.masks.items())
+        total_size = stats.total_numel()
         print('Total Model parameters:', total_size)
 
-        sparse_size = 0
-        for name, weight in self.masks.items():
-            sparse_size += (weight != 0).sum().int().item()
+        sparse_size = stats.total_nonzeros()
 
         print('Total parameters under sparsity level of {0}: {1} after epoch of {2}'.format(self.density, sparse_size / total_size, epoch))
 
-    def truncate_weights(self):
-
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
-                self.name2nonzeros[name] = mask.sum().item()
-                self.name2zeros[name] = mask.numel() - self.name2nonzeros[name]
+    def mask_stats(self):
+        """Nonzero counts of all masks, see stats.SparsityStats."""
+        return SparsityStats((name, self.masks[name]) for name, weight in self.layers.named_parameters())
 
-                # death
-                if self.death_mode == 'magnitude':
-                    new_mask = self.magnitude_death(mask, weight, name)
-                elif self.death_mode == 'SET':
-                    new_mask = self.magnitude_and_negativity_death(mask, weight, name)
-                elif self.death_mode == 'Taylor_FO':
-                    new_mask = self.taylor_FO(mask, weight, name)
-                elif self.death_mode == 'threshold':
-                    new_mask = self.threshold_death(mask, weight, name)
-
-                self.num_remove[name] = int(self.name2nonzeros[name] - new_mask.sum().item())
-                self.masks[name][:] = new_mask
-
-
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
+    def truncate_weights(self):
+        stats = self.mask_stats()
+        self.name2nonzeros.update(stats.nonzeros())
+        self.name2zeros.update(stats.zeros())
+
+        for name, weight in self.layers.named_parameters():
+            mask = self.masks[name]
+
+            # death
+            if self.death_mode == 'magnitude':
+                new_mask = self.magnitude_death(mask, weight, name)
+            elif self.death_mode == 'SET':
+                new_mask = self.magnitude_and_negativity_death(mask, weight, name)
+            elif self.death_mode == 'Taylor_FO':
+                new_mask = self.taylor_FO(mask, weight, name)
+            elif self.death_mode == 'threshold':
+                new_mask = self.threshold_death(mask, weight, name)
+
+            self.masks[name] = new_mask
+        self.num_remove.update(self.mask_stats().removed(stats))
+
+
+        grown = None
+        if self.growth_mode in ['random', 'momentum', 'gradient']:
+            grown = self.batched_growth()
+        else:
+            for name, weight in self.layers.named_parameters():
                 new_mask = self.masks[name].data.byte()
 
                 # growth
-                if self.growth_mode == 'random':
-                    new_mask = self.random_growth(name, new_mask, weight)
-
                 if self.growth_mode == 'random_unfired':
                     new_mask = self.random_unfired_growth(name, new_mask, weight)
 
-                elif self.growth_mode == 'momentum':
-                    new_mask = self.momentum_growth(name, new_mask, weight)
-
-                elif self.growth_mode == 'gradient':
-                    new_mask = self.gradient_growth(name, new_mask, weight)
-
-                new_nonzero = new_mask.sum().item()
-
                 # exchanging masks
-                self.masks.pop(name)
-                self.masks[name] = new_mask.float()
+                self.masks[name] = new_mask
 
         self.apply_mask()
+        if grown is None:
+            self.exploration.update(self.masks)
+        else:
+            # only the grown weights can have fired for the first time
+            for name in grown:
+                self.exploration.update_grown(name, grown[name])
 
 
     '''
@@ -551,10 +452,13 @@ class Masking(object):
 
         num_remove = math.ceil(self.death_rate * self.name2nonzeros[name])
         num_zeros = self.name2zeros[name]
-        k = math.ceil(num_zeros + num_remove)
 
-        x, idx = torch.sort((weight.data * weight.grad).pow(2).flatten())
-        mask.data.view(-1)[idx[:k]] = 0.0
+        # the k = num_zeros + num_remove smallest scores are the inactive entries (score 0)
+        # plus the num_remove smallest active ones, so only the active entries are selected from
+        active = mask.data.view(-1).nonzero().view(-1)
+        score = (weight.data * weight.grad).pow(2).flatten()[active]
+        _, idx = torch.topk(score, min(num_remove, active.numel()), largest=False)
+        mask.data.view(-1)[active[idx]] = 0.0
 
         return mask
 
@@ -564,11 +468,10 @@ class Masking(object):
         if num_remove == 0.0: return weight.data != 0.0
         num_zeros = self.name2zeros[name]
 
-        x, idx = torch.sort(torch.abs(weight.data.view(-1)))
-        n = idx.shape[0]
-
-        k = math.ceil(num_zeros + num_remove)
-        threshold = x[k-1].item()
+        # the num_zeros inactive weights are zero, so the k-th smallest magnitude overall
+        # is the num_remove-th smallest magnitude among the active weights
+        active = torch.abs(weight.data[mask != 0])
+        threshold = torch.kthvalue(active, min(num_remove, active.numel()))[0].item()
 
         return (torch.abs(weight.data) > threshold)
 
@@ -579,20 +482,20 @@ class Masking(object):
 
         # find magnitude threshold
         # remove all weights which absolute value is smaller than threshold
-        x, idx = torch.sort(weight[weight > 0.0].data.view(-1))
+        x = weight[weight > 0.0].data.view(-1)
         k = math.ceil(num_remove/2.0)
         if k >= x.shape[0]:
             k = x.shape[0]
 
-        threshold_magnitude = x[k-1].item()
+        threshold_magnitude = torch.kthvalue(x, k)[0].item() if k > 0 else x.max().item()
 
         # find negativity threshold
         # remove all weights which are smaller than threshold
-        x, idx = torch.sort(weight[weight < 0.0].view(-1))
+        x = weight[weight < 0.0].data.view(-1)
         k = math.ceil(num_remove/2.0)
         if k >= x.shape[0]:
             k = x.shape[0]
-        threshold_negativity = x[k-1].item()
+        threshold_negativity = torch.kthvalue(x, k)[0].item() if k > 0 else x.max().item()
 
 
         pos_mask = (weight.data > threshold_magnitude) & (weight.data > 0.0)
@@ -610,81 +513,45 @@ class Masking(object):
         total_regrowth = self.num_remove[name]
         n = (new_mask == 0).sum().item()
         if n == 0: return new_mask
-        num_nonfired_weights = (self.fired_masks[name]==0).sum().item()
+        num_nonfired_weights = self.exploration.unfired_count(name)
 
         if total_regrowth <= num_nonfired_weights:
-            idx = (self.fired_masks[name].flatten() == 0).nonzero()
-            indices = torch.randperm(len(idx))[:total_regrowth]
-
-            # idx = torch.nonzero(self.fired_masks[name].flatten())
-            new_mask.data.view(-1)[idx[indices]] = 1.0
+            new_mask.data.view(-1)[self.exploration.sample_unfired(name, total_regrowth)] = 1.0
         else:
-            new_mask[self.fired_masks[name]==0] = 1.0
+            new_mask[self.exploration.unfired_mask(name)] = 1.0
             n = (new_mask == 0).sum().item()
             expeced_growth_probability = ((total_regrowth-num_nonfired_weights) / n)
-            new_weights = torch.rand(new_mask.shape).cuda() < expeced_growth_probability
+            new_weights = torch.rand(new_mask.shape, device=new_mask.device) < expeced_growth_probability
             new_mask = new_mask.byte() | new_weights
         return new_mask
 
+    def growth_scores(self, weight):
+        if self.growth_mode == 'momentum': return self.get_momentum_for_weight(weight)
+        if self.growth_mode == 'gradient': return self.get_gradient_for_weights(weight)
+        return None
+
+    def batched_growth(self):
+        """random/momentum/gradient growth of all layers at once, see growth.grow; returns name -> grown indices."""
+        names = [name for name, weight in self.layers.named_parameters()]
+        scores = [self.growth_scores(weight) for name, weight in self.layers.named_parameters()]
+        new_masks, grown = grow([self.masks[name] for name in names], scores, [self.num_remove[name] for name in names], return_grown=True)
+        for name, new_mask in zip(names, new_masks):
+            self.masks[name] = new_mask
+        return dict(zip(names, grown))
+
     def random_growth(self, name, new_mask, weight):
-        total_regrowth = self.num_remove[name]
-        n = (new_mask==0).sum().item()
-        if n == 0: return new_mask
-        expeced_growth_probability = (total_regrowth/n)
-        new_weights = torch.rand(new_mask.shape).cuda() < expeced_growth_probability
-        new_mask_ = new_mask.byte() | new_weights
-        if (new_mask_!=0).sum().item() == 0:
-            new_mask_ = new_mask
-        return new_mask_
+        return grow([new_mask], [None], [self.num_remove[name]])[0]
 
     def momentum_growth(self, name, new_mask, weight):
-        total_regrowth = self.num_remove[name]
-        grad = self.get_momentum_for_weight(weight)
-        grad = grad*(new_mask==0).float()
-        y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
-        new_mask.data.view(-1)[idx[:total_regrowth]] = 1.0
-
-        return new_mask
+        return grow([new_mask], [self.get_momentum_for_weight(weight)], [self.num_remove[name]])[0]
 
     def gradient_growth(self, name, new_mask, weight):
-        total_regrowth = self.num_remove[name]
-        grad = self.get_gradient_for_weights(weight)
-        grad = grad*(new_mask==0).float()
-
-        y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
-        new_mask.data.view(-1)[idx[:total_regrowth]] = 1.0
-
-        return new_mask
+        return grow([new_mask], [self.get_gradient_for_weights(weight)], [self.num_remove[name]])[0]
 
 
 
     def momentum_neuron_growth(self, name, new_mask, weight):
-        total_regrowth = self.num_remove[name]
-        grad = self.get_momentum_for_weight(weight)
-
-        M = torch.abs(grad)
-        if len(M.shape) == 2: sum_dim = [1]
-        elif len(M.shape) == 4: sum_dim = [1, 2, 3]
-
-        v = M.mean(sum_dim).data
-        v /= v.sum()
-
-        slots_per_neuron = (new_mask==0).sum(sum_dim)
-
-        M = M*(new_mask==0).float()
-        for i, fraction  in enumerate(v):
-            neuron_regrowth = math.floor(fraction.item()*total_regrowth)
-            available = slots_per_neuron[i].item()
-
-            y, idx = torch.sort(M[i].flatten())
-            if neuron_regrowth > available:
-                neuron_regrowth = available
-            threshold = y[-(neuron_regrowth)].item()
-            if threshold == 0.0: continue
-            if neuron_regrowth < 10: continue
-            new_mask[i] = new_mask[i] | (M[i] > threshold)
-
-        return new_mask
+        return neuron_growth(new_mask, self.get_momentum_for_weight(weight), self.num_remove[name])
 
     '''
                 UTILITY
@@ -703,34 +570,22 @@ class Masking(object):
         return grad
 
     def print_nonzero_counts(self):
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
-                num_nonzeros = (mask != 0).sum().item()
-                val = '{0}: {1}->{2}, density: {3:.3f}'.format(name, self.name2nonzeros[name], num_nonzeros, num_nonzeros/float(mask.numel()))
-                print(val)
+        stats = self.mask_stats()
+        for name, num_nonzeros, density in zip(stats.names, stats.counts(), stats.density().values()):
+            val = '{0}: {1}->{2}, density: {3:.3f}'.format(name, self.name2nonzeros[name], num_nonzeros, density)
+            print(val)
 
 
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name not in self.masks: continue
-                print('Death rate: {0}\n'.format(self.death_rate))
-                break
+        for name, tensor in self.layers.named_parameters():
+            print('Death rate: {0}\n'.format(self.death_rate))
+            break
 
     def fired_masks_update(self):
-        ntotal_fired_weights = 0.0
-        ntotal_weights = 0.0
-        layer_fired_weights = {}
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                self.fired_masks[name] = self.masks[name].data.byte() | self.fired_masks[name].data.byte()
-                ntotal_fired_weights += float(self.fired_masks[name].sum().item())
-                ntotal_weights += float(self.fired_masks[name].numel())
-                layer_fired_weights[name] = float(self.fired_masks[name].sum().item())/float(self.fired_masks[name].numel())
-                print('Layerwise percentage of the fired weights of', name, 'is:', layer_fired_weights[name])
-        total_fired_weights = ntotal_fired_weights/ntotal_weights
+        self.exploration.update(self.masks)
+        layer_fired_weights, total_fired_weights = self.exploration.rates()
+        layer_fired_weights = dict(layer_fired_weights)
+        for name in layer_fired_weights:
+            print('Layerwise percentage of the fired weights of', name, 'is:', layer_fired_weights[name])
         print('The percentage of the total fired weights is:', total_fired_weights)
         return layer_fired_weights, total_fired_weights
 
@@ -762,7 +617,7 @@ class Masking(object):
         and M.*W is sparse
         """
         print('pruning at initializatin with l1norm authogonal')
-        approxed_paras = copy.deepcopy(self.masks)
+        approxed_paras = {name: mask.clone() for name, mask in self.masks.items()}
         for name in approxed_paras:
             approxed_paras[name].requires_grad = True
         optimizer = optim.SGD(approxed_paras.values(), momentum=0.9, lr=0.1)
@@ -781,7 +636,7 @@ class Masking(object):
             for name, weight in self.dense_model.named_parameters():
                 if name in self.masks:
                     para = approxed_paras[name] * weight
-                    layer_loss[name] = torch.norm(torch.matmul(torch.transpose(para.view(-1, para.size()[1]),0,1), para.view(-1, para.size()[1])) - torch.eye(para.size()[1]).cuda()) \
+                    layer_loss[name] = torch.norm(torch.matmul(torch.transpose(para.view(-1, para.size()[1]),0,1), para.view(-1, para.size()[1])) - torch.eye(para.size()[1], device=para.device)) \
                                        + mu*torch.norm(para, 1)
 
             loss = sum(layer_loss.values())
@@ -797,11 +652,8 @@ class Masking(object):
             if name in self.masks:
                 scores.append(torch.abs(approxed_paras[name]* weight))
 
-        all_scores = torch.cat([torch.flatten(x) for x in scores])
-
-        num_params_to_keep = int(len(all_scores) * density)
-        threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-        acceptable_score = threshold[-1]
+        num_params_to_keep = int(sum(x.numel() for x in scores) * density)
+        acceptable_score = kth_largest(scores, num_params_to_keep)
 
         layer_wise_sparsities = []
         for g in scores:
@@ -814,10 +666,8 @@ class Masking(object):
         # use dictionary to apply masks.
         print('approximate_isometry starts...')
         approxed_paras = {}
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                approxed_paras[name] = weight
+        for name, weight in self.layers.named_parameters():
+            approxed_paras[name] = weight
         optimizer = optim.SGD(approxed_paras.values(), momentum=0.9, lr=0.1)
         for e in range(1, 10001):
             if e == int(10000/3):
@@ -831,7 +681,7 @@ class Masking(object):
             layer_loss = {}
             for name in approxed_paras:
                 para = approxed_paras[name]
-                layer_loss[name] = torch.norm(torch.matmul(torch.transpose(para.view(-1, para.size()[1]),0,1), para.view(-1, para.size()[1])) - torch.eye(para.size()[1]).cuda())
+                layer_loss[name] = torch.norm(torch.matmul(torch.transpose(para.view(-1, para.size()[1]),0,1), para.view(-1, para.size()[1])) - torch.eye(para.size()[1], device=para.device))
             loss = sum(layer_loss.values())
             # loss.to(self.device)
             loss.backward(retain_graph=True)
@@ -860,12 +710,12 @@ class Masking(object):
         with torch.no_grad():
             for i, (inputs, targets) in enumerate(xloader):
                 if i >= recalbn: break
-                inputs = inputs.cuda(device=device, non_blocking=True)
+                inputs = inputs.to(device, non_blocking=True)
                 _, _ = network(inputs)
         return network
 
     def ntk_app_train(self, xloader, networks, recalbn=0, train_mode=False, num_batch=-1):
-        device = torch.cuda.current_device()
+        device = self.device
         # if recalbn > 0:
         #     network = recal_bn(network, xloader, recalbn, device)
         #     if network_2 is not None:
@@ -885,10 +735,10 @@ class Masking(object):
             logits = []
             grads = [[] for _ in range(len(networks))]
             if num_batch > 0 and i >= num_batch: break
-            inputs = inputs.cuda(device=device, non_blocking=True)
+            inputs = inputs.to(device, non_blocking=True)
             for net_idx, network in enumerate(networks):
                 network.zero_grad()
-                inputs_ = inputs.clone().cuda(device=device, non_blocking=True)
+                inputs_ = inputs.clone().to(device, non_blocking=True)
                 logit = network(inputs_)
                 logits.append(logit)
 
@@ -902,7 +752,7 @@ class Masking(object):
                             grad.append(W.grad.view(-1).detach())
                     grads[net_idx].append(torch.cat(grad, -1))
                     network.zero_grad()
-                    torch.cuda.empty_cache()
+                    if device.type == 'cuda': torch.cuda.empty_cache()
             ######
             # print(torch.equal(logits[0], logits[1]))
             grads = [torch.stack(_grads, 0) for _grads in grads]
@@ -0,0 +1,121 @@
+import torch
+from collections import OrderedDict
+from sparselearning.mask_store import MaskStore, pack_bits, unpack_bits, popcount, _table, _BIT_WEIGHTS
+
+
+class ExplorationTracker(object):
+    """Which weights have been active at some point during training (In-Time Over-Parameterization).
+
+    The fired state of a layer is kept as packed bits, 1 bit per weight, and
+    the number of fired weights per layer as a device counter. update() ORs
+    the current masks into the bits and only adds the newly fired weights to
+    the counters, so the exploration rate never needs a rescan of the fired
+    masks. The counters of all layers are copied to the host together, once
+    per update, when they are first read. Packed MaskStore masks are ORed in
+    as they are stored, without unpacking them. After a growth step that
+    knows which weights it grew, update_grown() only looks at those weights:
+    every other active weight was active, and so fired, before.
+
+    For random_unfired growth, sample_unfired() draws never-fired weights from
+    a cached list of candidate indices. Candidates that fired since are
+    skipped by a bit lookup, and the list is only rebuilt (one nonzero() over
+    the layer) once more than half of it has fired.
+    """
+    def __init__(self):
+        self._bits = OrderedDict()
+        self._shapes = {}
+        self._counts = OrderedDict()
+        self._candidates = {}
+        self._host = None
+
+    def reset(self):
+        self.__init__()
+
+    def __contains__(self, name):
+        return name in self._bits
+
+    def update(self, masks):
+        """Marks the active weights of every mask (a name -> mask mapping, e.g. a MaskStore) as fired."""
+        store = isinstance(masks, MaskStore)
+        for name in masks:
+            if store and masks.packed:
+                bits = masks.raw(name)
+            else:
+                bits = pack_bits(masks[name])
+            if name not in self._bits:
+                # the raw bits of a packed store are its masks: ORing into them in place would change the masks
+                self._bits[name] = bits.clone() if store and masks.packed else bits
+                self._shapes[name] = masks.shape(name) if store else masks[name].shape
+                self._counts[name] = popcount(bits)
+                continue
+            fired = self._bits[name]
+            new = bits & ~fired
+            fired |= new
+            self._counts[name] = self._counts[name] + popcount(new)
+        self._host = None
+
+    def update_grown(self, name, grown):
+        """Marks the weights growth.grow grew in layer name as fired, in O(number of grown weights).
+
+        grown is the (index, valid) pair of grow(..., return_grown=True), or
+        None. The other active weights of the layer must have been marked
+        before, i.e. update() saw the masks before this growth step.
+        """
+        if grown is None: return
+        index, valid = grown
+        new = valid & ~self._fired_at(name, index)
+        # the newly fired bits are distinct and unset, so adding them to their bytes sets them
+        bits = _table(_BIT_WEIGHTS, index.device)[index & 7] * new.to(torch.uint8)
+        self._bits[name].index_add_(0, index >> 3, bits)
+        self._counts[name] = self._counts[name] + new.sum()
+        self._host = None
+
+    def fired_counts(self):
+        """Number of fired weights per layer (host ints)."""
+        if self._host is None:
+            counts = torch.stack([count.to(torch.long) for count in self._counts.values()]).tolist() if len(self._counts) > 0 else []
+            self._host = OrderedDict(zip(self._counts.keys(), counts))
+        return self._host
+
+    def unfired_count(self, name):
+        return self._shapes[name].numel() - self.fired_counts()[name]
+
+    def rates(self):
+        """(fraction of fired weights per layer, fraction of fired weights over all layers)."""
+        counts = self.fired_counts()
+        numels = {name: self._shapes[name].numel() for name in counts}
+        layer_rates = OrderedDict((name, count / float(numels[name])) for name, count in counts.items())
+        total = sum(counts.values()) / float(max(sum(numels.values()), 1))
+        return layer_rates, total
+
+    def fired_mask(self, name, dtype=torch.uint8):
+        return unpack_bits(self._bits[name], self._shapes[name], dtype)
+
+    def unfired_mask(self, name):
+        """bool mask of the weights that never fired."""
+        return unpack_bits(~self._bits[name], self._shapes[name], torch.bool)
+
+    def _fired_at(self, name, idx):
+        weights = _table(_BIT_WEIGHTS, idx.device)
+        return (self._bits[name][idx >> 3] & weights[idx & 7]) != 0
+
+    def sample_unfired(self, name, k, generator=None):
+        """k distinct never-fired flat indices of layer name, drawn uniformly (k <= unfired_count(name))."""
+        candidates = self._candidates.get(name)
+        if candidates is None or 2 * self.unfired_count(name) < candidates.numel():
+            candidates = self.unfired_mask(name).view(-1).nonzero().view(-1)
+            self._candidates[name] = candidates
+        scores = torch.rand(candidates.numel(), device=candidates.device, generator=generator)
+        scores[self._fired_at(name, candidates)] = -1.0
+        return candidates[torch.topk(scores, k)[1]]
+
+    def state_dict(self):
+        return OrderedDict((name, {'shape': tuple(self._shapes[name]), 'bits': bits.cpu()}) for name, bits in self._bits.items())
+
+    def load_state_dict(self, state, device=None):
+        self.reset()
+        for name, entry in state.items():
+            bits = entry['bits'] if device is None else entry['bits'].to(device)
+            self._bits[name] = bits
+            self._shapes[name] = torch.Size(entry['shape'])
+            self._counts[name] = popcount(bits)
@@ -0,0 +1,83 @@
+from collections import OrderedDict
+
+
+class SparseLayer(object):
+    """A masked parameter together with the metadata the masking code keeps looking up."""
+    __slots__ = ('name', 'param', 'shape', 'numel', 'fan_in', 'fan_out', 'registry')
+
+    def __init__(self, name, param, registry):
+        self.name = name
+        self.param = param
+        self.shape = param.shape
+        self.numel = param.numel()
+        self.registry = registry
+        if param.dim() >= 2:
+            receptive_field = param[0][0].numel()
+            self.fan_in = param.shape[1] * receptive_field
+            self.fan_out = param.shape[0] * receptive_field
+        else:
+            self.fan_in = self.fan_out = self.numel
+
+    @property
+    def mask(self):
+        return self.registry.masks[self.name]
+
+    @mask.setter
+    def mask(self, mask):
+        self.registry.masks[self.name] = mask
+
+    @property
+    def state(self):
+        """The optimizer state dict of this parameter (e.g. holding the momentum_buffer)."""
+        return self.registry.optimizer.state[self.param]
+
+
+class SparseLayerRegistry(object):
+    """Ordered registry of the parameters of the modules added to Masking.
+
+    It is built once in Masking.add_module. Iterating it yields only the layers
+    that currently have a mask, in module order. The filtered list is cached and
+    rebuilt only when the set of masks changes (MaskStore.keys_version), so the
+    usual `for module in modules: for name, weight in module.named_parameters():
+    if name not in masks: continue` scan becomes a walk over a short list.
+    """
+    def __init__(self, masks, optimizer=None):
+        self.masks = masks
+        self.optimizer = optimizer
+        self._layers = OrderedDict()
+        self._active = []
+        self._named = []
+        self._version = -1
+
+    def add_module(self, module):
+        for name, param in module.named_parameters():
+            self._layers[name] = SparseLayer(name, param, self)
+        self._version = -1
+
+    def _refresh(self):
+        if self._version != self.masks.keys_version:
+            self._active = [layer for name, layer in self._layers.items() if name in self.masks]
+            self._named = [(layer.name, layer.param) for layer in self._active]
+            self._version = self.masks.keys_version
+        return self._active
+
+    def __iter__(self):
+        return iter(self._refresh())
+
+    def __len__(self):
+        return len(self._refresh())
+
+    def __getitem__(self, name):
+        return self._layers[name]
+
+    def __contains__(self, name):
+        return name in self._layers and name in self.masks
+
+    def numel(self):
+        """Total number of weights in the masked layers."""
+        return sum(layer.numel for layer in self._refresh())
+
+    def named_parameters(self):
+        """(name, param) for every masked parameter, like module.named_parameters() filtered by the masks."""
+        self._refresh()
+        return self._named
@@ -0,0 +1,55 @@
+import zlib
+import torch
+
+
+def num_ones(numel, density):
+    """Number of active weights sample_mask puts in a layer of numel weights."""
+    return min(max(int(round(numel * density)), 0), numel)
+
+
+def layer_generator(seed, name, device=None):
+    """A torch.Generator on device seeded from (seed, layer name).
+
+    Each layer gets its own stream, so the mask of a layer does not depend
+    on the other layers or on the order in which they are sampled.
+    """
+    generator = torch.Generator(device=device if device is not None else 'cpu')
+    generator.manual_seed((seed * 1000003 + zlib.crc32(name.encode())) % 2**63)
+    return generator
+
+
+def _choose(numel, k, device, generator):
+    # k distinct indices drawn uniformly from range(numel), for k <= numel / 2.
+    # Draw with replacement and drop duplicates until there are enough; unique()
+    # sorts, so the k indices that are kept are again chosen at random.
+    picked = torch.empty(0, dtype=torch.long, device=device)
+    while picked.numel() < k:
+        draws = int((k - picked.numel()) * 1.1) + 16
+        picked = torch.unique(torch.cat([picked, torch.randint(numel, (draws,), device=device, generator=generator)]))
+    if picked.numel() > k:
+        picked = picked[torch.randperm(picked.numel(), device=device, generator=generator)[:k]]
+    return picked
+
+
+def sample_mask(shape, density, device=None, generator=None, dtype=torch.bool):
+    """Random mask with exactly num_ones(numel, density) active weights.
+
+    Replaces `(torch.rand(shape) < density).float().data.cuda()`, which builds
+    a float32 random tensor on the CPU, copies it over and only hits the
+    target count in expectation. Here only the indices of the minority side
+    (the ones for density <= 0.5, the zeros otherwise) are drawn, directly on
+    device, and scattered into a bool mask.
+
+    Args:
+        shape       Shape of the layer.
+        density     Fraction of active weights.
+        device      Device the mask is built on.
+        generator   Optional torch.Generator on that device (see layer_generator).
+        dtype       dtype of the returned mask.
+    """
+    numel = torch.Size(shape).numel()
+    k = num_ones(numel, density)
+    fill = 2 * k > numel
+    mask = torch.full((numel,), fill, dtype=torch.bool, device=device)
+    mask[_choose(numel, numel - k if fill else k, device, generator)] = not fill
+    return mask.view(shape).to(dtype)
@@ -0,0 +1,100 @@
+import struct
+import torch
+
+_BITS = 8
+_BINS = 1 << _BITS
+_SHIFTS = (24, 16, 8, 0)
+
+
+def _keys(x):
+    """Maps float32 values to int64 keys in [0, 2**32) that sort in the same order as the floats."""
+    i = x.detach().float().reshape(-1).view(torch.int32).long()
+    return torch.where(i < 0, i ^ 0x7fffffff, i) + 2**31
+
+
+def _from_key(key):
+    i = key - 2**31
+    if i < 0: i ^= 0x7fffffff
+    return struct.unpack('<f', struct.pack('<i', i))[0]
+
+
+def kth_largest(scores, k):
+    """Exact k-th largest entry over several score tensors, without concatenating them.
+
+    Same value as torch.topk(torch.cat([s.flatten() for s in scores]), k)[0][-1],
+    computed with a radix select: each of 4 passes histograms the next 8 bits
+    of the order-preserving float keys of the entries that still share the
+    already-fixed prefix, so the extra memory is 256 bins plus one layer's keys
+    at a time.
+
+    Args:
+        scores      A list of tensors, or a function returning a fresh iterable
+                    of tensors (e.g. a generator over the layers). A function
+                    is called once per pass, so the scores of all layers never
+                    have to be kept at the same time.
+        k           1 <= k <= total number of entries.
+
+    Returns:
+        The k-th largest value as a python float.
+    """
+    return _from_key(_kth_key(scores, k))
+
+
+def _kth_key(scores, k):
+    stream = scores if callable(scores) else (lambda: scores)
+    prefix = 0
+    for shift in _SHIFTS:
+        hist = None
+        for score in stream():
+            keys = _keys(score)
+            if shift != _SHIFTS[0]:
+                keys = keys[(keys >> (shift + _BITS)) == prefix]
+            counts = torch.bincount((keys >> shift) & (_BINS - 1), minlength=_BINS)
+            hist = counts if hist is None else hist + counts.to(hist.device)
+        counts = hist.tolist()
+        if shift == _SHIFTS[0] and not 1 <= k <= sum(counts):
+            raise ValueError('k={0} is out of range for {1} scores'.format(k, sum(counts)))
+        for digit in range(_BINS - 1, -1, -1):
+            if counts[digit] >= k: break
+            k -= counts[digit]
+        prefix = (prefix << _BITS) | digit
+    return prefix
+
+
+def top_k_masks(scores, k):
+    """Boolean masks of exactly the k largest entries over several score tensors.
+
+    The k-th largest key is found with the radix select of kth_largest; every
+    entry above it is kept, and of the entries equal to it only the first ones
+    in (layer, flat index) order, so that exactly k entries are selected and
+    the result is deterministic. Entries that must never be selected can be
+    given a score of -inf.
+
+    Args:
+        scores      A list of tensors (or a function returning a fresh iterable
+                    of them, as for kth_largest).
+        k           Number of entries to select, clipped to [0, number of entries].
+
+    Returns:
+        (list of bool masks of the shapes of the scores, k-th largest value).
+        The value is None if nothing is selected.
+    """
+    stream = scores if callable(scores) else (lambda: scores)
+    k = min(int(k), sum(score.numel() for score in stream()))
+    if k <= 0:
+        return [torch.zeros(score.shape, dtype=torch.bool, device=score.device) for score in stream()], None
+    key = _kth_key(stream, k)
+    masks, ties = [], []
+    for score in stream():
+        keys = _keys(score)
+        masks.append(keys > key)
+        ties.append(keys == key)
+    remaining = k - int(sum(mask.sum() for mask in masks))
+    # cumulative count of the tied entries over all layers, offset by the ties of the earlier layers
+    offset = 0
+    for mask, tie in zip(masks, ties):
+        rank = torch.cumsum(tie, 0) + offset
+        mask |= tie & (rank <= remaining)
+        # a 0-d count, also for layers without entries (rank[-1:] of those would be empty)
+        offset = offset + tie.sum()
+    return [mask.view(score.shape) for mask, score in zip(masks, stream())], _from_key(key)
@@ -5,6 +5,7 @@ import torch.nn.functional as F
 import math
 import copy
 import types
+from sparselearning.selection import kth_largest
 
 
 def snip_forward_conv2d(self, x):
@@ -16,7 +17,8 @@ def snip_forward_linear(self, x):
         return F.linear(x, self.weight * self.weight_mask, self.bias)
 
 
-def SNIP(net, keep_ratio, train_dataloader, device):
+def SNIP(net, keep_ratio, train_dataloader, device=None):
+    if device is None: device = next(net.parameters()).device
 
     # Grab a single batch from the training dataset
     inputs, targets = next(iter(train_dataloader))
@@ -53,14 +55,11 @@ def SNIP(net, keep_ratio, train_dataloader, device):
         if isinstance(layer, nn.Conv2d) or isinstance(layer, nn.Linear):
             grads_abs.append(torch.abs(layer.weight_mask.grad))
 
-    # Gather all scores in a single vector and normalise
-    all_scores = torch.cat([torch.flatten(x) for x in grads_abs])
-    norm_factor = torch.sum(all_scores)
-    all_scores.div_(norm_factor)
+    # Normalise and find the global threshold layer by layer, without concatenating all scores
+    norm_factor = sum(torch.sum(x) for x in grads_abs)
 
-    num_params_to_keep = int(len(all_scores) * keep_ratio)
-    threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-    acceptable_score = threshold[-1]
+    num_params_to_keep = int(sum(x.numel() for x in grads_abs) * keep_ratio)
+    acceptable_score = kth_largest(lambda: (x / norm_factor for x in grads_abs), num_params_to_keep)
 
     layer_wise_sparsities = []
     for g in grads_abs:
@@ -72,6 +71,7 @@ def SNIP(net, keep_ratio, train_dataloader, device):
     return layer_wise_sparsities
 
 def SNIP_training(net, keep_ratio, train_dataloader, device, masks, death_rate):
+    if device is None: device = next(net.parameters()).device
     # TODO: shuffle?
 
     # Grab a single batch from the training dataset
@@ -174,7 +174,8 @@ def count_fc_parameters(net):
     return total
 
 
-def GraSP(net, ratio, train_dataloader, device, num_classes=10, samples_per_class=25, num_iters=1, T=200, reinit=True):
+def GraSP(net, ratio, train_dataloader, device=None, num_classes=10, samples_per_class=25, num_iters=1, T=200, reinit=True):
+    if device is None: device = next(net.parameters()).device
     eps = 1e-10
     keep_ratio = ratio
     old_net = net
@@ -261,16 +262,12 @@ def GraSP(net, ratio, train_dataloader, device, num_classes=10, samples_per_clas
         if isinstance(layer, nn.Conv2d) or isinstance(layer, nn.Linear):
             grads[old_modules[idx]] = -layer.weight.data * layer.weight.grad  # -theta_q Hg
 
-    # Gather all scores in a single vector and normalise
-    all_scores = torch.cat([torch.flatten(x) for x in grads.values()])
-    norm_factor = torch.abs(torch.sum(all_scores)) + eps
+    # Normalise and find the global threshold layer by layer, without concatenating all scores
+    norm_factor = torch.abs(sum(torch.sum(x) for x in grads.values())) + eps
     print("** norm factor:", norm_factor)
-    all_scores.div_(norm_factor)
 
-    num_params_to_rm = int(len(all_scores) * (1-keep_ratio))
-    threshold, _ = torch.topk(all_scores, num_params_to_rm, sorted=True)
-    # import pdb; pdb.set_trace()
-    acceptable_score = threshold[-1]
+    num_params_to_rm = int(sum(x.numel() for x in grads.values()) * (1-keep_ratio))
+    acceptable_score = kth_largest(lambda: (x / norm_factor for x in grads.values()), num_params_to_rm)
     print('** accept: ', acceptable_score)
 
     layer_wise_sparsities = []
@@ -283,7 +280,8 @@ def GraSP(net, ratio, train_dataloader, device, num_classes=10, samples_per_clas
 
     return layer_wise_sparsities
 
-def synflow(net, keep_ratio, train_dataloader, device):
+def synflow(net, keep_ratio, train_dataloader, device=None):
+    if device is None: device = next(net.parameters()).device
 
     @torch.no_grad()
     def linearize(model):
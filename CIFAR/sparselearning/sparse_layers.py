@@ -0,0 +1,191 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# upper bound on the size of the (nnz chunk x columns) products in the weight gradient
+_CHUNK_ELEMENTS = 1 << 22
+
+
+class CSRStructure(object):
+    """Sparsity pattern of a 2D weight in CSR form, together with its transpose.
+
+    The values are not stored: they are gathered from the dense weight with
+    `index`, so the structure only has to be rebuilt when the mask changes.
+    """
+    def __init__(self, mask):
+        rows, cols = (mask != 0).nonzero(as_tuple=True)
+        self.shape = tuple(mask.shape)
+        self.rows, self.cols = rows, cols
+        self.index = rows * self.shape[1] + cols
+        self.crow = self._crow(rows, self.shape[0])
+        # transpose: the same entries ordered by column, values permuted by `perm`
+        self.perm = torch.argsort(cols * self.shape[0] + rows)
+        self.tcrow = self._crow(cols, self.shape[1])
+        self.tcol = rows[self.perm]
+
+    @staticmethod
+    def _crow(rows, n):
+        crow = torch.zeros(n + 1, dtype=torch.long, device=rows.device)
+        crow[1:] = torch.cumsum(torch.bincount(rows, minlength=n), 0)
+        return crow
+
+    def nnz(self):
+        return self.index.numel()
+
+    def matrix(self, values):
+        return torch.sparse_csr_tensor(self.crow, self.cols, values, self.shape)
+
+    def transposed(self, values):
+        return torch.sparse_csr_tensor(self.tcrow, self.tcol, values[self.perm], (self.shape[1], self.shape[0]))
+
+
+class SparseMM(torch.autograd.Function):
+    """out = W @ rhs for a CSR weight W whose values are given as a dense vector."""
+    @staticmethod
+    def forward(ctx, values, rhs, structure):
+        ctx.structure = structure
+        ctx.save_for_backward(values, rhs)
+        return torch.sparse.mm(structure.matrix(values), rhs)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        values, rhs = ctx.saved_tensors
+        structure = ctx.structure
+        grad_values = grad_rhs = None
+        if ctx.needs_input_grad[1]:
+            grad_rhs = torch.sparse.mm(structure.transposed(values), grad_out)
+        if ctx.needs_input_grad[0]:
+            # dW is only needed at the active entries: dW[r, c] = <grad_out[r], rhs[c]>
+            grad_values = torch.empty_like(values)
+            step = max(1, _CHUNK_ELEMENTS // max(1, rhs.shape[1]))
+            for start in range(0, structure.nnz(), step):
+                rows = structure.rows[start:start+step]
+                cols = structure.cols[start:start+step]
+                grad_values[start:start+step] = (grad_out[rows] * rhs[cols]).sum(1)
+        return grad_values, grad_rhs, None
+
+
+class _SparseMixin(object):
+    """Sparse execution for layers whose weight is masked.
+
+    The dense weight stays the nn.Parameter, so optimizers, checkpoints and
+    Masking keep working on it unchanged. Forward and backward only touch the
+    active weights: the CSR pattern comes from the mask and the values are
+    gathered from the weight on every call. The gradient of the weight is zero
+    outside of the mask, so growth modes that need dense gradients (gradient,
+    momentum) see no signal for inactive weights; use random growth with
+    sparse layers.
+    """
+    def _init_sparse(self):
+        self.structure = None
+        self.masks = None
+        self.mask_name = None
+        self._mask_version = -1
+
+    def set_mask(self, mask):
+        """Fixes the sparsity pattern to the nonzeros of mask (None: run dense)."""
+        if mask is None:
+            self.structure = None
+        else:
+            self.structure = CSRStructure(mask.detach().to(self.weight.device).reshape(self.weight.shape[0], -1))
+
+    def attach(self, masks, name):
+        """Follows masks[name] of a MaskStore, rebuilding the pattern whenever the masks change."""
+        self.masks, self.mask_name = masks, name
+        self._mask_version = -1
+
+    def _structure(self):
+        if self.masks is not None and self._mask_version != self.masks.version:
+            self.set_mask(self.masks[self.mask_name] if self.mask_name in self.masks else None)
+            self._mask_version = self.masks.version
+        return self.structure
+
+    def _values(self, structure):
+        return self.weight.reshape(-1)[structure.index]
+
+
+class SparseLinear(_SparseMixin, nn.Linear):
+    def __init__(self, *args, **kwargs):
+        super(SparseLinear, self).__init__(*args, **kwargs)
+        self._init_sparse()
+
+    @classmethod
+    def from_dense(cls, linear):
+        sparse = cls(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        sparse.weight, sparse.bias = linear.weight, linear.bias
+        return sparse
+
+    def forward(self, input):
+        structure = self._structure()
+        if structure is None:
+            return super(SparseLinear, self).forward(input)
+        shape = input.shape
+        values = self._values(structure)
+        out = SparseMM.apply(values, input.reshape(-1, shape[-1]).t().to(values.dtype), structure).t()
+        if self.bias is not None:
+            out = out + self.bias
+        return out.reshape(shape[:-1] + (self.out_features,))
+
+
+class SparseConv2d(_SparseMixin, nn.Conv2d):
+    """Conv2d as im2col (F.unfold) followed by a CSR x dense product."""
+    def __init__(self, *args, **kwargs):
+        super(SparseConv2d, self).__init__(*args, **kwargs)
+        self._init_sparse()
+
+    @classmethod
+    def from_dense(cls, conv):
+        sparse = cls(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                     dilation=conv.dilation, groups=conv.groups, bias=conv.bias is not None, padding_mode=conv.padding_mode)
+        sparse.weight, sparse.bias = conv.weight, conv.bias
+        return sparse
+
+    def forward(self, input):
+        structure = self._structure()
+        if structure is None:
+            return super(SparseConv2d, self).forward(input)
+        n, _, h, w = input.shape
+        out_h = (h + 2*self.padding[0] - self.dilation[0]*(self.kernel_size[0] - 1) - 1) // self.stride[0] + 1
+        out_w = (w + 2*self.padding[1] - self.dilation[1]*(self.kernel_size[1] - 1) - 1) // self.stride[1] + 1
+        cols = F.unfold(input, self.kernel_size, dilation=self.dilation, padding=self.padding, stride=self.stride)
+        # (N, C*k*k, L) -> (C*k*k, N*L), so the whole batch is one sparse product
+        rhs = cols.transpose(0, 1).reshape(cols.shape[1], -1)
+        values = self._values(structure)
+        out = SparseMM.apply(values, rhs.to(values.dtype), structure)
+        out = out.reshape(self.out_channels, n, out_h, out_w).transpose(0, 1)
+        if self.bias is not None:
+            out = out + self.bias.view(1, -1, 1, 1)
+        return out
+
+
+def convert_to_sparse(model, masks=None):
+    """Replaces the nn.Conv2d / nn.Linear layers of model by SparseConv2d / SparseLinear in place.
+
+    Works for any model built from these layers (cifar_resnet, vgg, ImageNet
+    resnet.ResNet, ...). The new layers share the original parameters, so
+    parameter names and optimizer state are unchanged. With masks (a
+    MaskStore, e.g. Masking.masks) each layer follows its mask; without, the
+    pattern is taken from the current nonzeros of the weights. Grouped
+    convolutions and non-zero padding modes are left dense.
+
+    Returns:
+        The names of the converted layers.
+    """
+    converted = []
+    for module_name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if type(child) is nn.Conv2d and child.groups == 1 and child.padding_mode == 'zeros' and not isinstance(child.padding, str):
+                sparse = SparseConv2d.from_dense(child)
+            elif type(child) is nn.Linear:
+                sparse = SparseLinear.from_dense(child)
+            else:
+                continue
+            name = child_name if module_name == '' else module_name + '.' + child_name
+            if masks is not None:
+                sparse.attach(masks, name + '.weight')
+            else:
+                sparse.set_mask(child.weight != 0)
+            sparse.train(child.training)
+            setattr(module, child_name, sparse)
+            converted.append(name)
+    return converted
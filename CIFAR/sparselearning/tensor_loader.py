@@ -0,0 +1,164 @@
+import numpy as np
+import torch
+from torchvision import datasets
+from sparselearning.prefetch import background
+
+
+def _source_index(index, size, pad, mode):
+    """Maps indices into the padded axis (0 .. size+2*pad-1) to indices into the image and a validity flag."""
+    index = index - pad
+    if mode == 'reflect':
+        index = index.abs()
+        index = torch.where(index > size - 1, 2 * (size - 1) - index, index)
+        return index, None
+    valid = (index >= 0) & (index < size)
+    return index.clamp(0, size - 1), valid
+
+
+def augment_batch(images, pad=0, pad_mode='reflect', flip=False, generator=None):
+    """Random crop of the padded images plus a random horizontal flip, for a whole uint8 batch at once.
+
+    Same result as F.pad (reflect) or zero padding followed by RandomCrop and
+    RandomHorizontalFlip per image, but padding, crop and flip are folded
+    into one gather from the unpadded (N, C, H, W) batch.
+    """
+    n, c, h, w = images.shape
+    if pad == 0 and not flip: return images
+    device = images.device
+    top = torch.randint(0, 2 * pad + 1, (n, 1), device=device, generator=generator)
+    left = torch.randint(0, 2 * pad + 1, (n, 1), device=device, generator=generator)
+    cols = torch.arange(w, device=device).unsqueeze(0)
+    if flip:
+        flipped = torch.rand(n, 1, device=device, generator=generator) < 0.5
+        cols = torch.where(flipped, (w - 1) - cols, cols)
+    rows, row_valid = _source_index(top + torch.arange(h, device=device).unsqueeze(0), h, pad, pad_mode)
+    cols, col_valid = _source_index(left + cols, w, pad, pad_mode)
+
+    batch = torch.arange(n, device=device).view(n, 1, 1, 1)
+    channel = torch.arange(c, device=device).view(1, c, 1, 1)
+    out = images[batch, channel, rows.view(n, 1, h, 1), cols.view(n, 1, 1, w)]
+    if row_valid is not None:
+        out = out * (row_valid.view(n, 1, h, 1) & col_valid.view(n, 1, 1, w))
+    return out
+
+
+class TensorImageLoader(object):
+    """Drop-in for a DataLoader over an image dataset that is kept in memory as one uint8 tensor.
+
+    Every batch is an index slice of the (N, C, H, W) uint8 tensor (in a new
+    random order every epoch when shuffle is set), augmented with
+    augment_batch and normalized with one fused multiply-add, instead of a
+    ToTensor/PIL round trip per image in worker processes. With device set,
+    the images are moved there once and batches are built on that device.
+    With background=True the next batches are built by one background thread.
+
+    Args:
+        images      uint8 tensor (N, C, H, W).
+        targets     int64 tensor (N,).
+        batch_size  Images per batch; the last batch may be smaller.
+        shuffle     Reshuffle every epoch.
+        pad         Padding for the random crop (0: no crop).
+        pad_mode    'reflect' or 'constant' (zero) padding.
+        flip        Random horizontal flips.
+        mean, std   Per-channel normalization of the [0, 1] scaled pixels.
+        device      Device the data is kept and the batches are built on.
+        background  Build batches in a background thread.
+        pin_memory  Return pinned CPU batches (CPU data only).
+    """
+    def __init__(self, images, targets, batch_size, shuffle=False, pad=0, pad_mode='reflect', flip=False,
+                 mean=(0.0,), std=(1.0,), device=None, background=False, pin_memory=False):
+        self.images = images if device is None else images.to(device)
+        self.targets = targets if device is None else targets.to(device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pad, self.pad_mode, self.flip = pad, pad_mode, flip
+        channels = self.images.shape[1]
+        mean = torch.tensor(mean, dtype=torch.float32).expand(channels)
+        std = torch.tensor(std, dtype=torch.float32).expand(channels)
+        # (x/255 - mean)/std as x*scale + shift
+        self.scale = (1.0 / (255.0 * std)).view(1, -1, 1, 1).to(self.images.device)
+        self.shift = (-mean / std).view(1, -1, 1, 1).to(self.images.device)
+        self.background = background
+        self.pin_memory = pin_memory and self.images.device.type == 'cpu' and torch.cuda.is_available()
+
+    def __len__(self):
+        return (len(self.targets) + self.batch_size - 1) // self.batch_size
+
+    def _batch(self, index):
+        images = augment_batch(self.images[index], self.pad, self.pad_mode, self.flip)
+        data = torch.addcmul(self.shift, images.float(), self.scale)
+        target = self.targets[index]
+        if self.pin_memory:
+            data, target = data.pin_memory(), target.pin_memory()
+        return data, target
+
+    def _batches(self):
+        n = len(self.targets)
+        order = torch.randperm(n, device=self.images.device) if self.shuffle else torch.arange(n, device=self.images.device)
+        for start in range(0, n, self.batch_size):
+            yield self._batch(order[start:start + self.batch_size])
+
+    def __iter__(self):
+        if not self.background:
+            return self._batches()
+        return background(self._batches(), depth=2)
+
+
+def _nchw(data):
+    data = torch.as_tensor(np.asarray(data))
+    if data.dim() == 3: data = data.unsqueeze(1)   # MNIST: (N, H, W)
+    else: data = data.permute(0, 3, 1, 2)          # CIFAR: (N, H, W, C)
+    return data.contiguous()
+
+
+def _split_loaders(args, train_set, test_set, validation_split, device, train_kwargs, test_kwargs):
+    images, targets = _nchw(train_set.data), torch.as_tensor(train_set.targets, dtype=torch.long)
+    background = getattr(args, 'max_threads', 1) > 1
+    valid_loader = None
+    if validation_split > 0.0:
+        # same split as DatasetSplitter: the first part trains, the rest validates
+        split = int(np.floor((1.0-validation_split) * len(targets)))
+        train_loader = TensorImageLoader(images[:split], targets[:split], args.batch_size, shuffle=True,
+                                         device=device, background=background, **train_kwargs)
+        valid_loader = TensorImageLoader(images[split:], targets[split:], args.test_batch_size,
+                                         device=device, **train_kwargs)
+    else:
+        train_loader = TensorImageLoader(images, targets, args.batch_size, shuffle=True,
+                                         device=device, background=background, **train_kwargs)
+
+    print('Train loader length', len(train_loader))
+
+    test_loader = TensorImageLoader(_nchw(test_set.data), torch.as_tensor(test_set.targets, dtype=torch.long),
+                                    args.test_batch_size, device=device, **test_kwargs)
+    return train_loader, valid_loader, test_loader
+
+
+def get_cifar10_tensor_loaders(args, validation_split=0.0, device=None):
+    """In-memory version of utils.get_cifar10_dataloaders (reflect padding, random crop, flip)."""
+    normalize = dict(mean=(0.4914, 0.4822, 0.4465), std=(0.2023, 0.1994, 0.2010))
+    train_set = datasets.CIFAR10('_dataset', True, download=True)
+    test_set = datasets.CIFAR10('_dataset', False, download=False)
+    # as with DatasetSplitter, the validation split is drawn from the augmented training set
+    return _split_loaders(args, train_set, test_set, validation_split, device,
+                          dict(pad=4, pad_mode='reflect', flip=True, **normalize), normalize)
+
+
+def get_cifar100_tensor_loaders(args, validation_split=0.0, device=None):
+    """In-memory version of utils.get_cifar100_dataloaders (zero padding, random crop, flip)."""
+    normalize = dict(mean=(0.5070751592371323, 0.48654887331495095, 0.4409178433670343),
+                     std=(0.2673342858792401, 0.2564384629170883, 0.27615047132568404))
+    print('==> Preparing data..')
+    train_set = datasets.CIFAR100(root='./data', train=True, download=True)
+    test_set = datasets.CIFAR100(root='./data', train=False, download=True)
+    # like get_cifar100_dataloaders, no validation split: the test set doubles as validation set
+    train_loader, _, test_loader = _split_loaders(args, train_set, test_set, 0.0, device,
+                                                  dict(pad=4, pad_mode='constant', flip=True, **normalize), normalize)
+    return train_loader, test_loader, test_loader
+
+
+def get_mnist_tensor_loaders(args, validation_split=0.0, device=None):
+    """In-memory version of utils.get_mnist_dataloaders (normalization only)."""
+    normalize = dict(mean=(0.1307,), std=(0.3081,))
+    train_set = datasets.MNIST('../data', train=True, download=True)
+    test_set = datasets.MNIST('../data', train=False)
+    return _split_loaders(args, train_set, test_set, validation_split, device, normalize, normalize)
@@ -1,9 +1,11 @@
 import os
+import contextlib
 import numpy as np
 import torch
 import torch.nn.functional as F
 import torchvision
 from torchvision import datasets, transforms
+from sparselearning.tensor_loader import get_cifar10_tensor_loaders, get_cifar100_tensor_loaders, get_mnist_tensor_loaders
 
 class DatasetSplitter(torch.utils.data.Dataset):
     """This splitter makes sure that we always use the same training/validation split"""
@@ -25,8 +27,32 @@ class DatasetSplitter(torch.utils.data.Dataset):
         return self.parent_dataset[index + self.split_start]
 
 
+def configure_cpu(args, device):
+    """Applies --threads and checks that --bf16 autocast is supported by this torch."""
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if args.bf16 and not hasattr(torch, 'autocast'):
+        print('WARNING: torch.autocast not available, ignoring --bf16 option')
+        args.bf16 = False
+    if device.type == 'cpu':
+        print('CPU training: {0} threads, channels_last={1}, bf16={2}'.format(torch.get_num_threads(), args.channels_last, args.bf16))
+
+
+@contextlib.contextmanager
+def _no_autocast():
+    # contextlib.nullcontext needs Python 3.7
+    yield
+
+
+def autocast(device, enabled):
+    """bf16 autocast on the given device, or a no-op context when disabled."""
+    if not enabled: return _no_autocast()
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+
 def get_cifar100_dataloaders(args, validation_split=0.0, max_threads=10):
     """Creates augmented train, validation, and test data loaders."""
+    if getattr(args, 'tensor_loader', None): return get_cifar100_tensor_loaders(args, validation_split, args.tensor_loader)
     cifar_mean = (0.5070751592371323, 0.48654887331495095, 0.4409178433670343)
     cifar_std = (0.2673342858792401, 0.2564384629170883, 0.27615047132568404)
     # Data
@@ -54,6 +80,7 @@ def get_cifar100_dataloaders(args, validation_split=0.0, max_threads=10):
 
 def get_cifar10_dataloaders(args, validation_split=0.0, max_threads=10):
     """Creates augmented train, validation, and test data loaders."""
+    if getattr(args, 'tensor_loader', None): return get_cifar10_tensor_loaders(args, validation_split, args.tensor_loader)
 
     normalize = transforms.Normalize((0.4914, 0.4822, 0.4465),
                                      (0.2023, 0.1994, 0.2010))
@@ -158,6 +185,7 @@ def get_tinyimagenet_dataloaders(args, validation_split=0.0):
 
 def get_mnist_dataloaders(args, validation_split=0.0):
     """Creates augmented train, validation, and test data loaders."""
+    if getattr(args, 'tensor_loader', None): return get_mnist_tensor_loaders(args, validation_split, args.tensor_loader)
     normalize = transforms.Normalize((0.1307,), (0.3081,))
     transform = transform=transforms.Compose([transforms.ToTensor(),normalize])
 
@@ -0,0 +1,97 @@
+import numpy as np
+import torch
+
+
+def fast_collate(batch):
+    imgs = [img[0] for img in batch]
+    targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
+    w = imgs[0].size[0]
+    h = imgs[0].size[1]
+    tensor = torch.zeros( (len(imgs), 3, h, w), dtype=torch.uint8 )
+    for i, img in enumerate(imgs):
+        nump_array = np.asarray(img, dtype=np.uint8)
+        # tens = torch.from_numpy(nump_array)
+        if(nump_array.ndim < 3):
+            nump_array = np.expand_dims(nump_array, axis=-1)
+        nump_array = np.rollaxis(nump_array, 2)
+        nump_array_copy = np.copy(nump_array)
+        tensor[i] += torch.from_numpy(nump_array_copy)
+
+    return tensor, targets
+
+
+class NHWCCollate(object):
+    """collate_fn that writes the decoded HWC pixels straight into a reusable uint8 NHWC batch.
+
+    fast_collate zero-fills a new NCHW tensor per batch and makes two copies
+    plus an add per image (np.copy of the transposed array, then +=). Here
+    each image is copied once, as is, into a slot of a preallocated
+    (N, H, W, 3) buffer; the NHWC -> NCHW change is left to the device, where
+    prefetched_loader views the batch as a channels_last NCHW tensor without
+    moving any data (see is_nhwc).
+
+    The buffers are allocated lazily in the process that collates, in shared
+    memory inside DataLoader workers, so handing a batch to the main process
+    does not copy it. They are reused round robin, so `ring` must be larger
+    than the number of batches of one worker that can be alive at the same
+    time (prefetch_factor queued + 1 being pinned). The pin thread copies the
+    batch into new pinned memory before the GPU sees it, so the asynchronous
+    device copies never read a shared buffer.
+
+    With pin=True (collating in the main process, num_workers=0) every batch
+    is a new pinned tensor instead. It is copied to the GPU with
+    non_blocking=True, and a ring cannot tell when that copy has finished;
+    the caching host allocator only hands a pinned block out again once the
+    copies recorded on it are done, so the allocations stay cheap and safe.
+
+    Args:
+        ring    Number of shared batch buffers per process.
+        pin     Collate into new pinned tensors instead of shared buffers.
+    """
+    def __init__(self, ring=4, pin=False):
+        self.ring = ring
+        self.pin = pin
+        self._buffers = []
+        self._next = 0
+
+    def _buffer(self, n, h, w):
+        if self.pin:
+            return torch.empty((n, h, w, 3), dtype=torch.uint8, pin_memory=True)
+        slot = self._next
+        self._next = (slot + 1) % self.ring
+        buffer = self._buffers[slot] if slot < len(self._buffers) else None
+        if buffer is None or buffer.shape[0] < n or tuple(buffer.shape[1:3]) != (h, w):
+            buffer = torch.empty((n, h, w, 3), dtype=torch.uint8).share_memory_()
+            if slot < len(self._buffers): self._buffers[slot] = buffer
+            else: self._buffers.append(buffer)
+        # a smaller last batch uses the first rows of the buffer
+        return buffer[:n]
+
+    def __call__(self, batch):
+        targets = torch.tensor([target for img, target in batch], dtype=torch.int64)
+        w, h = batch[0][0].size
+        tensor = self._buffer(len(batch), h, w)
+        out = tensor.numpy()
+        for i, (img, target) in enumerate(batch):
+            pixels = np.asarray(img, dtype=np.uint8)
+            if pixels.ndim < 3:
+                # grayscale: the same plane for all 3 channels, as fast_collate does
+                pixels = pixels[:, :, None]
+            out[i] = pixels
+        return tensor, targets
+
+
+def is_nhwc(loader):
+    """True if the batches of loader are (N, H, W, 3): it collates with NHWCCollate or says so (loader.nhwc)."""
+    return getattr(loader, 'nhwc', False) or isinstance(getattr(loader, 'collate_fn', None), NHWCCollate)
+
+
+def get_collate(workers, nhwc=False):
+    """fast_collate, or an NHWCCollate whose buffers outlive the batches (and device copies) in flight."""
+    if not nhwc:
+        return fast_collate, True
+    if workers == 0:
+        # collated in this process: new pinned batches, nothing left for the pin thread to do
+        return NHWCCollate(ring=3, pin=torch.cuda.is_available()), False
+    # prefetch_factor (2) batches per worker queued, one being pinned, one spare
+    return NHWCCollate(ring=4), True
@@ -7,7 +7,17 @@ import numpy as np
 import math
 from snip import SNIP, prefetched_loader, GraSP
 from torch.autograd import Variable
-from funcs import redistribution_funcs, growth_funcs, prune_funcs
+from funcs import redistribution_funcs, growth_funcs, prune_funcs, batched_growth_scores
+from growth import grow, water_fill
+from mask_store import MaskStore, masked_mul_
+from registry import SparseLayerRegistry
+from density import layerwise_density
+from sampler import sample_mask, layer_generator, num_ones
+from stats import SparsityStats
+from exploration import ExplorationTracker
+from mask_sync import MaskSync
+from mask_delta import MaskDelta
+from sparse_allreduce import reset_inactive_momentum
 
 def add_sparse_args(parser):
     parser.add_argument('--growth', type=str, default='gradient', help='Growth mode. Choose from: momentum, random, and momentum_neuron.')
@@ -22,6 +32,10 @@ def add_sparse_args(parser):
     parser.add_argument('--sparse_init', type=str, default='ER', help='sparse initialization')
     parser.add_argument('--multiplier', type=int, default=1, metavar='N', help='extend training time by multiplier times')
     parser.add_argument('--fc_density', type=float, default=1, help='The pruning rate / death rate.')
+    parser.add_argument('--packed-masks', action='store_true', help='Keep masks as packed bits (1 bit per weight) instead of float tensors. Saves memory, costs an unpack per mask access.')
+    parser.add_argument('--mask-seed', type=int, default=None, help='Seed the random masks per layer (by layer name), so the initial topology does not depend on the global RNG state.')
+    parser.add_argument('--mask-check-every', type=int, default=1000, metavar='N', help='All-reduce a checksum of the masks every N steps in distributed runs and re-sync them if the ranks diverged (0: never).')
+    parser.add_argument('--mask-delta-sync', action='store_true', help='In distributed runs, compute mask updates on rank 0 only and broadcast the changed indices (varint-coded deltas) to the other ranks.')
     #------------------
     #parameters of reinitialization
     # ------------------
@@ -95,7 +109,7 @@ class Masking(object):
         self.redistribution_mode = redistribution_mode
         self.prune_rate_decay = prune_rate_decay
         self.verbose = verbose
-        self.device = torch.device("cuda")
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         self.growth_func = growth_mode
         self.prune_func = prune_mode
@@ -104,7 +118,14 @@ class Masking(object):
         self.global_growth = False
         self.global_prune = False
         self.fc_density = args.fc_density
-        self.masks = {}
+        self.masks = MaskStore(self.device, packed=getattr(args, 'packed_masks', False))
+        self.mask_seed = getattr(args, 'mask_seed', None)
+        self.layers = SparseLayerRegistry(self.masks, optimizer)
+        self._masked_version = -1
+        # bumped whenever the topology is (re)initialized or updated; masks are synced across ranks on changes
+        self.topology_version = 0
+        self.mask_sync = None
+        self.mask_delta = None
         self.modules = []
         self.names = []
         self.optimizer = optimizer
@@ -118,12 +139,15 @@ class Masking(object):
         self.name2variance = {}
         self.name2zeros = {}
         self.name2nonzeros = {}
+        # weights that have been active at some point (ITOP)
+        self.exploration = ExplorationTracker()
         self.name2removed = {}
 
         self.total_variance = 0
         self.total_removed = 0
         self.total_zero = 0
         self.total_nonzero = 0
+        self.stats = None
         self.prune_rate = prune_rate
         self.name2prune_rate = {}
         self.steps = 0
@@ -146,8 +170,16 @@ class Masking(object):
                 self.name_to_32bit[name] = tensor2
             self.half = True
 
+    def random_mask(self, name, shape, density):
+        """Random mask of a layer with exactly num_ones(numel, density) active weights, built on self.device."""
+        generator = None
+        if self.mask_seed is not None:
+            generator = layer_generator(self.mask_seed, name, self.device)
+        return sample_mask(shape, density, self.device, generator)
+
     def init(self, mode='ERK', density=0.05, erk_power_scale=1.0):
         self.density = density
+        self.topology_version += 1
         self.init_growth_prune_and_redist()
         self.init_optimizer()
         if mode == 'uniform':
@@ -156,11 +188,9 @@ class Masking(object):
             # each layer will have weight.numel()*density weights.
             # weight.numel()*density == weight.numel()*(1.0-sparsity)
             self.baseline_nonzero = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name][:] = (torch.rand(weight.shape) < density).float().data.cuda()
-                    self.baseline_nonzero += weight.numel()*density
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = self.random_mask(name, weight.shape, density)
+                self.baseline_nonzero += num_ones(weight.numel(), density)
             self.apply_mask()
 
         elif mode == 'GraSP':
@@ -168,7 +198,7 @@ class Masking(object):
             layer_wise_sparsities = GraSP(self.module, self.density, self.train_loader, self.device)
             # re-sample mask positions
             for sparsity_, name in zip(layer_wise_sparsities, self.masks):
-                self.masks[name][:] = (torch.rand(self.masks[name].shape) < (1-sparsity_)).float().data.cuda()
+                self.masks[name] = self.random_mask(name, self.masks.shape(name), 1-sparsity_)
 
         elif mode == 'snip':
             print('initialize by snip')
@@ -176,8 +206,8 @@ class Masking(object):
             snip_masks = SNIP(self.module, self.density, self.train_loader, self.device, self.masks, self.args)
             for snip_mask, name in zip(snip_masks, self.masks):
                 assert (snip_mask.shape == self.masks[name].shape)
-                self.masks[name][:] = snip_mask
-                self.baseline_nonzero += (self.masks[name]!=0).sum().item()
+                self.masks[name] = snip_mask
+            self.baseline_nonzero = self.mask_stats().total_nonzeros()
 
         elif mode == 'resume':
             print('initialized with resume')
@@ -186,14 +216,12 @@ class Masking(object):
             # if you want to resume a sparse model but did not
             # save the mask.
             self.baseline_nonzero = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    print((weight != 0.0).sum().item())
-                    if name in self.name_to_32bit:
-                        print('W2')
-                    self.masks[name][:] = (weight != 0.0).float().data.cuda()
-                    self.baseline_nonzero += weight.numel()*density
+            for name, weight in self.layers.named_parameters():
+                print((weight != 0.0).sum().item())
+                if name in self.name_to_32bit:
+                    print('W2')
+                self.masks[name] = (weight != 0.0).float().data.to(self.device)
+                self.baseline_nonzero += weight.numel()*density
             self.apply_mask()
 
         elif mode == 'ERK_plus':
@@ -204,86 +232,33 @@ class Masking(object):
                 total_params += weight.numel()
                 self.baseline_nonzero += weight.numel() * density
 
-            for name in self.masks.copy():
+            for name in list(self.masks):
                 if 'fc.weight' in name:
                     total_params = total_params - self.masks[name].numel()
                     density = (self.baseline_nonzero - self.masks[name].numel() * self.fc_density) / total_params
                     self.masks.pop(name)
 
-            is_epsilon_valid = False
-            dense_layers = set()
-            while not is_epsilon_valid:
-
-                divisor = 0
-                rhs = 0
-                raw_probabilities = {}
-                for name, mask in self.masks.items():
-                    n_param = np.prod(mask.shape)
-                    n_zeros = n_param * (1 - density)
-                    n_ones = n_param * density
-
-                    if name in dense_layers:
-                        # See `- default_sparsity * (N_3 + N_4)` part of the equation above.
-                        rhs -= n_zeros
-
-                    else:
-                        # Corresponds to `(1 - default_sparsity) * (N_1 + N_2)` part of the
-                        # equation above.
-                        rhs += n_ones
-                        # Erdos-Renyi probability: epsilon * (n_in + n_out / n_in * n_out).
-                        if len(mask.shape) !=2 :
-                            raw_probabilities[name] = (
-                                                          np.sum(mask.shape) / np.prod(mask.shape)
-                                                  ) ** erk_power_scale
-                        else:
-                            raw_probabilities[name] = (
-                                                              np.sum(mask.shape) / np.prod(mask.shape)
-                                                      ) ** erk_power_scale
-                        # Note that raw_probabilities[mask] * n_param gives the individual
-                        # elements of the divisor.
-                        divisor += raw_probabilities[name] * n_param
-                # By multipliying individual probabilites with epsilon, we should get the
-                # number of parameters per layer correctly.
-                epsilon = rhs / divisor
-                # If epsilon * raw_probabilities[mask.name] > 1. We set the sparsities of that
-                # mask to 0., so they become part of dense_layers sets.
-                max_prob = np.max(list(raw_probabilities.values()))
-                max_prob_one = max_prob * epsilon
-                if max_prob_one > 1:
-                    is_epsilon_valid = False
-                    for mask_name, mask_raw_prob in raw_probabilities.items():
-                        if mask_raw_prob == max_prob:
-                            print(f"Sparsity of var:{mask_name} had to be set to 0.")
-                            dense_layers.add(mask_name)
-                else:
-                    is_epsilon_valid = True
+            shapes = [(name, self.masks.shape(name)) for name in self.masks]
+            density_dict = layerwise_density(shapes, density, 'ERK', erk_power_scale)
 
-            density_dict = {}
             total_nonzero = 0.0
-            # With the valid epsilon, we can set sparsities of the remaning layers.
-            for name, mask in self.masks.items():
-                n_param = np.prod(mask.shape)
-                if name in dense_layers:
-                    density_dict[name] = 1.0
-                else:
-                    probability_one = epsilon * raw_probabilities[name]
-                    density_dict[name] = probability_one
-                print(
-                    f"layer: {name}, shape: {mask.shape}, density: {density_dict[name]}"
-                )
-                self.masks[name][:] = (torch.rand(mask.shape) < density_dict[name]).float().data.cuda()
-
-                total_nonzero += density_dict[name] * mask.numel()
+            for name, shape in shapes:
+                if density_dict[name] == 1.0:
+                    print(f"Sparsity of var:{name} had to be set to 0.")
+                print(f"layer: {name}, shape: {shape}, density: {density_dict[name]}")
+                self.masks[name] = self.random_mask(name, shape, density_dict[name])
+                total_nonzero += num_ones(shape.numel(), density_dict[name])
 
             for name, weight in self.module.named_parameters():
                 if 'fc.weight' in name:
-                    self.masks[name] = (torch.rand(weight.shape) < self.fc_density).float().data.cuda()
-                    total_nonzero += self.fc_density * weight.numel()
+                    self.masks[name] = self.random_mask(name, weight.shape, self.fc_density)
+                    total_nonzero += num_ones(weight.numel(), self.fc_density)
                     total_params += weight.numel()
                     print(
                         f"layer: {name}, shape: {self.masks[name].shape}, density: {self.fc_density}"
                     )
 
+            self.baseline_nonzero = total_nonzero
             print(f"Overall sparsity {total_nonzero / total_params}")
             self.apply_mask()
 
@@ -294,76 +269,27 @@ class Masking(object):
             for name, weight in self.masks.items():
                 total_params += weight.numel()
                 self.baseline_nonzero += weight.numel() * density
-            is_epsilon_valid = False
-
-            dense_layers = set()
-            while not is_epsilon_valid:
-
-                divisor = 0
-                rhs = 0
-                raw_probabilities = {}
-                for name, mask in self.masks.items():
-                    n_param = np.prod(mask.shape)
-                    n_zeros = n_param * (1 - density)
-                    n_ones = n_param * density
-
-                    if name in dense_layers:
-                        # See `- default_sparsity * (N_3 + N_4)` part of the equation above.
-                        rhs -= n_zeros
-
-                    else:
-                        rhs += n_ones  ###### very important, don't forget this
-                        raw_probabilities[name] = (
-                                                          np.sum(mask.shape) / np.prod(mask.shape)
-                                                  ) ** erk_power_scale
-                        # Note that raw_probabilities[mask] * n_param gives the individual
-                        # elements of the divisor.
-                        divisor += raw_probabilities[name] * n_param
-                # By multipliying individual probabilites with epsilon, we should get the
-                # number of parameters per layer correctly.
-                epsilon = rhs / divisor
-                # If epsilon * raw_probabilities[mask.name] > 1. We set the sparsities of that
-                # mask to 0., so they become part of dense_layers sets.
-                max_prob = np.max(list(raw_probabilities.values()))
-                max_prob_one = max_prob * epsilon
-                if max_prob_one > 1:
-                    is_epsilon_valid = False
-                    for mask_name, mask_raw_prob in raw_probabilities.items():
-                        if mask_raw_prob == max_prob:
-                            print(f"Sparsity of var:{mask_name} had to be set to 0.")
-                            dense_layers.add(mask_name)
-                else:
-                    is_epsilon_valid = True
+            shapes = [(name, self.masks.shape(name)) for name in self.masks]
+            density_dict = layerwise_density(shapes, density, 'ERK', erk_power_scale)
 
-            density_dict = {}
             total_nonzero = 0.0
-            # With the valid epsilon, we can set sparsities of the remaning layers.
-            for name, mask in self.masks.items():
-                n_param = np.prod(mask.shape)
-                if name in dense_layers:
-                    density_dict[name] = 1.0
-                else:
-                    probability_one = epsilon * raw_probabilities[name]
-                    density_dict[name] = probability_one
-                print(
-                    f"layer: {name}, shape: {mask.shape}, density: {density_dict[name]}"
-                )
-                self.masks[name][:] = (torch.rand(mask.shape) < density_dict[name]).float().data.cuda()
-
-                total_nonzero += density_dict[name] * mask.numel()
+            for name, shape in shapes:
+                if density_dict[name] == 1.0:
+                    print(f"Sparsity of var:{name} had to be set to 0.")
+                print(f"layer: {name}, shape: {shape}, density: {density_dict[name]}")
+                self.masks[name] = self.random_mask(name, shape, density_dict[name])
+                total_nonzero += num_ones(shape.numel(), density_dict[name])
+            self.baseline_nonzero = total_nonzero
             print(f"Overall sparsity {total_nonzero / total_params}")
             self.apply_mask()
-        self.fired_masks = copy.deepcopy(self.masks)
+        self.exploration.update(self.masks) # used for ITOP
         self.print_nonzero_counts()
 
-        total_size = 0
-        for name, weight in self.masks.items():
-            total_size += weight.numel()
+        stats = SparsityStats(self.masks.items())
+        total_size = stats.total_numel()
         print('Total Model parameters:', total_size)
 
-        sparse_size = 0
-        for name, weight in self.masks.items():
-            sparse_size += (weight != 0).sum().int().item()
+        sparse_size = stats.total_nonzeros()
 
         print('Total parameters under sparsity level of {0}: {1}'.format(density, sparse_size / total_size))
 
@@ -415,6 +341,8 @@ class Masking(object):
         self.prune_rate = self.prune_rate_decay.get_dr(self.prune_rate)
 
         self.steps += 1
+        if self.mask_sync is not None and self.mask_sync.check(self.steps):
+            self.apply_mask()
 
         if self.prune_every_k_steps is not None:
             if self.steps % self.prune_every_k_steps == 0:
@@ -424,7 +352,7 @@ class Masking(object):
 
     def get_jacobian(self, func, inputs, create_graph=False, strict=False):
 
-        for i, (input, target) in enumerate(prefetched_loader(inputs, fp16=False)):
+        for i, (input, target) in enumerate(prefetched_loader(inputs, fp16=False, device=self.device)):
             if i == 0:
                 input_var = Variable(input)
                 target_var = Variable(target)
@@ -449,10 +377,8 @@ class Masking(object):
         # use dictionary to apply masks.
         print('approximate_isometry starts...')
         approxed_paras = {}
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                approxed_paras[name] = weight
+        for name, weight in self.layers.named_parameters():
+            approxed_paras[name] = weight
         # optimizer = optim.SGD(approxed_paras.values(), momentum=0.9, lr=0.1)
         optimizer = optim.Adam(approxed_paras.values())
 
@@ -469,7 +395,7 @@ class Masking(object):
             for name in approxed_paras:
                 # approxed_paras[name].data = approxed_paras[name].data * self.masks[name]
                 para = approxed_paras[name]
-                layer_loss[name] = torch.norm(torch.matmul(torch.transpose(para.view(-1, para.size()[1]),0,1), para.view(-1, para.size()[1])) - torch.eye(para.size()[1]).cuda())
+                layer_loss[name] = torch.norm(torch.matmul(torch.transpose(para.view(-1, para.size()[1]),0,1), para.view(-1, para.size()[1])) - torch.eye(para.size()[1], device=para.device))
             loss = sum(layer_loss.values())
             # loss.to(self.device)
             optimizer.zero_grad()
@@ -482,9 +408,13 @@ class Masking(object):
     def add_module(self, module, density, sparse_init='ER'):
         self.module = module
         self.modules.append(module)
+        # masks and everything derived from them live on the device of the model
+        self.device = next(module.parameters()).device
+        self.masks.device = self.device
+        self.layers.add_module(module)
         for name, tensor in module.named_parameters():
             self.names.append(name)
-            self.masks[name] = torch.zeros_like(tensor, dtype=torch.float32, requires_grad=False).cuda()
+            self.masks[name] = torch.zeros_like(tensor, dtype=torch.float32, requires_grad=False).to(self.device)
         print('Removing biases...')
         self.remove_weight_partial_name('bias')
         print('Removing 2D batch norms...')
@@ -534,78 +464,122 @@ class Masking(object):
                     self.remove_weight(name)
                     #self.remove_weight_partial_name(name, verbose=self.verbose)
 
+    def masked_parameters(self):
+        """Returns ([param], [mask]) for all masked parameters.
+
+        The lists are rebuilt only when the masks change (MaskStore.version),
+        so apply_mask does not walk named_parameters() on every step. Masks are
+        cast to the dtype of their parameter once per topology.
+        """
+        if self._masked_version != self.masks.version:
+            self._masked_params = []
+            self._masked_names = []
+            for name, tensor in self.layers.named_parameters():
+                self._masked_params.append(tensor)
+                self._masked_names.append(name)
+            self._masked_masks = None
+            if not self.masks.packed:
+                self._masked_masks = [self.masks[name].to(tensor.dtype) for name, tensor in zip(self._masked_names, self._masked_params)]
+            self._masked_version = self.masks.version
+        if self._masked_masks is None:
+            # packed masks are unpacked on every call to keep the memory saving
+            return self._masked_params, [self.masks[name].to(tensor.dtype) for name, tensor in zip(self._masked_names, self._masked_params)]
+        return self._masked_params, self._masked_masks
+
     def apply_mask(self):
-        # synchronism masks
-        self.synchronism_masks()
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name in self.masks:
-                    if not self.half:
-                        tensor.data = tensor.data*self.masks[name]
-                    else:
-                        tensor.data = tensor.data*self.masks[name].half()
-                        if name in self.name_to_32bit:
-                            tensor2 = self.name_to_32bit[name]
-                            tensor2.data = tensor2.data*self.masks[name]
+        # synchronism masks, only when the topology changed since the last sync.
+        # Every rank runs the same init and truncate_weights calls, so the versions agree across ranks.
+        if torch.distributed.is_initialized(): self.synchronism_masks(force=False)
+        params, masks = self.masked_parameters()
+        masked_mul_(params, masks)
+        if self.half:
+            masters, master_masks = [], []
+            for name in self._masked_names:
+                if name in self.name_to_32bit:
+                    masters.append(self.name_to_32bit[name])
+                    master_masks.append(self.masks[name])
+            masked_mul_(masters, master_masks)
 
     def adjust_prune_rate(self):
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                if name not in self.name2prune_rate: self.name2prune_rate[name] = self.prune_rate
-
-                self.name2prune_rate[name] = self.prune_rate
-
-                sparsity = self.name2zeros[name]/float(self.masks[name].numel())
-                if sparsity < 0.2:
-                    # determine if matrix is relativly dense but still growing
-                    expected_variance = 1.0/len(list(self.name2variance.keys()))
-                    actual_variance = self.name2variance[name]
-                    expected_vs_actual = expected_variance/actual_variance
-                    if expected_vs_actual < 1.0:
-                        # growing
-                        self.name2prune_rate[name] = min(sparsity, self.name2prune_rate[name])
+        for name, weight in self.layers.named_parameters():
+            if name not in self.name2prune_rate: self.name2prune_rate[name] = self.prune_rate
+
+            self.name2prune_rate[name] = self.prune_rate
+
+            sparsity = self.name2zeros[name]/float(self.masks[name].numel())
+            if sparsity < 0.2:
+                # determine if matrix is relativly dense but still growing
+                expected_variance = 1.0/len(list(self.name2variance.keys()))
+                actual_variance = self.name2variance[name]
+                expected_vs_actual = expected_variance/actual_variance
+                if expected_vs_actual < 1.0:
+                    # growing
+                    self.name2prune_rate[name] = min(sparsity, self.name2prune_rate[name])
 
     def truncate_weights(self):
+        delta = self.delta_sync()
+        if delta is not None and not delta.is_src():
+            # rank 0 computes the update, the other ranks apply the indices it changed and keep
+            # the statistics of rank 0: nonzeros from the same masks, the rest sent with the delta
+            self.gather_nonzeros()
+            names = list(self.masks)
+            values = delta.receive(self.masks, extra=len(names) + 2)
+            self.name2removed = {} if self.global_prune else dict(zip(names, values[:len(names)]))
+            self.total_removed = values[-2]
+            self.topology_changed(synced=True)
+            self.adjust_growth(values[-1])
+            return
+        snapshot = delta.snapshot(self.masks) if delta is not None else None
+
         self.gather_statistics()
         self.adjust_prune_rate()
 
         total_nonzero_new = 0
+        grown = None
         if self.global_prune:
             self.total_removed = self.prune_func(self)
         else:
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    mask = self.masks[name]
-
-                    # prune
-                    new_mask = self.prune_func(self, mask, weight, name)
-                    removed = self.name2nonzeros[name] - new_mask.sum().item()
-                    self.total_removed += removed
-                    self.name2removed[name] = removed
-                    self.masks[name][:] = new_mask
+            for name, weight in self.layers.named_parameters():
+                mask = self.masks[name]
+
+                # prune
+                new_mask = self.prune_func(self, mask, weight, name)
+                self.masks[name] = new_mask
+            self.name2removed = dict(self.mask_stats().removed(self.stats))
+            self.total_removed += sum(self.name2removed.values())
 
         name2regrowth = self.calc_growth_redistribution()
         if self.global_growth:
             total_nonzero_new = self.growth_func(self, self.total_removed + self.adjusted_growth)
+        elif self.growth_func in batched_growth_scores:
+            # all layers in one grow() call without host syncs, then one for the new nonzero count
+            names = [name for name, weight in self.layers.named_parameters()]
+            scores = [batched_growth_scores[self.growth_func](self, weight) for name, weight in self.layers.named_parameters()]
+            quotas = [math.floor(self.name2removed[name]) for name in names]
+            new_masks, grown = grow([self.masks[name] for name in names], scores, quotas, return_grown=True)
+            for name, new_mask in zip(names, new_masks):
+                self.masks[name] = new_mask
+            total_nonzero_new = int(sum(new_mask.sum() for new_mask in new_masks))
+            grown = dict(zip(names, grown))
         else:
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    new_mask = self.masks[name].data.byte()
-
-                    # growth
-                    new_mask = self.growth_func(self, name, new_mask, math.floor(self.name2removed[name]), weight)
-
-                    new_nonzero = new_mask.sum().item()
-
-                    # exchanging masks
-                    self.masks.pop(name)
-                    self.masks[name] = new_mask.float()
-                    total_nonzero_new += new_nonzero
-        self.apply_mask()
-
+            for name, weight in self.layers.named_parameters():
+                new_mask = self.masks[name].data.byte()
+
+                # growth
+                new_mask = self.growth_func(self, name, new_mask, math.floor(self.name2removed[name]), weight)
+
+                # exchanging masks
+                self.masks[name] = new_mask
+            total_nonzero_new = self.mask_stats().total_nonzeros()
+        if delta is not None:
+            stats = [self.name2removed.get(name, 0) for name in self.masks] + [self.total_removed, total_nonzero_new]
+            delta.send(self.masks, snapshot, extra=stats)
+        # without a delta sync, apply_mask replaces the masks of the other ranks by those of rank 0
+        if delta is None and torch.distributed.is_initialized(): grown = None
+        self.topology_changed(synced=delta is not None, grown=grown)
+        self.adjust_growth(total_nonzero_new)
+
+    def adjust_growth(self, total_nonzero_new):
         # Some growth techniques and redistribution are probablistic and we might not grow enough weights or too much weights
         # Here we run an exponential smoothing over (prune-growth) residuals to adjust future growth
         self.adjustments.append(self.baseline_nonzero - total_nonzero_new)
@@ -614,32 +588,29 @@ class Masking(object):
             print('Nonzero before/after: {0}/{1}. Growth adjustment: {2:.2f}.'.format(
                   self.total_nonzero, total_nonzero_new, self.adjusted_growth))
 
+    def gather_nonzeros(self):
+        # all nonzero counts in one reduction, one host sync
+        self.stats = self.mask_stats()
+        self.name2nonzeros = dict(self.stats.nonzeros())
+        self.name2zeros = dict(self.stats.zeros())
+        self.total_nonzero = self.stats.total_nonzeros()
+        self.total_zero = float(sum(self.name2zeros.values()))
+
     def gather_statistics(self):
-        self.name2nonzeros = {}
-        self.name2zeros = {}
         self.name2variance = {}
         self.name2removed = {}
 
         self.total_variance = 0.0
         self.total_removed = 0
-        self.total_nonzero = 0
-        self.total_zero = 0.0
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
-
-                # redistribution
-                self.name2variance[name] = self.redistribution_func(self, name, weight, mask)
+        self.gather_nonzeros()
+        for name, weight in self.layers.named_parameters():
+            mask = self.masks[name]
 
-                if not np.isnan(self.name2variance[name]):
-                    self.total_variance += self.name2variance[name]
-                self.name2nonzeros[name] = mask.sum().item()
-                self.name2zeros[name] = mask.numel() - self.name2nonzeros[name]
+            # redistribution
+            self.name2variance[name] = self.redistribution_func(self, name, weight, mask)
 
-                sparsity = self.name2zeros[name]/float(self.masks[name].numel())
-                self.total_nonzero += self.name2nonzeros[name]
-                self.total_zero += self.name2zeros[name]
+            if not np.isnan(self.name2variance[name]):
+                self.total_variance += self.name2variance[name]
 
         for name in self.name2variance:
             if self.total_variance != 0.0:
@@ -652,53 +623,28 @@ class Masking(object):
                 print(self.name2variance)
 
     def calc_growth_redistribution(self):
-        num_overgrowth = 0
-        total_overgrowth = 0
-        residual = 0
-
-        residual = 9999
-        mean_residual = 0
-        name2regrowth = {}
-        i = 0
-        expected_var = 1.0/len(self.name2variance)
-        while residual > 0 and i < 1000:
-            residual = 0
-            for name in self.name2variance:
-                prune_rate = self.name2prune_rate[name]
-                num_remove = math.ceil(prune_rate*self.name2nonzeros[name])
-                num_nonzero = self.name2nonzeros[name]
-                num_zero = self.name2zeros[name]
-                max_regrowth = num_zero + num_remove
-
-                if name in name2regrowth:
-                    regrowth = name2regrowth[name]
-                else:
-                    regrowth = math.ceil(self.name2variance[name]*(self.total_removed+self.adjusted_growth))
-                regrowth += mean_residual
-
-                if regrowth > 0.99*max_regrowth:
-                    name2regrowth[name] = 0.99*max_regrowth
-                    residual += regrowth - name2regrowth[name]
-                else:
-                    name2regrowth[name] = regrowth
-            if len(name2regrowth) == 0: mean_residual = 0
-            else:
-                mean_residual = residual / len(name2regrowth)
-            i += 1
-
-        if i == 1000:
+        # regrowth proportional to the redistribution statistics, capped at 0.99 of the free
+        # slots of a layer; what does not fit is spread evenly over the other layers
+        names = list(self.name2variance)
+        demand, capacity = [], []
+        for name in names:
+            num_remove = math.ceil(self.name2prune_rate[name]*self.name2nonzeros[name])
+            capacity.append(0.99*(self.name2zeros[name] + num_remove))
+            demand.append(math.ceil(self.name2variance[name]*(self.total_removed+self.adjusted_growth)))
+        regrowth, residual = water_fill(demand, capacity)
+        name2regrowth = dict(zip(names, regrowth))
+
+        if residual > 0:
             print('Error resolving the residual! Layers are too full! Residual left over: {0}'.format(residual))
 
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                if self.prune_mode == 'global_magnitude':
-                    expected_removed = self.baseline_nonzero*self.name2prune_rate[name]
-                    if expected_removed == 0.0:
-                        name2regrowth[name] = 0.0
-                    else:
-                        expected_vs_actual = self.total_removed/expected_removed
-                        name2regrowth[name] = math.floor(expected_vs_actual*name2regrowth[name])
+        for name, weight in self.layers.named_parameters():
+            if self.prune_mode == 'global_magnitude':
+                expected_removed = self.baseline_nonzero*self.name2prune_rate[name]
+                if expected_removed == 0.0:
+                    name2regrowth[name] = 0.0
+                else:
+                    expected_vs_actual = self.total_removed/expected_removed
+                    name2regrowth[name] = math.floor(expected_vs_actual*name2regrowth[name])
 
         return name2regrowth
 
@@ -720,38 +666,60 @@ class Masking(object):
         grad = weight.grad.clone()
         return grad
 
+    def mask_stats(self):
+        """Nonzero counts of all masks, see stats.SparsityStats."""
+        return SparsityStats((name, self.masks[name]) for name, weight in self.layers.named_parameters())
+
     def print_nonzero_counts(self):
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
-                num_nonzeros = (mask != 0).sum().item()
-                if name in self.name2variance:
-                    val = '{0}: {1}->{2}, density: {3:.3f}, proportion: {4:.4f}'.format(name, self.name2nonzeros[name], num_nonzeros, num_nonzeros/float(mask.numel()), self.name2variance[name])
-                    print(val)
-                else:
-                    print(name, num_nonzeros)
+        stats = self.mask_stats()
+        for name, num_nonzeros, density in zip(stats.names, stats.counts(), stats.density().values()):
+            if name in self.name2variance:
+                val = '{0}: {1}->{2}, density: {3:.3f}, proportion: {4:.4f}'.format(name, self.name2nonzeros[name], num_nonzeros, density, self.name2variance[name])
+                print(val)
+            else:
+                print(name, num_nonzeros)
 
         print('Prune rate: {0}\n'.format(self.prune_rate))
 
     def fired_masks_update(self):
-        ntotal_fired_weights = 0.0
-        ntotal_weights = 0.0
-        layer_fired_weights = {}
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                self.fired_masks[name] = self.masks[name].data.byte() | self.fired_masks[name].data.byte()
-                ntotal_fired_weights += float(self.fired_masks[name].sum().item())
-                ntotal_weights += float(self.fired_masks[name].numel())
-                layer_fired_weights[name] = float(self.fired_masks[name].sum().item())/float(self.fired_masks[name].numel())
-                print('Layerwise percentage of the fired weights of', name, 'is:', layer_fired_weights[name])
-        total_fired_weights = ntotal_fired_weights/ntotal_weights
+        self.exploration.update(self.masks)
+        layer_fired_weights, total_fired_weights = self.exploration.rates()
+        layer_fired_weights = dict(layer_fired_weights)
+        for name in layer_fired_weights:
+            print('Layerwise percentage of the fired weights of', name, 'is:', layer_fired_weights[name])
         print('The percentage of the total fired weights is:', total_fired_weights)
         return layer_fired_weights, total_fired_weights
     
-    def synchronism_masks(self):
-
-        for name in self.masks.keys():
-            torch.distributed.broadcast(self.masks[name], src=0, async_op=False)
+    def topology_changed(self, synced=False, grown=None):
+        """Bumps the topology version and applies the new masks (synced: all ranks have them already).
+
+        grown maps layer names to the indices growth.grow grew; the exploration
+        tracker then only looks at those weights instead of the whole masks.
+        """
+        self.topology_version += 1
+        if synced and self.mask_sync is not None:
+            self.mask_sync.synced_version = self.topology_version
+        if getattr(self.args, 'sparse_allreduce', False) and torch.distributed.is_initialized():
+            # regrown weights are still 0 here: drop the rank-local momentum they gathered while inactive
+            reset_inactive_momentum(self.optimizer, [self.name_to_32bit.get(name, weight) for name, weight in self.layers.named_parameters()])
+        self.apply_mask()
+        if grown is None:
+            self.exploration.update(self.masks)
+        else:
+            for name in grown:
+                self.exploration.update_grown(name, grown[name])
+
+    def delta_sync(self):
+        """MaskDelta of distributed runs with --mask-delta-sync, else None."""
+        if not getattr(self.args, 'mask_delta_sync', False) or not torch.distributed.is_initialized():
+            return None
+        if torch.distributed.get_world_size() == 1: return None
+        if self.mask_delta is None: self.mask_delta = MaskDelta()
+        return self.mask_delta
+
+    def synchronism_masks(self, force=True):
+        # all masks of rank 0 in one packed broadcast
+        if self.mask_sync is None:
+            self.mask_sync = MaskSync(self.masks, check_every=getattr(self.args, 'mask_check_every', None))
+        self.mask_sync.sync(self.topology_version, force=force)
 
@@ -4,7 +4,15 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import copy
-
+from mask_store import MaskStore, masked_mul_
+from registry import SparseLayerRegistry
+from selection import kth_largest, top_k_masks
+from density import layerwise_density
+from sampler import sample_mask, layer_generator, num_ones
+from growth import grow, neuron_growth, water_fill
+from stats import SparsityStats
+from exploration import ExplorationTracker
+from async_update import AsyncTopologyUpdate, StepTimer
 import numpy as np
 import math
 
@@ -20,6 +28,9 @@ def add_sparse_args(parser):
     parser.add_argument('--fix', action='store_true', help='Fix topology during training. Default: True.')
     parser.add_argument('--pop', action='store_true', help='Fix topology during training. Default: True.')
     parser.add_argument('--sparse_init', type=str, default='ER', help='sparse initialization')
+    parser.add_argument('--packed-masks', action='store_true', help='Keep masks as packed bits (1 bit per weight) instead of float tensors. Saves memory, costs an unpack per mask access.')
+    parser.add_argument('--mask-seed', type=int, default=None, help='Seed the random masks per layer (by layer name), so the initial topology does not depend on the global RNG state.')
+    parser.add_argument('--async-update', type=int, default=0, metavar='K', help='With --method DST: compute each topology update in a background thread and swap the new masks in K steps later. 0 (default) updates synchronously.')
     parser.add_argument('--mix', type=float, default=0.0)
     # DST hyperparameters
     parser.add_argument('--method', type=str, default='DST', help='method name: DST, MPDS, GMP, NTK_path')
@@ -68,7 +79,7 @@ class Masking(object):
 
         self.args = args
         self.loader = train_loader
-        self.device = torch.device("cuda")
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.growth_mode = growth_mode
         self.death_mode = death_mode
         self.growth_death_ratio = growth_death_ratio
@@ -87,12 +98,16 @@ class Masking(object):
         self.growth_funcs['momentum'] = self.momentum_growth
         self.growth_funcs['momentum_neuron'] = self.momentum_neuron_growth
 
-        self.masks = {}
+        self.masks = MaskStore(self.device, packed=getattr(args, 'packed_masks', False))
+        self.mask_seed = getattr(args, 'mask_seed', None)
+        self.layers = SparseLayerRegistry(self.masks, optimizer)
+        self._masked_version = -1
         self.final_masks = {}
         self.grads = {}
         self.nonzero_masks = {}
         self.scores = {}
         self.pruning_rate = {}
+        self.stats = None
         self.modules = []
         self.names = []
         self.optimizer = optimizer
@@ -106,6 +121,8 @@ class Masking(object):
         self.name2variance = {}
         self.name2zeros = {}
         self.name2nonzeros = {}
+        # weights that have been active at some point (ITOP)
+        self.exploration = ExplorationTracker()
         self.total_variance = 0
         self.total_removed = 0
         self.total_zero = 0
@@ -114,6 +131,11 @@ class Masking(object):
         self.name2death_rate = {}
         self.steps = 0
 
+        # DST updates computed in the background and swapped in async_update steps later (0: synchronous)
+        self.async_update = getattr(args, 'async_update', 0)
+        self.topology_update = AsyncTopologyUpdate(self, self.async_update) if self.async_update > 0 else None
+        self.step_timer = StepTimer()
+
         # global growth/death state
         self.threshold = threshold
         self.growth_threshold = threshold
@@ -126,149 +148,128 @@ class Masking(object):
         #     self.prune_every_k_steps = self.args.update_frequency
 
 
+    def random_mask(self, name, shape, density):
+        """Random mask of a layer with exactly num_ones(numel, density) active weights, built on self.device."""
+        generator = None
+        if self.mask_seed is not None:
+            generator = layer_generator(self.mask_seed, name, self.device)
+        return sample_mask(shape, density, self.device, generator)
+
     def init(self, mode='ER', density=0.05, erk_power_scale=1.0, grad_dict=None, customer_density=None):
         self.density = density
         if self.sparse_init == 'customer':
             # print('initialized by customer')
             self.baseline_nonzero = 0
             for index, name in enumerate(self.masks):
-                self.masks[name][:] = (torch.rand(self.masks[name].shape) < (customer_density[index])).float()
-                self.baseline_nonzero += self.masks[name].numel() * (customer_density[index])
+                self.masks[name] = self.random_mask(name, self.masks.shape(name), customer_density[index])
+                self.baseline_nonzero += num_ones(self.masks.numel(name), customer_density[index])
             self.apply_mask()
         if self.sparse_init == 'prune':
             # used for pruning stabability test
             print('initialized by pruning')
 
             self.baseline_nonzero = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = (weight!=0).cuda()
-                    num_zeros = (weight==0).sum().item()
-                    num_remove = (self.args.pruning_rate) * self.masks[name].sum().item()
-                    k = math.ceil(num_zeros + num_remove)
-                    if num_remove == 0.0: return weight.data != 0.0
-                    x, idx = torch.sort(torch.abs(weight.data.view(-1)))
-                    self.masks[name].data.view(-1)[idx[:k]] = 0.0
-                    self.baseline_nonzero += (self.masks[name] != 0).sum().int().item()
+            for name, weight in self.layers.named_parameters():
+                mask = (weight!=0).float()
+                num_zeros = (weight==0).sum().item()
+                num_remove = (self.args.pruning_rate) * mask.sum().item()
+                k = math.ceil(num_zeros + num_remove)
+                if num_remove == 0.0: return weight.data != 0.0
+                x, idx = torch.sort(torch.abs(weight.data.view(-1)))
+                mask.data.view(-1)[idx[:k]] = 0.0
+                self.masks[name] = mask
+                self.baseline_nonzero += (mask != 0).sum().int().item()
             self.apply_mask()
         if self.sparse_init == 'prune_global':
             # used for pruning stabability test
             print('initialized by prune_global')
             self.baseline_nonzero = 0
             total_num_nonzoros = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = (weight!=0).cuda()
-                    self.name2nonzeros[name] = (weight!=0).sum().item()
-                    total_num_nonzoros += self.name2nonzeros[name]
-
-            weight_abs = []
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    weight_abs.append(torch.abs(weight))
-
-            # Gather all scores in a single vector and normalise
-            all_scores = torch.cat([torch.flatten(x) for x in weight_abs])
-            num_params_to_keep = int(total_num_nonzoros * (1 - self.args.pruning_rate))
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = (weight!=0).to(self.device)
+                self.name2nonzeros[name] = (weight!=0).sum().item()
+                total_num_nonzoros += self.name2nonzeros[name]
 
-            threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-            acceptable_score = threshold[-1]
+            # exact global threshold, streamed layer by layer instead of concatenating all scores
+            weight_abs = lambda: (torch.abs(weight) for name, weight in self.layers.named_parameters())
+            num_params_to_keep = int(total_num_nonzoros * (1 - self.args.pruning_rate))
+            acceptable_score = kth_largest(weight_abs, num_params_to_keep)
 
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = ((torch.abs(weight)) >= acceptable_score).float()
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = ((torch.abs(weight)) >= acceptable_score).float()
             self.apply_mask()
         if self.sparse_init == 'prune_and_grow':
             # used for pruning stabability test
             print('initialized by pruning and growing')
 
             self.baseline_nonzero = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    # prune
-                    self.masks[name] = (weight!=0).cuda()
-                    num_zeros = (weight==0).sum().item()
-                    num_remove = (self.args.pruning_rate) * self.masks[name].sum().item()
-                    k = math.ceil(num_zeros + num_remove)
-                    if num_remove == 0.0: return weight.data != 0.0
-                    x, idx = torch.sort(torch.abs(weight.data.view(-1)))
-                    self.masks[name].data.view(-1)[idx[:k]] = 0.0
-                    total_regrowth = (self.masks[name]==0).sum().item() - num_zeros
-
-                    # set the pruned weights to zero
-                    weight.data = weight.data * self.masks[name]
-                    if 'momentum_buffer' in self.optimizer.state[weight]:
-                        self.optimizer.state[weight]['momentum_buffer'] = self.optimizer.state[weight]['momentum_buffer'] * self.masks[name]
-
-                    # grow
-                    grad = grad_dict[name]
-                    grad = grad * (self.masks[name] == 0).float()
-
-                    y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
-                    self.masks[name].data.view(-1)[idx[:total_regrowth]] = 1.0
-                    self.baseline_nonzero += (self.masks[name] != 0).sum().int().item()
+            for name, weight in self.layers.named_parameters():
+                # prune
+                mask = (weight!=0).float()
+                num_zeros = (weight==0).sum().item()
+                num_remove = (self.args.pruning_rate) * mask.sum().item()
+                k = math.ceil(num_zeros + num_remove)
+                if num_remove == 0.0: return weight.data != 0.0
+                x, idx = torch.sort(torch.abs(weight.data.view(-1)))
+                mask.data.view(-1)[idx[:k]] = 0.0
+                total_regrowth = (mask==0).sum().item() - num_zeros
+
+                # set the pruned weights to zero
+                weight.data = weight.data * mask
+                if 'momentum_buffer' in self.optimizer.state[weight]:
+                    self.optimizer.state[weight]['momentum_buffer'] = self.optimizer.state[weight]['momentum_buffer'] * mask
+
+                # grow
+                grad = grad_dict[name]
+                grad = grad * (mask == 0).float()
+
+                y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
+                mask.data.view(-1)[idx[:total_regrowth]] = 1.0
+                self.masks[name] = mask
+                self.baseline_nonzero += (mask != 0).sum().int().item()
             self.apply_mask()
         if self.sparse_init == 'prune_and_grow_global':
             # used for pruning stabability test
             print('initialized by prune_and_grow_global')
             self.baseline_nonzero = 0
             total_num_nonzoros = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = (weight!=0).cuda()
-                    self.name2nonzeros[name] = (weight!=0).sum().item()
-                    total_num_nonzoros += self.name2nonzeros[name]
-
-            weight_abs = []
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    weight_abs.append(torch.abs(weight))
-
-            # Gather all scores in a single vector and normalise
-            all_scores = torch.cat([torch.flatten(x) for x in weight_abs])
-            num_params_to_keep = int(total_num_nonzoros * (1 - self.args.pruning_rate))
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = (weight!=0).to(self.device)
+                self.name2nonzeros[name] = (weight!=0).sum().item()
+                total_num_nonzoros += self.name2nonzeros[name]
 
-            threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-            acceptable_score = threshold[-1]
+            # exact global threshold, streamed layer by layer instead of concatenating all scores
+            weight_abs = lambda: (torch.abs(weight) for name, weight in self.layers.named_parameters())
+            num_params_to_keep = int(total_num_nonzoros * (1 - self.args.pruning_rate))
+            acceptable_score = kth_largest(weight_abs, num_params_to_keep)
 
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = ((torch.abs(weight)) >= acceptable_score).float()
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = ((torch.abs(weight)) >= acceptable_score).float()
 
-                    # set the pruned weights to zero
-                    weight.data = weight.data * self.masks[name]
-                    if 'momentum_buffer' in self.optimizer.state[weight]:
-                        self.optimizer.state[weight]['momentum_buffer'] = self.optimizer.state[weight]['momentum_buffer'] * self.masks[name]
+                # set the pruned weights to zero
+                weight.data = weight.data * self.masks[name]
+                if 'momentum_buffer' in self.optimizer.state[weight]:
+                    self.optimizer.state[weight]['momentum_buffer'] = self.optimizer.state[weight]['momentum_buffer'] * self.masks[name]
 
             ### grow
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    total_regrowth = self.name2nonzeros[name] - (self.masks[name]!=0).sum().item()
-                    grad = grad_dict[name]
-                    grad = grad * (self.masks[name] == 0).float()
-
-                    y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
-                    self.masks[name].data.view(-1)[idx[:total_regrowth]] = 1.0
-                    self.baseline_nonzero += (self.masks[name] != 0).sum().int().item()
+            for name, weight in self.layers.named_parameters():
+                mask = self.masks[name]
+                total_regrowth = self.name2nonzeros[name] - (mask!=0).sum().item()
+                grad = grad_dict[name]
+                grad = grad * (mask == 0).float()
+
+                y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
+                mask.data.view(-1)[idx[:total_regrowth]] = 1.0
+                self.masks[name] = mask
+                self.baseline_nonzero += (mask != 0).sum().int().item()
             self.apply_mask()
 
         if self.sparse_init == 'GMP':
             self.baseline_nonzero = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = torch.ones_like(weight, dtype=torch.float32, requires_grad=False).cuda()
-                    # self.masks[name][:] = (torch.rand(weight.shape) < density).float().data #lsw
-                    self.baseline_nonzero += (self.masks[name] != 0).sum().int().item()
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = torch.ones_like(weight, dtype=torch.float32, requires_grad=False).to(self.device)
+                # self.masks[name] = (torch.rand(weight.shape) < density).float().data #lsw
+                self.baseline_nonzero += (self.masks[name] != 0).sum().int().item()
             self.apply_mask()
         elif self.sparse_init == 'resume':
             print('initialized with LTR OR LRR')
@@ -277,99 +278,44 @@ class Masking(object):
             # if you want to resume a sparse model but did not
             # save the mask.
             self.baseline_nonzero = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    print(name, (weight != 0.0).sum().item())
-                    self.masks[name][:] = (weight != 0).float().data.cuda()
-                    self.baseline_nonzero += weight.numel() * density
+            for name, weight in self.layers.named_parameters():
+                print(name, (weight != 0.0).sum().item())
+                self.masks[name] = (weight != 0).float().data.to(self.device)
+                self.baseline_nonzero += weight.numel() * density
             self.apply_mask()
         elif self.sparse_init == 'uniform':
             self.baseline_nonzero = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name][:] = (torch.rand(weight.shape) < density).float().data.cuda() #lsw
-                    # self.masks[name][:] = (torch.rand(weight.shape) < density).float().data #lsw
-                    self.baseline_nonzero += weight.numel()*density
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = self.random_mask(name, weight.shape, density) #lsw
+                # self.masks[name] = (torch.rand(weight.shape) < density).float().data #lsw
+                self.baseline_nonzero += num_ones(weight.numel(), density)
             self.apply_mask()
         elif self.sparse_init == 'NM_sparsity':
             print('initialize by NM_sparsity')
             self.baseline_nonzero = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    length = weight.numel()
-                    group = int(length / self.args.M)
-
-                    index = torch.argsort(torch.rand(*(weight.view(group, self.args.M).shape)), dim=1)[:, :int(self.args.M - self.args.N)].cuda()
-                    self.masks[name] = self.masks[name].view(group, self.args.M).scatter_(dim=1, index=index,
-                                                                                          value=0).reshape(weight.shape)
+            for name, weight in self.layers.named_parameters():
+                length = weight.numel()
+                group = int(length / self.args.M)
+
+                index = torch.argsort(torch.rand(*(weight.view(group, self.args.M).shape)), dim=1)[:, :int(self.args.M - self.args.N)].to(self.device)
+                self.masks[name] = self.masks[name].view(group, self.args.M).scatter_(dim=1, index=index,
+                                                                                      value=0).reshape(weight.shape)
             self.apply_mask()
         elif self.sparse_init == 'fixed_ERK':
             print('initialize by fixed_ERK')
             total_params = 0
             for name, weight in self.masks.items():
                 total_params += weight.numel()
-            is_epsilon_valid = False
-            dense_layers = set()
-            while not is_epsilon_valid:
-
-                divisor = 0
-                rhs = 0
-                raw_probabilities = {}
-                for name, mask in self.masks.items():
-                    n_param = np.prod(mask.shape)
-                    n_zeros = n_param * (1 - density)
-                    n_ones = n_param * density
-
-                    if name in dense_layers:
-                        # See `- default_sparsity * (N_3 + N_4)` part of the equation above.
-                        rhs -= n_zeros
+            shapes = [(name, self.masks.shape(name)) for name in self.masks]
+            density_dict = layerwise_density(shapes, density, 'ERK', erk_power_scale)
 
-                    else:
-                        # Corresponds to `(1 - default_sparsity) * (N_1 + N_2)` part of the
-                        # equation above.
-                        rhs += n_ones
-                        # Erdos-Renyi probability: epsilon * (n_in + n_out / n_in * n_out).
-                        raw_probabilities[name] = (
-                                                          np.sum(mask.shape) / np.prod(mask.shape)
-                                                  ) ** erk_power_scale
-                        # Note that raw_probabilities[mask] * n_param gives the individual
-                        # elements of the divisor.
-                        divisor += raw_probabilities[name] * n_param
-                # By multipliying individual probabilites with epsilon, we should get the
-                # number of parameters per layer correctly.
-                epsilon = rhs / divisor
-                # If epsilon * raw_probabilities[mask.name] > 1. We set the sparsities of that
-                # mask to 0., so they become part of dense_layers sets.
-                max_prob = np.max(list(raw_probabilities.values()))
-                max_prob_one = max_prob * epsilon
-                if max_prob_one > 1:
-                    is_epsilon_valid = False
-                    for mask_name, mask_raw_prob in raw_probabilities.items():
-                        if mask_raw_prob == max_prob:
-                            print(f"Sparsity of var:{mask_name} had to be set to 0.")
-                            dense_layers.add(mask_name)
-                else:
-                    is_epsilon_valid = True
-
-            density_dict = {}
             total_nonzero = 0.0
-            # With the valid epsilon, we can set sparsities of the remaning layers.
-            for name, mask in self.masks.items():
-                n_param = np.prod(mask.shape)
-                if name in dense_layers:
-                    density_dict[name] = 1.0
-                else:
-                    probability_one = epsilon * raw_probabilities[name]
-                    density_dict[name] = probability_one
-                # print(
-                #     f"layer: {name}, shape: {mask.shape}, density: {density_dict[name]}"
-                # )
-                self.masks[name][:] = (torch.rand(mask.shape) < density_dict[name]).float().data
-
-                total_nonzero += density_dict[name] * mask.numel()
+            for name, shape in shapes:
+                if density_dict[name] == 1.0:
+                    print(f"Sparsity of var:{name} had to be set to 0.")
+                # print(f"layer: {name}, shape: {shape}, density: {density_dict[name]}")
+                self.masks[name] = self.random_mask(name, shape, density_dict[name])
+                total_nonzero += num_ones(shape.numel(), density_dict[name])
             print(f"Overall sparsity {total_nonzero / total_params}")
 
         # for name, mask in self.masks.copy().items():
@@ -378,7 +324,7 @@ class Masking(object):
         #         print(f"pop out {name}")
 
         self.apply_mask()
-        self.fired_masks = copy.deepcopy(self.masks) # used for over-paremeters
+        self.exploration.update(self.masks) # used for over-paremeters
         # self.nonzero_masks = copy.deepcopy(self.masks)  # used for over-paremeters
 
         self.init_death_rate(self.death_rate)
@@ -401,6 +347,7 @@ class Masking(object):
             self.name2death_rate[name] = death_rate
 
     def step(self):
+        self.step_timer.tick()
         self.optimizer.step()
         self.apply_mask()
         self.death_rate_decay.step()
@@ -419,6 +366,12 @@ class Masking(object):
                         self.truncate_weights(self.steps)
                         self.print_nonzero_counts()
                     # _, _ = self.fired_masks_update()
+                elif self.args.method == 'DST' and self.topology_update is not None:
+                    if self.topology_update.due(self.steps):
+                        self.topology_update.finish()
+                        self.print_nonzero_counts()
+                    if self.steps % self.prune_every_k_steps == 0:
+                        self.topology_update.start(self.steps)
                 elif self.args.method == 'DST':
                     if self.steps % self.prune_every_k_steps == 0:
                         self.truncate_weights()
@@ -455,27 +408,22 @@ class Masking(object):
             pruning_index = step / update_interval
             current_N = self.args.M - pruning_index
 
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    length = weight.numel()
-                    group = int(length / self.args.M)
-                    weight_temp = weight.abs().view(group, self.args.M)
+            for name, weight in self.layers.named_parameters():
+                length = weight.numel()
+                group = int(length / self.args.M)
+                weight_temp = weight.abs().view(group, self.args.M)
 
-                    index = torch.argsort(weight_temp, dim=1)[:, :int(self.args.M - current_N)]
-                    self.masks[name] = self.masks[name].view(group, self.args.M).scatter_(dim=1, index=index, value=0).reshape(
-                        weight.shape)
+                index = torch.argsort(weight_temp, dim=1)[:, :int(self.args.M - current_N)]
+                self.masks[name] = self.masks[name].view(group, self.args.M).scatter_(dim=1, index=index, value=0).reshape(
+                    weight.shape)
 
             self.apply_mask()
 
-            total_size = 0
-            for name, weight in self.masks.items():
-                total_size += weight.numel()
+            stats = SparsityStats(self.masks.items())
+            total_size = stats.total_numel()
             print('Total Model parameters:', total_size)
 
-            sparse_size = 0
-            for name, weight in self.masks.items():
-                sparse_size += (weight != 0).sum().int().item()
+            sparse_size = stats.total_nonzeros()
 
             print('Total parameters after pruning under sparsity level of {0}: {1}'.format(
                 self.args.ini_density,
@@ -496,23 +444,13 @@ class Masking(object):
             curr_prune_rate = (1 - self.args.ini_density) + (self.args.ini_density - self.args.final_density) * (
                     1 - prune_decay)
             print('current pruning rate is:', curr_prune_rate)
-            weight_abs = []
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    weight_abs.append(torch.abs(weight))
+            # exact global threshold, streamed layer by layer instead of concatenating all scores
+            weight_abs = lambda: (torch.abs(weight) for name, weight in self.layers.named_parameters())
+            num_params_to_keep = int(self.layers.numel() * (1 - curr_prune_rate))
+            acceptable_score = kth_largest(weight_abs, num_params_to_keep)
 
-            # Gather all scores in a single vector and normalise
-            all_scores = torch.cat([torch.flatten(x) for x in weight_abs])
-            num_params_to_keep = int(len(all_scores) * (1 - curr_prune_rate))
-
-            threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-            acceptable_score = threshold[-1]
-
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    self.masks[name] = ((torch.abs(weight)) >= acceptable_score).float()
+            for name, weight in self.layers.named_parameters():
+                self.masks[name] = ((torch.abs(weight)) >= acceptable_score).float()
 
             self.apply_mask()
 
@@ -532,6 +470,10 @@ class Masking(object):
     def add_module(self, module, density, sparse_init='ER', grad_dic=None, customer_density=None):
         self.sparse_init = sparse_init
         self.modules.append(module)
+        # masks and everything derived from them live on the device of the model
+        self.device = next(module.parameters()).device
+        self.masks.device = self.device
+        self.layers.add_module(module)
         for name, tensor in module.named_parameters():
             if len(tensor.size()) == 4 or len(tensor.size()) == 2:
                 self.names.append(name)
@@ -578,13 +520,38 @@ class Masking(object):
                 if isinstance(module, nn_type):
                     self.remove_weight(name)
 
+    def masked_parameters(self):
+        """Returns ([param], [mask]) for all masked parameters.
+
+        The lists are rebuilt only when the masks change (MaskStore.version),
+        so apply_mask does not walk named_parameters() on every step. Masks are
+        cast to the dtype of their parameter once per topology.
+        """
+        if self._masked_version != self.masks.version:
+            self._masked_params = []
+            self._masked_names = []
+            for name, tensor in self.layers.named_parameters():
+                self._masked_params.append(tensor)
+                self._masked_names.append(name)
+            self._masked_masks = None
+            if not self.masks.packed:
+                self._masked_masks = [self.masks[name].to(tensor.dtype) for name, tensor in zip(self._masked_names, self._masked_params)]
+            self._masked_version = self.masks.version
+        if self._masked_masks is None:
+            # packed masks are unpacked on every call to keep the memory saving
+            return self._masked_params, [self.masks[name].to(tensor.dtype) for name, tensor in zip(self._masked_names, self._masked_params)]
+        return self._masked_params, self._masked_masks
+
     def apply_mask(self):
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name in self.masks:
-                    tensor.data = tensor.data*self.masks[name]
-                    if 'momentum_buffer' in self.optimizer.state[tensor]:
-                        self.optimizer.state[tensor]['momentum_buffer'] = self.optimizer.state[tensor]['momentum_buffer']*self.masks[name]
+        params, masks = self.masked_parameters()
+        masked_mul_(params, masks)
+        buffers, buffer_masks = [], []
+        for tensor, mask in zip(params, masks):
+            buffer = self.optimizer.state[tensor].get('momentum_buffer')
+            if buffer is not None:
+                buffers.append(buffer)
+                buffer_masks.append(mask)
+        masked_mul_(buffers, buffer_masks)
 
     def truncate_weights_GMP(self, epoch=None):
         '''
@@ -599,22 +566,22 @@ class Masking(object):
             prune_decay = (1 - ((curr_prune_epoch - self.args.multiplier * self.args.init_prune_epoch) / total_prune_epochs)) ** 3
             curr_prune_rate = prune_rate - (prune_rate * prune_decay)
 
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
+            for name, weight in self.layers.named_parameters():
 
-                    x, idx = torch.sort(torch.abs(weight.data.view(-1)))
-                    p = int(curr_prune_rate * weight.numel())
-                    self.masks[name].data.view(-1)[idx[:p]] = 0.0
+                p = int(curr_prune_rate * weight.numel())
+                mask = self.masks[name]
+                # the inactive weights are zero and already among the p smallest magnitudes
+                active = mask.data.view(-1).nonzero().view(-1)
+                num_remove = min(max(p - (weight.numel() - active.numel()), 0), active.numel())
+                _, idx = torch.topk(torch.abs(weight.data.view(-1))[active], num_remove, largest=False)
+                mask.data.view(-1)[active[idx]] = 0.0
+                self.masks[name] = mask
             self.apply_mask()
-        total_size = 0
-        for name, weight in self.masks.items():
-            total_size += weight.numel()
+        stats = SparsityStats(self.masks.items())
+        total_size = stats.total_numel()
         print('Total Model parameters:', total_size)
 
-        sparse_size = 0
-        for name, weight in self.masks.items():
-            sparse_size += (weight != 0).sum().int().item()
+        sparse_size = stats.total_nonzeros()
 
         print('Total parameters under sparsity level of {0}: {1} after epoch of {2}'.format(self.density, sparse_size / total_size, epoch))
 
@@ -639,33 +606,28 @@ class Masking(object):
         name2regrowth = self.calc_growth_redistribution()
 
         # save current gradients
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                self.grads[name] = weight.grad.clone()
+        for name, weight in self.layers.named_parameters():
+            self.grads[name] = weight.grad.clone()
 
         # calculate scores
         signs = linearize(self.modules[0])
         (data, _) = next(iter(self.loader))
         input_dim = list(data[0, :].shape)
-        input = torch.ones([1] + input_dim).cuda()  # , dtype=torch.float64).to(device)
+        input = torch.ones([1] + input_dim).to(self.device)  # , dtype=torch.float64).to(device)
         output = self.modules[0](input)
         self.optimizer.zero_grad()
         torch.sum(output).backward()
 
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
+        for name, weight in self.layers.named_parameters():
+            mask = self.masks[name]
 
-                # prune
-                new_mask = self.kernel_pruning(mask, weight, name)
-                self.pruning_rate[name] = int(self.name2nonzeros[name] - new_mask.sum().item())
-                # grow
-                new_mask = self.kernel_gradient_growth(name, new_mask, self.pruning_rate[name], weight)
+            # prune
+            new_mask = self.kernel_pruning(mask, weight, name)
+            self.pruning_rate[name] = int(self.name2nonzeros[name] - new_mask.sum().item())
+            # grow
+            new_mask = self.kernel_gradient_growth(name, new_mask, self.pruning_rate[name], weight)
 
-            self.masks.pop(name)
-            self.masks[name] = new_mask.float()
+            self.masks[name] = new_mask
 
         nonlinearize(self.modules[0], signs)
         self.apply_mask()
@@ -688,16 +650,14 @@ class Masking(object):
         # nonlinearize(self.modules[0], signs)
 
     def truncate_weights_NM(self, step=None):
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                self.name2nonzeros[name] = (self.masks[name]!=0).sum().item()
-                mask = self.masks[name]
-                # death
-                new_mask, group_removal = self.magnitude_death_NM(mask, weight, self.death_rate)
+        self.name2nonzeros.update(self.mask_stats().nonzeros())
+        for name, weight in self.layers.named_parameters():
+            mask = self.masks[name]
+            # death
+            new_mask, group_removal = self.magnitude_death_NM(mask, weight, self.death_rate)
 
-                new_mask = self.gradient_growth_NM(name, new_mask, group_removal, weight)
-                self.masks[name] = new_mask.float()
+            new_mask = self.gradient_growth_NM(name, new_mask, group_removal, weight)
+            self.masks[name] = new_mask.float()
         self.apply_mask()
 
     def truncate_weights(self, step=None):
@@ -711,37 +671,41 @@ class Masking(object):
             total_removed = self.global_magnitude_death()
         else:
             index = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    mask = self.masks[name]
-
-                    # death
-                    if self.death_mode == 'magnitude':
-                        new_mask = self.magnitude_death(mask, weight, name)
-                    # elif self.death_mode == 'mag_gra':
-                    #     new_mask = self.mag_gra(mask, weight, name, epoch)
-                    elif self.death_mode == 'SET':
-                        new_mask = self.magnitude_and_negativity_death(mask, weight, name)
-                    elif self.death_mode == 'Taylor_FO':
-                        new_mask = self.taylor_FO(mask, weight, name)
-                    elif self.death_mode == 'threshold':
-                        new_mask = self.threshold_death(mask, weight, name)
-                    elif self.death_mode == 'magnitude_increase':
-                        new_mask = self.magnitude_increase(weight, mask, name)
-                    elif self.death_mode == 'new_pruning':
-                        if self.snip_masks:
-                            new_mask = self.CS_death(mask, self.snip_masks[index])
-                            index += 1
-                        else:
-                            print('No snip masks are available.')
-
-                    total_removed += self.name2nonzeros[name] - new_mask.sum().item()
-                    self.pruning_rate[name] = int(self.name2nonzeros[name] - new_mask.sum().item())
-                    self.masks[name][:] = new_mask
-                    self.nonzero_masks[name] = new_mask.float()
+            for name, weight in self.layers.named_parameters():
+                mask = self.masks[name]
+
+                # death
+                if self.death_mode == 'magnitude':
+                    new_mask = self.magnitude_death(mask, weight, name)
+                # elif self.death_mode == 'mag_gra':
+                #     new_mask = self.mag_gra(mask, weight, name, epoch)
+                elif self.death_mode == 'SET':
+                    new_mask = self.magnitude_and_negativity_death(mask, weight, name)
+                elif self.death_mode == 'Taylor_FO':
+                    new_mask = self.taylor_FO(mask, weight, name)
+                elif self.death_mode == 'threshold':
+                    new_mask = self.threshold_death(mask, weight, name)
+                elif self.death_mode == 'magnitude_increase':
+                    new_mask = self.magnitude_increase(weight, mask, name)
+                elif self.death_mode == 'new_pruning':
+                    if self.snip_masks:
+                        new_mask = self.CS_death(mask, self.snip_masks[index])
+                        index += 1
+                    else:
+                        print('No snip masks are available.')
+
+                self.masks[name] = new_mask
+                self.nonzero_masks[name] = new_mask.float()
+
+        # nonzeros after the death step, all layers in one reduction
+        pruned = self.mask_stats()
+        name2pruned = pruned.nonzeros()
+        if self.death_mode != 'global_magnitude':
+            self.pruning_rate.update(pruned.removed(self.stats))
+            total_removed = sum(self.pruning_rate.values())
 
         # self.apply_mask()
+        grown = None
         if self.growth_mode == 'global_momentum':
             total_nonzero_new = self.global_momentum_growth(total_removed + self.adjusted_growth)
         else:
@@ -753,51 +717,60 @@ class Masking(object):
                 elif total_removed > (1.0+self.tolerance) * expected_killed:
                     self.threshold *= 0.5
 
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    new_mask = self.masks[name].data.byte()
-
-                    if self.death_mode == 'threshold':
-                        total_regrowth = math.floor((total_removed/float(expected_killed))*name2regrowth[name]*self.growth_death_ratio)
-                    elif self.redistribution_mode == 'none':
-                        if name not in self.name2baseline_nonzero:
-                            self.name2baseline_nonzero[name] = self.name2nonzeros[name]
-                        old = self.name2baseline_nonzero[name]
-                        new = new_mask.sum().item()
-                        #print(old, new)
-                        total_regrowth = int(old-new)
-                    elif self.death_mode == 'global_magnitude':
-                        expected_removed = self.baseline_nonzero*self.name2death_rate[name]
-                        expected_vs_actual = total_removed/expected_removed
-                        total_regrowth = math.floor(expected_vs_actual*name2regrowth[name]*self.growth_death_ratio)
-                    else:
-                        total_regrowth = math.floor(name2regrowth[name]*self.growth_death_ratio)
-
-                    # growth
-                    if self.growth_mode == 'random':
-                        new_mask = self.random_growth(name, new_mask, total_regrowth, weight)
-
-                    elif self.growth_mode == 'momentum':
-                        new_mask = self.momentum_growth(name, new_mask, total_regrowth, weight)
-
-                    elif self.growth_mode == 'gradient':
-                        # implementation for Rigging Ticket
-                        new_mask, grad = self.gradient_growth(name, new_mask, self.pruning_rate[name], weight)
+            batched = []
+            for name, weight in self.layers.named_parameters():
+                new_mask = self.masks[name].data.byte()
 
-                    elif self.growth_mode == 'momentum_neuron':
-                        new_mask = self.momentum_neuron_growth(name, new_mask, total_regrowth, weight)
-
-                    elif self.growth_mode == 'mix_growth':
-                        new_mask = self.mix_growth(name, new_mask, total_regrowth, weight)
-
-                    new_nonzero = new_mask.sum().item()
-
-                    # exchanging masks
-                    self.masks.pop(name)
-                    self.masks[name] = new_mask.float()
-                    total_nonzero_new += new_nonzero
+                if self.death_mode == 'threshold':
+                    total_regrowth = math.floor((total_removed/float(expected_killed))*name2regrowth[name]*self.growth_death_ratio)
+                elif self.redistribution_mode == 'none':
+                    if name not in self.name2baseline_nonzero:
+                        self.name2baseline_nonzero[name] = self.name2nonzeros[name]
+                    old = self.name2baseline_nonzero[name]
+                    new = name2pruned[name]
+                    #print(old, new)
+                    total_regrowth = int(old-new)
+                elif self.death_mode == 'global_magnitude':
+                    expected_removed = self.baseline_nonzero*self.name2death_rate[name]
+                    expected_vs_actual = total_removed/expected_removed
+                    total_regrowth = math.floor(expected_vs_actual*name2regrowth[name]*self.growth_death_ratio)
+                else:
+                    total_regrowth = math.floor(name2regrowth[name]*self.growth_death_ratio)
+
+                # growth
+                if self.growth_mode in ['random', 'momentum']:
+                    # grown for all layers at once after the loop
+                    batched.append((name, new_mask, total_regrowth, weight))
+                    continue
+
+                elif self.growth_mode == 'gradient':
+                    # implementation for Rigging Ticket
+                    new_mask, grad = self.gradient_growth(name, new_mask, self.pruning_rate[name], weight)
+
+                elif self.growth_mode == 'momentum_neuron':
+                    new_mask = self.momentum_neuron_growth(name, new_mask, total_regrowth, weight)
+
+                elif self.growth_mode == 'mix_growth':
+                    new_mask = self.mix_growth(name, new_mask, total_regrowth, weight)
+
+                # exchanging masks
+                self.masks[name] = new_mask
+
+            if len(batched) > 0:
+                names, masks, quotas, weights = zip(*batched)
+                scores = [None if self.growth_mode == 'random' else self.get_momentum_for_weight(weight) for weight in weights]
+                new_masks, grown = grow(masks, scores, quotas, return_grown=True)
+                for name, new_mask in zip(names, new_masks):
+                    self.masks[name] = new_mask
+                grown = dict(zip(names, grown))
+            total_nonzero_new = self.mask_stats().total_nonzeros()
         self.apply_mask()
+        if grown is None:
+            self.exploration.update(self.masks)
+        else:
+            # every layer was grown by grow(), and only grown weights can have fired for the first time
+            for name in grown:
+                self.exploration.update_grown(name, grown[name])
 
         # Some growth techniques and redistribution are probablistic and we might not grow enough weights or too much weights
         # Here we run an exponential smoothing over (death-growth) residuals to adjust future growth
@@ -813,110 +786,84 @@ class Masking(object):
     '''
 
     def gather_statistics(self):
-        self.name2nonzeros = {}
-        self.name2zeros = {}
         self.name2variance = {}
 
         self.total_variance = 0.0
         self.total_removed = 0
+        # all nonzero counts in one reduction, one host sync
+        self.stats = self.mask_stats()
+        self.name2nonzeros = dict(self.stats.nonzeros())
+        self.name2zeros = dict(self.stats.zeros())
         self.total_nonzero = 0
         self.total_zero = 0.0
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
-                if self.redistribution_mode == 'momentum':
-                    grad = self.get_momentum_for_weight(tensor)
-                    self.name2variance[name] = torch.abs(grad[mask.byte()]).mean().item()#/(V1val*V2val)
-                elif self.redistribution_mode == 'magnitude':
-                    self.name2variance[name] = torch.abs(tensor)[mask.byte()].mean().item()
-                elif self.redistribution_mode == 'nonzeros':
-                    self.name2variance[name] = float((torch.abs(tensor) > self.threshold).sum().item())
-                elif self.redistribution_mode == 'none':
-                    self.name2variance[name] = 1.0
-                elif self.redistribution_mode == 'magnitude_increase':
-                    # only calculate the increased weights
-                    mask_increased = torch.abs(tensor) > torch.abs(self.pre_tensor[name])
-                    # weights_increased = (torch.abs(tensor) - torch.abs(self.pre_tensor[name])).mean().item()
-                    # print(name, "Weight increased:", weights_increased)
-                    # include all the non-zero weights
-                    self.name2variance[name] = (torch.abs(tensor[mask_increased.byte()]) - torch.abs(self.pre_tensor[name][mask_increased.byte()])).mean().item()
-                    # self.name2variance[name] = torch.abs(tensor[mask.byte()] - self.pre_tensor[name][mask.byte()]).mean().item()
-                    # print("name", name, "abs_MI",self.name2variance[name])# mean of ABS of magnitude increased weights
-                    # print("abs_M",torch.abs(tensor[mask.byte()] - self.pre_tensor[name][mask.byte()]).mean().item())  # mean() of absolute of all weights magnitude increased
-                elif self.redistribution_mode == 'uniform_distribution':
-                    self.name2variance[name] = 1
-                else:
-                    print('Unknown redistribution mode:{0}'.format(self.redistribution_mode))
-                    raise Exception('Unknown redistribution mode!')
-
-                if not np.isnan(self.name2variance[name]):
-                    self.total_variance += self.name2variance[name]
-                self.name2nonzeros[name] = mask.sum().item()
-                self.name2zeros[name] = mask.numel() - self.name2nonzeros[name]
-
-                sparsity = self.name2zeros[name]/float(self.masks[name].numel())
-                death_rate = self.name2death_rate[name]
-                if sparsity < 0.2:
-                    expected_variance = 1.0/len(list(self.name2variance.keys()))
-                    actual_variance = self.name2variance[name]
-                    expected_vs_actual = expected_variance/actual_variance
-                    if expected_vs_actual < 1.0:
-                        death_rate = min(sparsity, death_rate)
-                num_remove = math.ceil(death_rate*self.name2nonzeros[name])
-                self.total_removed += num_remove
-                self.total_nonzero += self.name2nonzeros[name]
-                self.total_zero += self.name2zeros[name]
+        for name, tensor in self.layers.named_parameters():
+            mask = self.masks[name]
+            if self.redistribution_mode == 'momentum':
+                grad = self.get_momentum_for_weight(tensor)
+                self.name2variance[name] = torch.abs(grad[mask.byte()]).mean().item()#/(V1val*V2val)
+            elif self.redistribution_mode == 'magnitude':
+                self.name2variance[name] = torch.abs(tensor)[mask.byte()].mean().item()
+            elif self.redistribution_mode == 'nonzeros':
+                self.name2variance[name] = float((torch.abs(tensor) > self.threshold).sum().item())
+            elif self.redistribution_mode == 'none':
+                self.name2variance[name] = 1.0
+            elif self.redistribution_mode == 'magnitude_increase':
+                # only calculate the increased weights
+                mask_increased = torch.abs(tensor) > torch.abs(self.pre_tensor[name])
+                # weights_increased = (torch.abs(tensor) - torch.abs(self.pre_tensor[name])).mean().item()
+                # print(name, "Weight increased:", weights_increased)
+                # include all the non-zero weights
+                self.name2variance[name] = (torch.abs(tensor[mask_increased.byte()]) - torch.abs(self.pre_tensor[name][mask_increased.byte()])).mean().item()
+                # self.name2variance[name] = torch.abs(tensor[mask.byte()] - self.pre_tensor[name][mask.byte()]).mean().item()
+                # print("name", name, "abs_MI",self.name2variance[name])# mean of ABS of magnitude increased weights
+                # print("abs_M",torch.abs(tensor[mask.byte()] - self.pre_tensor[name][mask.byte()]).mean().item())  # mean() of absolute of all weights magnitude increased
+            elif self.redistribution_mode == 'uniform_distribution':
+                self.name2variance[name] = 1
+            else:
+                print('Unknown redistribution mode:{0}'.format(self.redistribution_mode))
+                raise Exception('Unknown redistribution mode!')
+
+            if not np.isnan(self.name2variance[name]):
+                self.total_variance += self.name2variance[name]
+
+            sparsity = self.name2zeros[name]/float(self.masks.numel(name))
+            death_rate = self.name2death_rate[name]
+            if sparsity < 0.2:
+                expected_variance = 1.0/len(list(self.name2variance.keys()))
+                actual_variance = self.name2variance[name]
+                expected_vs_actual = expected_variance/actual_variance
+                if expected_vs_actual < 1.0:
+                    death_rate = min(sparsity, death_rate)
+            num_remove = math.ceil(death_rate*self.name2nonzeros[name])
+            self.total_removed += num_remove
+            self.total_nonzero += self.name2nonzeros[name]
+            self.total_zero += self.name2zeros[name]
 
     def calc_growth_redistribution(self):
-        num_overgrowth = 0
-        total_overgrowth = 0
-        residual = 0
         for name in self.name2variance:
             self.name2variance[name] /= self.total_variance
 
-        residual = 9999
-        mean_residual = 0
-        name2regrowth = {}
-        i = 0
-        expected_var = 1.0/len(self.name2variance)
-        while residual > 0 and i < 1000:
-            residual = 0
-            for name in self.name2variance:
-                #death_rate = min(self.name2death_rate[name], max(0.05, (self.name2zeros[name]/float(self.masks[name].numel()))))
-                sparsity = self.name2zeros[name]/float(self.masks[name].numel())
-                death_rate = self.name2death_rate[name]
-                if sparsity < 0.2:
-                    expected_variance = 1.0/len(list(self.name2variance.keys()))
-                    actual_variance = self.name2variance[name]
-                    expected_vs_actual = expected_variance/actual_variance
-                    if expected_vs_actual < 1.0:
-                        death_rate = min(sparsity, death_rate)
-                num_remove = math.ceil(death_rate*self.name2nonzeros[name])
-                #num_remove = math.ceil(self.name2death_rate[name]*self.name2nonzeros[name])
-                num_nonzero = self.name2nonzeros[name]
-                num_zero = self.name2zeros[name]
-                max_regrowth = num_zero + num_remove
-
-                if name in name2regrowth:
-                    regrowth = name2regrowth[name]
-                else:
-                    regrowth = math.ceil(self.name2variance[name]*(self.total_removed+self.adjusted_growth))
-                regrowth += mean_residual
-
-                #if regrowth > max_regrowth:
-                #    name2regrowth[name] = max_regrowth
-                if regrowth > 0.99*max_regrowth:
-                    name2regrowth[name] = 0.99*max_regrowth
-                    residual += regrowth - name2regrowth[name]
-                else:
-                    name2regrowth[name] = regrowth
-            if len(name2regrowth) == 0: mean_residual = 0
-            else:
-                mean_residual = residual / len(name2regrowth)
-            i += 1
-
-        if i == 1000:
+        # regrowth proportional to the redistribution statistics, capped at 0.99 of the free
+        # slots of a layer; what does not fit is spread evenly over the other layers
+        names = list(self.name2variance)
+        demand, capacity = [], []
+        for name in names:
+            #death_rate = min(self.name2death_rate[name], max(0.05, (self.name2zeros[name]/float(self.masks[name].numel()))))
+            sparsity = self.name2zeros[name]/float(self.masks.numel(name))
+            death_rate = self.name2death_rate[name]
+            if sparsity < 0.2:
+                expected_variance = 1.0/len(names)
+                actual_variance = self.name2variance[name]
+                expected_vs_actual = expected_variance/actual_variance
+                if expected_vs_actual < 1.0:
+                    death_rate = min(sparsity, death_rate)
+            num_remove = math.ceil(death_rate*self.name2nonzeros[name])
+            capacity.append(0.99*(self.name2zeros[name] + num_remove))
+            demand.append(math.ceil(self.name2variance[name]*(self.total_removed+self.adjusted_growth)))
+        regrowth, residual = water_fill(demand, capacity)
+        name2regrowth = dict(zip(names, regrowth))
+
+        if residual > 0:
             print('Error resolving the residual! Layers are too full! Residual left over: {0}'.format(residual))
 
         return name2regrowth
@@ -932,10 +879,13 @@ class Masking(object):
 
         num_remove = math.ceil(self.name2death_rate[name] * self.name2nonzeros[name])
         num_zeros = self.name2zeros[name]
-        k = math.ceil(num_zeros + num_remove)
 
-        x, idx = torch.sort((weight.data * weight.grad).pow(2).flatten())
-        mask.data.view(-1)[idx[:k]] = 0.0
+        # the k = num_zeros + num_remove smallest scores are the inactive entries (score 0)
+        # plus the num_remove smallest active ones, so only the active entries are selected from
+        active = mask.data.view(-1).nonzero().view(-1)
+        score = (weight.data * weight.grad).pow(2).flatten()[active]
+        _, idx = torch.topk(score, min(num_remove, active.numel()), largest=False)
+        mask.data.view(-1)[active[idx]] = 0.0
 
         return mask
 
@@ -949,10 +899,10 @@ class Masking(object):
         if num_remove == 0.0: return weight.data != 0.0
         #num_remove = math.ceil(self.name2death_rate[name]*self.name2nonzeros[name])
 
-        num_zeros = self.name2zeros[name]
-        x, idx = torch.sort(score.data.view(-1))
-        k = math.ceil(num_zeros + num_remove)
-        mask.data.view(-1)[idx[:k]] = 0.0
+        # inactive weights have a zero score, so select only among the active entries
+        active = mask.data.view(-1).nonzero().view(-1)
+        _, idx = torch.topk(score.data.view(-1)[active], min(num_remove, active.numel()), largest=False)
+        mask.data.view(-1)[active[idx]] = 0.0
         return mask
 
     def magnitude_death_NM(self, mask, weight, pruning_rate):
@@ -986,12 +936,10 @@ class Masking(object):
         #num_remove = math.ceil(self.name2death_rate[name]*self.name2nonzeros[name])
         num_zeros = self.name2zeros[name]
 
-        x, idx = torch.sort(torch.abs(weight.data.view(-1)))
-        n = idx.shape[0]
-        num_nonzero = n-num_zeros
-
-        k = math.ceil(num_zeros + num_remove)
-        threshold = x[k-1].item()
+        # the num_zeros inactive weights are zero, so the k-th smallest magnitude overall
+        # is the num_remove-th smallest magnitude among the active weights
+        active = torch.abs(weight.data[mask != 0])
+        threshold = torch.kthvalue(active, min(num_remove, active.numel()))[0].item()
 
         return (torch.abs(weight.data) > threshold)
 
@@ -1001,73 +949,39 @@ class Masking(object):
             if name in self.masks:
                 death_rate = self.name2death_rate[name]
         tokill = math.ceil(death_rate*self.baseline_nonzero)
-        total_removed = 0
-        prev_removed = 0
-        while total_removed < tokill*(1.0-self.tolerance) or (total_removed > tokill*(1.0+self.tolerance)):
-            total_removed = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-                    remain = (torch.abs(weight.data) > self.threshold).sum().item()
-                    total_removed += self.name2nonzeros[name] - remain
-
-            if prev_removed == total_removed: break
-            prev_removed = total_removed
-            if total_removed > tokill*(1.0+self.tolerance):
-                self.threshold *= 1.0-self.increment
-                self.increment *= 0.99
-            elif total_removed < tokill*(1.0-self.tolerance):
-                self.threshold *= 1.0+self.increment
-                self.increment *= 0.99
 
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                self.masks[name][:] = torch.abs(weight.data) > self.threshold
+        # keep exactly the largest active magnitudes over all layers, inactive weights can never be kept
+        scores, total_nonzero = [], 0
+        for name, weight in self.layers.named_parameters():
+            mask = self.masks[name]
+            scores.append(torch.where(mask != 0, torch.abs(weight.data), torch.full_like(weight.data, -float('inf'))))
+            total_nonzero += self.name2nonzeros[name]
+        total_removed = min(tokill, total_nonzero)
+        new_masks, threshold = top_k_masks(scores, total_nonzero - total_removed)
+        if threshold is not None: self.threshold = threshold
+
+        for (name, weight), new_mask in zip(self.layers.named_parameters(), new_masks):
+            self.masks[name] = new_mask
 
         return int(total_removed)
 
 
     def global_momentum_growth(self, total_regrowth):
-        togrow = total_regrowth
-        total_grown = 0
-        last_grown = 0
-        while total_grown < togrow*(1.0-self.tolerance) or (total_grown > togrow*(1.0+self.tolerance)):
-            total_grown = 0
-            total_possible = 0
-            for module in self.modules:
-                for name, weight in module.named_parameters():
-                    if name not in self.masks: continue
-
-                    new_mask = self.masks[name]
-                    grad = self.get_momentum_for_weight(weight)
-                    grad = grad*(new_mask==0).float()
-                    possible = (grad !=0.0).sum().item()
-                    total_possible += possible
-                    grown = (torch.abs(grad.data) > self.growth_threshold).sum().item()
-                    total_grown += grown
-            print(total_grown, self.growth_threshold, togrow, self.growth_increment, total_possible)
-            if total_grown == last_grown: break
-            last_grown = total_grown
-
-
-            if total_grown > togrow*(1.0+self.tolerance):
-                self.growth_threshold *= 1.02
-                #self.growth_increment *= 0.95
-            elif total_grown < togrow*(1.0-self.tolerance):
-                self.growth_threshold *= 0.98
-                #self.growth_increment *= 0.95
+        # regrow exactly the inactive weights with the largest momentum magnitude over all layers
+        scores = []
+        for name, weight in self.layers.named_parameters():
+            grad = self.get_momentum_for_weight(weight)
+            scores.append(torch.where(self.masks[name] == 0, torch.abs(grad.data).float(), torch.full_like(grad.data, -float('inf'), dtype=torch.float)))
+        total_possible = int(sum((score != -float('inf')).sum() for score in scores))
+        new_masks, threshold = top_k_masks(scores, min(math.ceil(total_regrowth), total_possible))
+        if threshold is not None: self.growth_threshold = threshold
+        print(total_possible, self.growth_threshold, total_regrowth)
 
         total_new_nonzeros = 0
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-
-                new_mask = self.masks[name]
-                grad = self.get_momentum_for_weight(weight)
-                grad = grad*(new_mask==0).float()
-                self.masks[name][:] = (new_mask.byte() | (torch.abs(grad.data) > self.growth_threshold)).float()
-                total_new_nonzeros += new_mask.sum().item()
+        for (name, weight), grown in zip(self.layers.named_parameters(), new_masks):
+            new_mask = (self.masks[name].bool() | grown).float()
+            self.masks[name] = new_mask
+            total_new_nonzeros += new_mask.sum().item()
         return total_new_nonzeros
 
 
@@ -1077,20 +991,20 @@ class Masking(object):
 
         # find magnitude threshold
         # remove all weights which absolute value is smaller than threshold
-        x, idx = torch.sort(weight[weight > 0.0].data.view(-1))
+        x = weight[weight > 0.0].data.view(-1)
         k = math.ceil(num_remove/2.0)
         if k >= x.shape[0]:
             k = x.shape[0]
 
-        threshold_magnitude = x[k-1].item()
+        threshold_magnitude = torch.kthvalue(x, k)[0].item() if k > 0 else x.max().item()
 
         # find negativity threshold
         # remove all weights which are smaller than threshold
-        x, idx = torch.sort(weight[weight < 0.0].view(-1))
+        x = weight[weight < 0.0].data.view(-1)
         k = math.ceil(num_remove/2.0)
         if k >= x.shape[0]:
             k = x.shape[0]
-        threshold_negativity = x[k-1].item()
+        threshold_negativity = torch.kthvalue(x, k)[0].item() if k > 0 else x.max().item()
 
 
         pos_mask = (weight.data > threshold_magnitude) & (weight.data > 0.0)
@@ -1105,23 +1019,10 @@ class Masking(object):
     '''
 
     def random_growth(self, name, new_mask, total_regrowth, weight):
-        n = (new_mask==0).sum().item()
-        if n == 0: return new_mask
-        expeced_growth_probability = (total_regrowth/n)
-        new_weights = torch.rand(new_mask.shape).cuda() < expeced_growth_probability #lsw
-        # new_weights = torch.rand(new_mask.shape) < expeced_growth_probability
-        new_mask_ = new_mask.byte() | new_weights
-        if (new_mask_!=0).sum().item() == 0:
-            new_mask_ = new_mask
-        return new_mask_
+        return grow([new_mask], [None], [total_regrowth])[0]
 
     def momentum_growth(self, name, new_mask, total_regrowth, weight):
-        grad = self.get_momentum_for_weight(weight)
-        grad = grad*(new_mask==0).float()
-        y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
-        new_mask.data.view(-1)[idx[:total_regrowth]] = 1.0
-
-        return new_mask
+        return grow([new_mask], [self.get_momentum_for_weight(weight)], [total_regrowth])[0]
 
     def kernel_gradient_growth(self, name, new_mask, total_regrowth, weight):
         grad = self.grads[name]
@@ -1177,37 +1078,13 @@ class Masking(object):
 
         n = (new_mask == 0).sum().item()
         expeced_growth_probability = (random_grow / n)
-        new_weights = torch.rand(new_mask.shape).cuda() < expeced_growth_probability
+        new_weights = torch.rand(new_mask.shape, device=new_mask.device) < expeced_growth_probability
         new_mask = new_mask.bool() | new_weights
 
         return new_mask
 
     def momentum_neuron_growth(self, name, new_mask, total_regrowth, weight):
-        grad = self.get_momentum_for_weight(weight)
-
-        M = torch.abs(grad)
-        if len(M.shape) == 2: sum_dim = [1]
-        elif len(M.shape) == 4: sum_dim = [1, 2, 3]
-
-        v = M.mean(sum_dim).data
-        v /= v.sum()
-
-        slots_per_neuron = (new_mask==0).sum(sum_dim)
-
-        M = M*(new_mask==0).float()
-        for i, fraction  in enumerate(v):
-            neuron_regrowth = math.floor(fraction.item()*total_regrowth)
-            available = slots_per_neuron[i].item()
-
-            y, idx = torch.sort(M[i].flatten())
-            if neuron_regrowth > available:
-                neuron_regrowth = available
-            threshold = y[-(neuron_regrowth)].item()
-            if threshold == 0.0: continue
-            if neuron_regrowth < 10: continue
-            new_mask[i] = new_mask[i] | (M[i] > threshold)
-
-        return new_mask
+        return neuron_growth(new_mask, self.get_momentum_for_weight(weight), total_regrowth)
 
     '''
                 UTILITY
@@ -1225,21 +1102,25 @@ class Masking(object):
         grad = weight.grad.clone()
         return grad
 
+    def mask_stats(self):
+        """Nonzero counts of all masks, see stats.SparsityStats."""
+        return SparsityStats((name, self.masks[name]) for name, weight in self.layers.named_parameters())
+
+    def finish_topology_update(self):
+        """Swaps in a pending asynchronous topology update now, e.g. at the end of an epoch or of training."""
+        if self.topology_update is not None and self.topology_update.flush():
+            self.print_nonzero_counts()
+
     def print_nonzero_counts(self):
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
-                num_nonzeros = (mask != 0).sum().item()
-                val = '{0}: {1}->{2}, density: {3:.3f}'.format(name, self.name2nonzeros[name], num_nonzeros, num_nonzeros/float(mask.numel()))
-                print(val)
+        stats = self.mask_stats()
+        for name, num_nonzeros, density in zip(stats.names, stats.counts(), stats.density().values()):
+            val = '{0}: {1}->{2}, density: {3:.3f}'.format(name, self.name2nonzeros[name], num_nonzeros, density)
+            print(val)
 
 
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name not in self.masks: continue
-                print('Death rate: {0}\n'.format(self.name2death_rate[name]))
-                break
+        for name, tensor in self.layers.named_parameters():
+            print('Death rate: {0}\n'.format(self.name2death_rate[name]))
+            break
 
     def reset_momentum(self):
         """
@@ -1248,40 +1129,31 @@ class Masking(object):
         When connections are reset, parameters should be treated
         as freshly initialized.
         """
-        for module in self.modules:
-            for name, tensor in module.named_parameters():
-                if name not in self.masks: continue
-                mask = self.masks[name]
-                weights = list(self.optimizer.state[tensor])
-                for w in weights:
-                    if w == 'momentum_buffer':
-                        # momentum
-                        if self.args.reset_mom_zero:
-                            print('zero')
-                            self.optimizer.state[tensor][w][mask == 0] = 0
-                        else:
-                            print('mean')
-                            self.optimizer.state[tensor][w][mask==0] = torch.mean(self.optimizer.state[tensor][w][mask.byte()])
-                        # self.optimizer.state[tensor][w][mask==0] = 0
-                    elif w == 'square_avg' or \
-                        w == 'exp_avg' or \
-                        w == 'exp_avg_sq' or \
-                        w == 'exp_inf':
-                        # Adam
+        for name, tensor in self.layers.named_parameters():
+            mask = self.masks[name]
+            weights = list(self.optimizer.state[tensor])
+            for w in weights:
+                if w == 'momentum_buffer':
+                    # momentum
+                    if self.args.reset_mom_zero:
+                        print('zero')
+                        self.optimizer.state[tensor][w][mask == 0] = 0
+                    else:
+                        print('mean')
                         self.optimizer.state[tensor][w][mask==0] = torch.mean(self.optimizer.state[tensor][w][mask.byte()])
+                    # self.optimizer.state[tensor][w][mask==0] = 0
+                elif w == 'square_avg' or \
+                    w == 'exp_avg' or \
+                    w == 'exp_avg_sq' or \
+                    w == 'exp_inf':
+                    # Adam
+                    self.optimizer.state[tensor][w][mask==0] = torch.mean(self.optimizer.state[tensor][w][mask.byte()])
 
     def fired_masks_update(self):
-        ntotal_fired_weights = 0.0
-        ntotal_weights = 0.0
-        layer_fired_weights = {}
-        for module in self.modules:
-            for name, weight in module.named_parameters():
-                if name not in self.masks: continue
-                self.fired_masks[name] = self.masks[name].data.byte() | self.fired_masks[name].data.byte()
-                ntotal_fired_weights += float(self.fired_masks[name].sum().item())
-                ntotal_weights += float(self.fired_masks[name].numel())
-                layer_fired_weights[name] = float(self.fired_masks[name].sum().item())/float(self.fired_masks[name].numel())
-                print('Layerwise percentage of the fired weights of', name, 'is:', layer_fired_weights[name])
-        total_fired_weights = ntotal_fired_weights/ntotal_weights
+        self.exploration.update(self.masks)
+        layer_fired_weights, total_fired_weights = self.exploration.rates()
+        layer_fired_weights = dict(layer_fired_weights)
+        for name in layer_fired_weights:
+            print('Layerwise percentage of the fired weights of', name, 'is:', layer_fired_weights[name])
         print('The percentage of the total fired weights is:', total_fired_weights)
         return layer_fired_weights, total_fired_weights
\ No newline at end of file
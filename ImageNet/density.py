@@ -0,0 +1,82 @@
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+
+
+def raw_probabilities(shapes, method='ERK', power_scale=1.0):
+    """Unnormalised per-layer densities of the Erdos-Renyi family.
+
+    ERK             (sum of all dims / product of all dims) ** power_scale
+    ER              the same over the first two dims (n_out, n_in) only
+    modified_ERK    conv kernels use all dims but the last one, 2D weights all dims
+    """
+    raw = []
+    for shape in shapes:
+        if method == 'ER':
+            dims = shape[:2]
+        elif method == 'modified_ERK' and len(shape) != 2:
+            dims = shape[:-1]
+        else:
+            dims = shape
+        raw.append((np.sum(dims) / np.prod(dims)) ** power_scale)
+    return np.array(raw, dtype=np.float64)
+
+
+@lru_cache(maxsize=None)
+def _solve(shapes, density, method, power_scale, dense_layers):
+    names = [name for name, shape in shapes]
+    n_params = np.array([np.prod(shape) for name, shape in shapes], dtype=np.float64)
+    if method == 'uniform':
+        return tuple(1.0 if name in dense_layers else density for name in names)
+
+    raw = raw_probabilities([shape for name, shape in shapes], method, power_scale)
+    forced = np.array([name in dense_layers for name in names], dtype=bool)
+    if forced.all():
+        return tuple(1.0 for name in names)
+    # budget of nonzeros left for the sparse layers once the forced dense layers are paid for
+    budget = density * n_params.sum() - n_params[forced].sum()
+
+    # Layers become dense in order of decreasing raw probability, all layers with the
+    # same raw probability at once, until epsilon * max raw probability <= 1. Instead
+    # of re-solving after each step, evaluate epsilon for every possible cutoff at once.
+    order = np.flatnonzero(~forced)
+    order = order[np.argsort(-raw[order], kind='stable')]
+    sorted_raw = raw[order]
+    cutoffs = np.concatenate([[0], np.flatnonzero(np.diff(sorted_raw) != 0) + 1])
+    dense_params = np.concatenate([[0.0], np.cumsum(n_params[order])])
+    divisor = (raw[order] * n_params[order]).sum() - np.concatenate([[0.0], np.cumsum(sorted_raw * n_params[order])])
+    epsilon = (budget - dense_params[cutoffs]) / divisor[cutoffs]
+    valid = np.flatnonzero(epsilon * sorted_raw[cutoffs] <= 1)
+    if len(valid) == 0:
+        print('No valid epsilon for density {0}, all layers are kept dense.'.format(density))
+        return tuple(1.0 for name in names)
+    cutoff, epsilon = cutoffs[valid[0]], epsilon[valid[0]]
+
+    densities = np.ones(len(names))
+    densities[order[cutoff:]] = epsilon * raw[order[cutoff:]]
+    return tuple(densities.tolist())
+
+
+def layerwise_density(shapes, density, method='ERK', power_scale=1.0, dense_layers=()):
+    """Per-layer densities so that the whole model has the given overall density.
+
+    Solves the ERK / ER allocation of "Rigging the Lottery" in closed form:
+    every layer gets epsilon * raw_probability, and layers whose density would
+    exceed 1 are made dense and their parameters taken out of the budget.
+    Results are cached per (shapes, density, method, power_scale, dense_layers),
+    so repeated inits and sweeps over the same architecture are free.
+
+    Args:
+        shapes          Ordered mapping or list of (name, shape) of the masked layers.
+        density         Overall density of these layers.
+        method          'ERK', 'ER', 'modified_ERK' or 'uniform'.
+        power_scale     Exponent applied to the raw probabilities.
+        dense_layers    Names of layers that must stay dense (density 1).
+
+    Returns:
+        OrderedDict name -> density.
+    """
+    if isinstance(shapes, dict): shapes = shapes.items()
+    shapes = tuple((name, tuple(int(d) for d in shape)) for name, shape in shapes)
+    densities = _solve(shapes, float(density), method, float(power_scale), tuple(sorted(dense_layers)))
+    return OrderedDict((name, d) for (name, shape), d in zip(shapes, densities))
@@ -0,0 +1,119 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+import torch.utils.data
+
+
+def cache_key(dataset):
+    """Identifies the pre-processed images: the dataset root, its file list and the (deterministic) transform."""
+    h = hashlib.sha1()
+    h.update(os.path.abspath(getattr(dataset, 'root', '')).encode())
+    h.update(repr(getattr(dataset, 'transform', None)).encode())
+    samples = getattr(dataset, 'samples', None)
+    if samples is not None:
+        h.update('\n'.join(path for path, _ in samples).encode())
+    h.update(str(len(dataset)).encode())
+    return h.hexdigest()[:16]
+
+
+def _collate_hwc(batch):
+    images = np.stack([np.asarray(img, dtype=np.uint8) for img, _ in batch])
+    if images.ndim == 3:
+        # grayscale: the same plane for all 3 channels
+        images = np.repeat(images[:, :, :, None], 3, axis=3)
+    return images, np.array([target for _, target in batch], dtype=np.int64)
+
+
+class EvalCache(object):
+    """Loader over an evaluation set whose deterministic transform is only ever run once.
+
+    The first pass decodes the dataset (PIL images of a fixed size, e.g.
+    Resize(256) + CenterCrop(224)) in worker processes and writes the uint8
+    HWC images into a memory-mapped .npy file in cache_dir, named by
+    cache_key; the file is renamed into place only once it is complete. Every
+    later pass, also of later runs, streams the batches straight from the
+    mmap into (pinned) batch tensors, without any decoding.
+
+    Batches are (N, H, W, 3) uint8 and nhwc is set, which prefetched_loader
+    turns into normalized channels_last NCHW batches on the GPU. With mean and
+    std given, batches are instead normalized float (N, 3, H, W) on the CPU,
+    for loops that use the batches as they are.
+
+    Args:
+        dataset     Map-style dataset of (PIL image, label), e.g. ImageFolder.
+        cache_dir   Directory of the cache files.
+        batch_size  Images per batch; the last batch may be smaller.
+        workers     Decoding workers of the first pass.
+        mean, std   Per-channel normalization of the [0, 1] scaled pixels.
+    """
+    def __init__(self, dataset, cache_dir, batch_size, workers=5, mean=None, std=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.workers = workers
+        os.makedirs(cache_dir, exist_ok=True)
+        key = cache_key(dataset)
+        self.path = os.path.join(cache_dir, key + '.npy')
+        self.targets_path = os.path.join(cache_dir, key + '.targets.npy')
+        self.nhwc = mean is None
+        if mean is not None:
+            mean = torch.tensor(mean, dtype=torch.float32)
+            std = torch.tensor(std, dtype=torch.float32)
+            self.scale = (1.0 / (255.0 * std)).view(1, -1, 1, 1)
+            self.shift = (-mean / std).view(1, -1, 1, 1)
+        self.pin = torch.cuda.is_available()
+        self._buffer = None
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def cached(self):
+        return os.path.exists(self.path) and os.path.exists(self.targets_path)
+
+    def _batch(self, images, targets):
+        targets = torch.from_numpy(np.array(targets))
+        if self.nhwc:
+            # A new pinned tensor per batch instead of a ring: the consumer copies it with
+            # non_blocking=True, and the caching host allocator only hands a pinned block out
+            # again once the copies recorded on it have finished on the device.
+            buffer = torch.empty(images.shape, dtype=torch.uint8, pin_memory=self.pin)
+            buffer.numpy()[...] = images
+            return buffer, targets
+        # normalized on the CPU: the buffer is read here, so one is reused
+        if self._buffer is None or self._buffer.shape[1:] != images.shape[1:]:
+            self._buffer = torch.empty((self.batch_size,) + images.shape[1:], dtype=torch.uint8)
+        buffer = self._buffer[:len(images)]
+        buffer.numpy()[...] = images
+        data = torch.addcmul(self.shift, buffer.permute(0, 3, 1, 2).float(), self.scale)
+        return data, targets
+
+    def _write(self):
+        """First pass: decodes the dataset, writes the cache and yields its batches on the way."""
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        loader = torch.utils.data.DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False,
+                                             num_workers=self.workers, collate_fn=_collate_hwc)
+        images, targets, start = None, np.zeros(len(self.dataset), dtype=np.int64), 0
+        for batch, target in loader:
+            if images is None:
+                images = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8,
+                                                   shape=(len(self.dataset),) + batch.shape[1:])
+            images[start:start + len(batch)] = batch
+            targets[start:start + len(batch)] = target
+            start += len(batch)
+            yield self._batch(batch, target)
+        if images is None: return
+        images.flush()
+        del images
+        np.save(self.targets_path, targets)
+        os.replace(tmp, self.path)
+        print('=> cached {} evaluation images in {}'.format(start, self.path))
+
+    def _read(self):
+        images = np.load(self.path, mmap_mode='r')
+        targets = np.load(self.targets_path)
+        for start in range(0, len(targets), self.batch_size):
+            yield self._batch(images[start:start + self.batch_size], targets[start:start + self.batch_size])
+
+    def __iter__(self):
+        return self._read() if self.cached() else self._write()
@@ -1,5 +1,7 @@
 import torch
 import math
+from growth import grow, neuron_growth
+from selection import top_k_masks
 '''
                 REDISTRIBUTION
 '''
@@ -105,12 +107,13 @@ def magnitude_prune(masking, mask, weight, name):
             masking.total_removed = 0
     """
     num_remove = math.ceil(masking.name2prune_rate[name]*masking.name2nonzeros[name])
-    num_zeros = masking.name2zeros[name]
-    k = math.ceil(num_zeros + num_remove)
     if num_remove == 0.0: return weight.data != 0.0
 
-    x, idx = torch.sort(torch.abs(weight.data.view(-1)))
-    mask.data.view(-1)[idx[:k]] = 0.0
+    # the name2zeros[name] inactive weights are zero and always among the smallest
+    # magnitudes, so only the num_remove smallest active weights need to be found
+    active = mask.data.view(-1).nonzero().view(-1)
+    _, idx = torch.topk(torch.abs(weight.data.view(-1))[active], min(num_remove, active.numel()), largest=False)
+    mask.data.view(-1)[active[idx]] = 0.0
     return mask
 
 def global_magnitude_prune(masking):
@@ -119,29 +122,19 @@ def global_magnitude_prune(masking):
         if name in masking.masks:
             prune_rate = masking.name2prune_rate[name]
     tokill = math.ceil(prune_rate*masking.baseline_nonzero)
-    total_removed = 0
-    prev_removed = 0
-    while total_removed < tokill*(1.0-masking.tolerance) or (total_removed > tokill*(1.0+masking.tolerance)):
-        total_removed = 0
-        for module in masking.modules:
-            for name, weight in module.named_parameters():
-                if name not in masking.masks: continue
-                remain = (torch.abs(weight.data) > masking.prune_threshold).sum().item()
-                total_removed += masking.name2nonzeros[name] - remain
-
-        if prev_removed == total_removed: break
-        prev_removed = total_removed
-        if total_removed > tokill*(1.0+masking.tolerance):
-            masking.prune_threshold *= 1.0-masking.increment
-            masking.increment *= 0.99
-        elif total_removed < tokill*(1.0-masking.tolerance):
-            masking.prune_threshold *= 1.0+masking.increment
-            masking.increment *= 0.99
-
-    for module in masking.modules:
-        for name, weight in module.named_parameters():
-            if name not in masking.masks: continue
-            masking.masks[name][:] = torch.abs(weight.data) > masking.prune_threshold
+
+    # keep exactly the largest active magnitudes over all layers, inactive weights can never be kept
+    scores, total_nonzero = [], 0
+    for name, weight in masking.layers.named_parameters():
+        mask = masking.masks[name]
+        scores.append(torch.where(mask != 0, torch.abs(weight.data), torch.full_like(weight.data, -float('inf'))))
+        total_nonzero += masking.name2nonzeros[name]
+    total_removed = min(tokill, total_nonzero)
+    new_masks, threshold = top_k_masks(scores, total_nonzero - total_removed)
+    if threshold is not None: masking.prune_threshold = threshold
+
+    for (name, weight), new_mask in zip(masking.layers.named_parameters(), new_masks):
+        masking.masks[name] = new_mask
 
     return int(total_removed)
 
@@ -150,16 +143,16 @@ def magnitude_and_negativity_prune(masking, mask, weight, name):
     num_remove = math.ceil(masking.name2prune_rate[name]*masking.name2nonzeros[name])
     if num_remove == 0.0: return weight.data != 0.0
 
-    num_zeros = masking.name2zeros[name]
-    k = math.ceil(num_zeros + (num_remove/2.0))
+    k = math.ceil(num_remove/2.0)
 
     # remove all weights which absolute value is smaller than threshold
-    x, idx = torch.sort(torch.abs(weight.data.view(-1)))
-    mask.data.view(-1)[idx[:k]] = 0.0
+    active = mask.data.view(-1).nonzero().view(-1)
+    _, idx = torch.topk(torch.abs(weight.data.view(-1))[active], min(k, active.numel()), largest=False)
+    mask.data.view(-1)[active[idx]] = 0.0
 
     # remove the most negative weights
-    x, idx = torch.sort(weight.data.view(-1))
-    mask.data.view(-1)[idx[:math.ceil(num_remove/2.0)]] = 0.0
+    _, idx = torch.topk(weight.data.view(-1), k, largest=False)
+    mask.data.view(-1)[idx] = 0.0
 
     return mask
 
@@ -168,22 +161,10 @@ def magnitude_and_negativity_prune(masking, mask, weight, name):
 '''
 
 def random_growth(masking, name, new_mask, total_regrowth, weight):
-    n = (new_mask==0).sum().item()
-    if n == 0: return new_mask
-    expeced_growth_probability = (total_regrowth/n)
-    new_weights = torch.rand(new_mask.shape).cuda() < expeced_growth_probability
-    return new_mask.bool() | new_weights
+    return grow([new_mask], [None], [total_regrowth])[0]
 
 def gradient_growth(masking, name, new_mask, total_regrowth, weight):
-    grad = masking.get_gradient_for_weights(weight)
-    if grad.dtype == torch.float16:
-        grad = grad * (new_mask == 0).half()
-    else:
-        grad = grad * (new_mask == 0).float()
-    y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
-    new_mask.data.view(-1)[idx[:total_regrowth]] = 1.0
-
-    return new_mask
+    return grow([new_mask], [masking.get_gradient_for_weights(weight)], [total_regrowth])[0]
 
 def momentum_growth(masking, name, new_mask, total_regrowth, weight):
     """Grows weights in places where the momentum is largest.
@@ -249,84 +230,27 @@ def momentum_growth(masking, name, new_mask, total_regrowth, weight):
         Total number of parameters removed in pruning:
             masking.total_removed = 0
     """
-    grad = masking.get_momentum_for_weight(weight)
-    if grad.dtype == torch.float16:
-        grad = grad*(new_mask==0).half()
-    else:
-        grad = grad*(new_mask==0).float()
-    y, idx = torch.sort(torch.abs(grad).flatten(), descending=True)
-    new_mask.data.view(-1)[idx[:total_regrowth]] = 1.0
-
-    return new_mask
+    return grow([new_mask], [masking.get_momentum_for_weight(weight)], [total_regrowth])[0]
 
 def momentum_neuron_growth(masking, name, new_mask, total_regrowth, weight):
-    grad = masking.get_momentum_for_weight(weight)
-
-    M = torch.abs(grad)
-    if len(M.shape) == 2: sum_dim = [1]
-    elif len(M.shape) == 4: sum_dim = [1, 2, 3]
-
-    v = M.mean(sum_dim).data
-    v /= v.sum()
-
-    slots_per_neuron = (new_mask==0).sum(sum_dim)
-
-    M = M*(new_mask==0).float()
-    for i, fraction  in enumerate(v):
-        neuron_regrowth = math.floor(fraction.item()*total_regrowth)
-        available = slots_per_neuron[i].item()
-
-        y, idx = torch.sort(M[i].flatten())
-        if neuron_regrowth > available:
-            neuron_regrowth = available
-        # TODO: Work into more stable growth method
-        threshold = y[-(neuron_regrowth)].item()
-        if threshold == 0.0: continue
-        if neuron_regrowth < 10: continue
-        new_mask[i] = new_mask[i] | (M[i] > threshold)
-
-    return new_mask
+    return neuron_growth(new_mask, masking.get_momentum_for_weight(weight), total_regrowth)
 
 
 def global_momentum_growth(masking, total_regrowth):
-    togrow = total_regrowth
-    total_grown = 0
-    last_grown = 0
-    while total_grown < togrow*(1.0-masking.tolerance) or (total_grown > togrow*(1.0+masking.tolerance)):
-        total_grown = 0
-        total_possible = 0
-        for module in masking.modules:
-            for name, weight in module.named_parameters():
-                if name not in masking.masks: continue
-
-                new_mask = masking.masks[name]
-                grad = masking.get_momentum_for_weight(weight)
-                grad = grad*(new_mask==0).float()
-                possible = (grad !=0.0).sum().item()
-                total_possible += possible
-                grown = (torch.abs(grad.data) > masking.growth_threshold).sum().item()
-                total_grown += grown
-        if total_grown == last_grown: break
-        last_grown = total_grown
-
-
-        if total_grown > togrow*(1.0+masking.tolerance):
-            masking.growth_threshold *= 1.02
-            #masking.growth_increment *= 0.95
-        elif total_grown < togrow*(1.0-masking.tolerance):
-            masking.growth_threshold *= 0.98
-            #masking.growth_increment *= 0.95
+    # regrow exactly the inactive weights with the largest momentum magnitude over all layers
+    scores = []
+    for name, weight in masking.layers.named_parameters():
+        grad = masking.get_momentum_for_weight(weight)
+        scores.append(torch.where(masking.masks[name] == 0, torch.abs(grad.data).float(), torch.full_like(grad.data, -float('inf'), dtype=torch.float)))
+    total_possible = int(sum((score != -float('inf')).sum() for score in scores))
+    new_masks, threshold = top_k_masks(scores, min(math.ceil(total_regrowth), total_possible))
+    if threshold is not None: masking.growth_threshold = threshold
 
     total_new_nonzeros = 0
-    for module in masking.modules:
-        for name, weight in module.named_parameters():
-            if name not in masking.masks: continue
-
-            new_mask = masking.masks[name]
-            grad = masking.get_momentum_for_weight(weight)
-            grad = grad*(new_mask==0).float()
-            masking.masks[name][:] = (new_mask.bool() | (torch.abs(grad.data) > masking.growth_threshold)).float()
-            total_new_nonzeros += new_mask.sum().item()
+    for (name, weight), grown in zip(masking.layers.named_parameters(), new_masks):
+        new_mask = (masking.masks[name].bool() | grown).float()
+        masking.masks[name] = new_mask
+        total_new_nonzeros += new_mask.sum().item()
     return total_new_nonzeros
 
 
@@ -349,3 +273,10 @@ redistribution_funcs['momentum'] = momentum_redistribution
 redistribution_funcs['nonzero'] = nonzero_redistribution
 redistribution_funcs['magnitude'] = magnitude_redistribution
 redistribution_funcs['none'] = no_redistribution
+
+# growth functions that Masking runs for all layers in one batched pass (see growth.grow),
+# mapped to the scores they grow by (None: random)
+batched_growth_scores = {}
+batched_growth_scores[random_growth] = lambda masking, weight: None
+batched_growth_scores[momentum_growth] = lambda masking, weight: masking.get_momentum_for_weight(weight)
+batched_growth_scores[gradient_growth] = lambda masking, weight: masking.get_gradient_for_weights(weight)
@@ -0,0 +1,109 @@
+import numpy as np
+import torch
+from selection import _keys
+
+# keys of (score, position) pairs: a 32 bit score key above 31 bits of position
+_POS_SPAN = 2**31
+
+
+def grow(masks, scores, quotas, generator=None, return_grown=False):
+    """Regrows the inactive weights with the largest |score| of every layer, without host syncs.
+
+    Per layer, each weight gets one int64 key that orders by |score| and then
+    by position (lower flat index first), active weights get -1, and a single
+    topk(quota) picks the weights to grow. The chosen entries are scattered
+    into the mask directly, so there is no .item() or nonzero() per layer, and
+    the temporary memory is a few tensors of one layer's size instead of a
+    sort over the whole model. The result is deterministic.
+
+    Args:
+        masks       Current (pruned) masks of the layers.
+        scores      Per layer a score tensor of the mask's shape (e.g. momentum
+                    or gradient), or None for random growth, which draws random
+                    scores and so picks exactly quotas[i] weights uniformly.
+        quotas      Number of weights to regrow per layer. A quota larger than
+                    the number of inactive weights regrows all of them.
+        generator   Optional torch.Generator for the random scores.
+        return_grown Also return, per layer, the flat indices the top-k picked
+                    and which of them were grown, as an (index, valid) pair
+                    (None if nothing was grown), e.g. for
+                    ExplorationTracker.update_grown.
+
+    Returns:
+        The new masks as bool tensors (and the grown indices, see return_grown).
+    """
+    new_masks, grown_indices = [], []
+    for mask, score, quota in zip(masks, scores, quotas):
+        inactive = (mask == 0).reshape(-1)
+        grown = torch.zeros_like(inactive)
+        k = min(max(int(quota), 0), inactive.numel())
+        picked = None
+        if k > 0:
+            if score is None:
+                flat = torch.rand(inactive.numel(), device=mask.device, generator=generator)
+            else:
+                flat = torch.abs(score.detach()).reshape(-1).float().to(mask.device)
+            position = torch.arange(inactive.numel() - 1, -1, -1, device=mask.device)
+            keys = torch.where(inactive, _keys(flat) * _POS_SPAN + position, torch.full_like(position, -1))
+            values, index = torch.topk(keys, k, sorted=False)
+            # a quota above the number of inactive weights picks some active ones (key -1): not grown
+            picked = (index, values >= 0)
+            grown.scatter_(0, index, picked[1])
+        new_masks.append((mask != 0) | grown.view(mask.shape))
+        grown_indices.append(picked)
+    if return_grown: return new_masks, grown_indices
+    return new_masks
+
+
+def neuron_growth(mask, score, total_regrowth, min_regrowth=10):
+    """momentum_neuron growth for all output neurons of a layer at once.
+
+    Neuron i gets a quota of floor(total_regrowth * its share of the mean
+    |score|), capped by its free slots, and regrows its inactive weights whose
+    |score| is above its quota-th largest one. Neurons with a quota below
+    min_regrowth or a zero threshold are skipped, as in the per-neuron loop.
+    One row-wise top-k replaces a sort and several .item() calls per neuron.
+    """
+    scores = torch.abs(score.detach()).reshape(score.shape[0], -1).float()
+    inactive = (mask == 0).reshape(mask.shape[0], -1)
+    share = scores.mean(1)
+    share = share / share.sum()
+    quota = torch.min(torch.floor(share * total_regrowth).long(), inactive.sum(1))
+
+    scores = scores * inactive
+    k = int(quota.max())
+    if k < min_regrowth: return mask
+    top = torch.topk(scores, k, dim=1)[0]
+    threshold = top.gather(1, (quota - 1).clamp(min=0).unsqueeze(1))
+    rows = (quota >= min_regrowth) & (threshold.squeeze(1) != 0)
+    grown = (scores > threshold) & rows.unsqueeze(1)
+    return (mask != 0) | grown.view(mask.shape)
+
+
+def water_fill(demand, capacity):
+    """Spreads the regrowth that does not fit into full layers evenly over the others.
+
+    Every layer gets min(capacity, demand + level), with one common level >= 0
+    chosen so that the total equals the total demand. This is the fixed point
+    the iterative residual loop of calc_growth_redistribution converged to,
+    solved exactly: with the gaps capacity - demand sorted, the level follows
+    from prefix sums in O(L log L).
+
+    Returns:
+        (allocation per layer as a list, residual). The residual is > 0 only if
+        the capacities cannot hold the total demand; then all layers are full.
+    """
+    demand = np.asarray(demand, dtype=np.float64)
+    capacity = np.asarray(capacity, dtype=np.float64)
+    n = len(demand)
+    if n == 0: return [], 0.0
+    gap = np.sort(capacity - demand)
+    prefix = np.concatenate([[0.0], np.cumsum(gap)])
+    # with the k smallest gaps filled up, the level for the n-k other layers is -prefix[k]/(n-k)
+    k = np.arange(n)
+    level = -prefix[:n] / (n - k)
+    below = np.concatenate([[-np.inf], gap[:-1]])
+    valid = (level >= below) & (level <= gap)
+    if not valid.any():
+        return capacity.tolist(), float(-prefix[n])
+    return np.minimum(capacity, demand + level[np.argmax(valid)]).tolist(), 0.0
@@ -0,0 +1,92 @@
+from __future__ import print_function
+
+import argparse
+import io
+import os
+import time
+
+import torch
+import torch.utils.data
+import torchvision.transforms as transforms
+import torchvision.datasets as datasets
+from PIL import Image
+
+from collate import get_collate, is_nhwc
+
+
+class SyntheticJPEGs(torch.utils.data.Dataset):
+    """Random JPEGs decoded on access, for timing the loader without ImageNet on disk."""
+    def __init__(self, n, size, transform):
+        self.transform = transform
+        self.files = []
+        for i in range(min(n, 64)):
+            pixels = torch.randint(0, 256, (size, size, 3), dtype=torch.uint8).numpy()
+            buffer = io.BytesIO()
+            Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+            self.files.append(buffer.getvalue())
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        img = Image.open(io.BytesIO(self.files[index % len(self.files)])).convert('RGB')
+        return self.transform(img), index % 1000
+
+
+def build_dataset(args):
+    transform = transforms.Compose([transforms.RandomResizedCrop(224), transforms.RandomHorizontalFlip()])
+    if args.data is None:
+        return SyntheticJPEGs(args.batch_size * (args.batches + args.warmup) * 2, 375, transform)
+    return datasets.ImageFolder(os.path.join(args.data, 'train'), transform)
+
+
+def build_loader(dataset, collate, workers, args):
+    collate_fn, pin_memory = get_collate(workers, nhwc=(collate == 'nhwc'))
+    return torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=workers,
+                                       pin_memory=pin_memory and torch.cuda.is_available(),
+                                       collate_fn=collate_fn, drop_last=True)
+
+
+def to_device(input, loader, device):
+    # what prefetched_loader does with a batch, without the normalization
+    input = input.to(device, non_blocking=True)
+    if is_nhwc(loader): input = input.permute(0, 3, 1, 2)
+    return input.float()
+
+
+def bench_loader(args, device):
+    dataset = build_dataset(args)
+    print('{:>6} {:>8} {:>12} {:>18}'.format('collate', 'workers', 'images/s', 'images/s/worker'))
+    for workers in args.workers:
+        for collate in args.collates:
+            loader = build_loader(dataset, collate, workers, args)
+            batches = iter(loader)
+            for _ in range(args.warmup):
+                to_device(next(batches)[0], loader, device)
+            if device.type == 'cuda': torch.cuda.synchronize()
+            start = time.time()
+            for _ in range(args.batches):
+                to_device(next(batches)[0], loader, device)
+            if device.type == 'cuda': torch.cuda.synchronize()
+            rate = args.batches * args.batch_size / (time.time() - start)
+            print('{:>6} {:>8} {:>12.1f} {:>18.1f}'.format(collate, workers, rate, rate / max(workers, 1)))
+            del batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ImageNet loader throughput')
+    parser.add_argument('--data', default=None, type=str, help='ImageNet root with a train/ folder (default: synthetic JPEGs)')
+    parser.add_argument('--no-cuda', action='store_true', default=False, help='do not copy the batches to the GPU')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--batches', type=int, default=50, help='timed batches per measurement')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed batches per measurement')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--collates', nargs='+', default=['fast', 'nhwc'], choices=['fast', 'nhwc'])
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.no_cuda else 'cpu')
+    bench_loader(args, device)
+
+
+if __name__ == '__main__':
+    main()
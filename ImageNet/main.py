@@ -30,6 +30,11 @@ except ImportError:
     raise ImportError("Please install apex from https://www.github.com/nvidia/apex to run this example.")
 
 import resnet as models
+from collate import get_collate, is_nhwc
+from shards import ShardDataset, ShardSampler
+from eval_cache import EvalCache
+from prefetch import Prefetcher
+from sparse_allreduce import register_sparse_allreduce
 from smoothing import LabelSmoothing
 
 def add_parser_arguments(parser):
@@ -53,6 +58,16 @@ def add_parser_arguments(parser):
                         ' | '.join(model_configs) + '(default: classic)')
     parser.add_argument('-j', '--workers', default=5, type=int, metavar='N',
                         help='number of data loading workers (default: 5)')
+    parser.add_argument('--shards', default=None, type=str, metavar='DIR',
+                        help='read train/val from the memory-mapped shards in DIR (see shards.py) instead of DIR/train, DIR/val')
+    parser.add_argument('--eval-cache', default=None, type=str, metavar='DIR',
+                        help='cache the center-cropped validation images in DIR on the first pass and read them from there')
+    parser.add_argument('--prefetch', default=2, type=int, metavar='N',
+                        help='batches copied to the GPU and normalized ahead by a background thread (0: inline)')
+    parser.add_argument('--sparse-allreduce', action='store_true',
+                        help='use torch DDP and all-reduce only the gradients of active weights (dense before topology updates)')
+    parser.add_argument('--nhwc-collate', action='store_true',
+                        help='collate into reusable NHWC uint8 buffers and go to NCHW (channels_last) on the GPU')
     parser.add_argument('--spp', action='store_true',
                         help='flag to switch another grow initialization')
     parser.add_argument('--epochs', default=90, type=int, metavar='N',
@@ -183,15 +198,18 @@ def train_net(args, logger_cls):
             best_prec1 = checkpoint['best_prec1']
             model_state = checkpoint['state_dict']
             optimizer_state = checkpoint['optimizer']
+            mask_state = checkpoint.get('masks')
             print("=> loaded checkpoint '{}' (epoch {}) with acc {}"
                   .format(args.resume, checkpoint['epoch'], best_prec1))
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
             model_state = None
             optimizer_state = None
+            mask_state = None
     else:
         model_state = None
         optimizer_state = None
+        mask_state = None
 
     model_and_loss = ModelAndLoss(args,
             (args.arch, args.model_config),
@@ -212,13 +230,14 @@ def train_net(args, logger_cls):
                 dynamic_loss_scale = args.dynamic_loss_scale)
 
 
-        train_loader = get_train_loader(args.data, args.batch_size, workers=args.workers, _worker_init_fn=_worker_init_fn)
+        train_loader = get_train_loader(args.data, args.batch_size, workers=args.workers, _worker_init_fn=_worker_init_fn, nhwc=args.nhwc_collate, shards=args.shards)
         train_loader_len = len(train_loader)
     else:
         train_loader_len = 0
 
     if not args.trainbench:
-        val_loader = get_val_loader(args.data, args.batch_size, workers=args.workers, _worker_init_fn=_worker_init_fn)
+        val_loader = get_val_loader(args.data, args.batch_size, workers=args.workers, _worker_init_fn=_worker_init_fn, nhwc=args.nhwc_collate, shards=args.shards,
+                                    eval_cache=args.eval_cache)
         val_loader_len = len(val_loader)
     else:
         val_loader_len = 0
@@ -230,6 +249,13 @@ def train_net(args, logger_cls):
 
     if not args.dense:
         mask.add_module(model_and_loss.model, sparse_init=args.sparse_init, density=args.density)
+        if mask_state is not None:
+            print('=> restoring masks from checkpoint')
+            mask.masks.load_state_dict(mask_state)
+            mask.apply_mask()
+            mask.exploration.update(mask.masks)
+        if args.distributed and args.sparse_allreduce:
+            model_and_loss.allreduce = register_sparse_allreduce(model_and_loss.model, mask.masks)
 
     if args.scale:
         print('scale the initialization')
@@ -324,6 +350,7 @@ class ModelAndLoss(nn.Module):
         super(ModelAndLoss, self).__init__()
         self.arch = arch
         self.mask = None
+        self.allreduce = None
 
 
         print("=> creating model '{}'".format(arch))
@@ -338,7 +365,11 @@ class ModelAndLoss(nn.Module):
             model = network_to_half(model)
         if distributed:
             # model = DDP(model, device_ids=[args.local_rank]) # for Pytorch DDP
-            model = DDP(model)
+            if args.sparse_allreduce:
+                # comm hooks need the PyTorch DDP
+                model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+            else:
+                model = DDP(model)
 
         if not state is None:
             new_state = {}
@@ -368,7 +399,7 @@ def train_loop(args, model_and_loss, optimizer, lr_scheduler, train_loader, val_
                best_prec1 = 0, start_epoch = 0, prof = False):
     update_iter = 0
     for epoch in range(start_epoch, epochs):
-        if torch.distributed.is_initialized():
+        if hasattr(train_loader.sampler, 'set_epoch'):
             train_loader.sampler.set_epoch(epoch)
 
         lr_scheduler(optimizer, epoch)
@@ -391,94 +422,66 @@ def train_loop(args, model_and_loss, optimizer, lr_scheduler, train_loader, val_
                 'state_dict': model_and_loss.model.state_dict(),
                 'best_prec1': best_prec1,
                 'optimizer' : optimizer.state_dict(),
+                'masks': None if args.dense else model_and_loss.mask.masks.state_dict(),
             }, is_best)
 
 # }}}
 
 # Data Loading functions {{{
-def fast_collate(batch):
-    imgs = [img[0] for img in batch]
-    targets = torch.tensor([target[1] for target in batch], dtype=torch.int64)
-    w = imgs[0].size[0]
-    h = imgs[0].size[1]
-    tensor = torch.zeros( (len(imgs), 3, h, w), dtype=torch.uint8 )
-    for i, img in enumerate(imgs):
-        nump_array = np.asarray(img, dtype=np.uint8)
-        # tens = torch.from_numpy(nump_array)
-        if(nump_array.ndim < 3):
-            nump_array = np.expand_dims(nump_array, axis=-1)
-        nump_array = np.rollaxis(nump_array, 2)
-        nump_array_copy = np.copy(nump_array)
-        tensor[i] += torch.from_numpy(nump_array_copy)
-
-    return tensor, targets
-
-
 def prefetched_loader(loader, fp16):
-    mean = torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255]).cuda().view(1,3,1,1)
-    std = torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255]).cuda().view(1,3,1,1)
-    if fp16:
-        mean = mean.half()
-        std = std.half()
-
-    stream = torch.cuda.Stream()
-    first = True
-
-    for next_input, next_target in loader:
-        with torch.cuda.stream(stream):
-            next_input = next_input.cuda(non_blocking=True)
-            next_target = next_target.cuda(non_blocking=True)
-            if fp16:
-                next_input = next_input.half()
-            else:
-                next_input = next_input.float()
-            next_input = next_input.sub_(mean).div_(std)
-
-        if not first:
-            yield input, target
-        else:
-            first = False
-
-        torch.cuda.current_stream().wait_stream(stream)
-        input = next_input
-        target = next_target
-
-    yield input, target
+    return Prefetcher(loader, torch.device('cuda'), depth=args.prefetch,
+                      mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225),
+                      dtype=torch.half if fp16 else None, nhwc=is_nhwc(loader))
 
 
-def get_train_loader(data_path, batch_size, workers=5, _worker_init_fn=None):
+def get_train_loader(data_path, batch_size, workers=5, _worker_init_fn=None, nhwc=False, shards=None):
     traindir = os.path.join(data_path, 'train')
-    train_dataset = datasets.ImageFolder(
-        traindir,
-        transforms.Compose([
+    train_transform = transforms.Compose([
             transforms.RandomResizedCrop(224),
             transforms.RandomHorizontalFlip(),
             #transforms.ToTensor(), Too slow
             #normalize,
-        ]))
+        ])
 
-    if torch.distributed.is_initialized():
+    if shards is not None:
+        train_dataset = ShardDataset(shards, 'train', train_transform)
+        train_sampler = ShardSampler(train_dataset)
+    elif torch.distributed.is_initialized():
+        train_dataset = datasets.ImageFolder(traindir, train_transform)
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
     else:
+        train_dataset = datasets.ImageFolder(traindir, train_transform)
         train_sampler = None
 
+    collate_fn, pin_memory = get_collate(workers, nhwc)
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=batch_size, shuffle=(train_sampler is None),
-        num_workers=workers, worker_init_fn=_worker_init_fn, pin_memory=True, sampler=train_sampler, collate_fn=fast_collate, drop_last=True)
+        num_workers=workers, worker_init_fn=_worker_init_fn, pin_memory=pin_memory, sampler=train_sampler, collate_fn=collate_fn, drop_last=True)
 
     return train_loader
 
-def get_val_loader(data_path, batch_size, workers=5, _worker_init_fn=None):
+def get_val_loader(data_path, batch_size, workers=5, _worker_init_fn=None, nhwc=False, shards=None, eval_cache=None):
     valdir = os.path.join(data_path, 'val')
-
-    val_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(valdir, transforms.Compose([
+    collate_fn, pin_memory = get_collate(workers, nhwc)
+    if shards is not None:
+        # Resize(256) is a no-op for shards converted with --size 256
+        val_dataset = ShardDataset(shards, 'val', transforms.Compose([
+            transforms.Resize(256),
+            transforms.CenterCrop(224),
+        ]))
+    else:
+        val_dataset = datasets.ImageFolder(valdir, transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(224),
-        ])),
+        ]))
+    if eval_cache is not None:
+        return EvalCache(val_dataset, eval_cache, batch_size, workers=workers)
+
+    val_loader = torch.utils.data.DataLoader(
+        val_dataset,
         batch_size=batch_size, shuffle=False,
-        num_workers=workers, worker_init_fn=_worker_init_fn, pin_memory=True,
-        collate_fn=fast_collate)
+        num_workers=workers, worker_init_fn=_worker_init_fn, pin_memory=pin_memory,
+        collate_fn=collate_fn)
 
     return val_loader
 # }}}
@@ -543,12 +546,16 @@ def train(train_loader, model_and_loss, optimizer, fp16, logger, epoch, prof=Fal
     model_and_loss.model.train()
     end = time.time()
 
-    for i, (input, target) in enumerate(prefetched_loader(train_loader, fp16)):
+    loader = prefetched_loader(train_loader, fp16)
+    for i, (input, target) in enumerate(loader):
         data_time = time.time() - end
         if prof:
             if i > 10:
                 break
 
+        if model_and_loss.allreduce is not None:
+            # dense gradients for the step right before a topology update
+            model_and_loss.allreduce.dense = not args.fix and (update_iter + 1) % args.update_frequency == 0
         loss, prec1, prec5 = step(input, target)
 
         logger.train_iter_callback(epoch, i,
@@ -564,6 +571,8 @@ def train(train_loader, model_and_loss, optimizer, fp16, logger, epoch, prof=Fal
         update_iter += 1
         if update_iter % args.update_frequency == 0 and not args.fix and not args.dense:
             model_and_loss.mask.at_end_of_epoch()
+    print(loader.summary())
+    if model_and_loss.allreduce is not None: print(model_and_loss.allreduce.summary())
     logger.train_epoch_callback(epoch)
 
 
@@ -0,0 +1,108 @@
+import torch
+import torch.distributed as dist
+from mask_sync import pack_bucket
+from mask_store import unpack_bits
+
+# indices below 2**35 take at most 5 varint bytes
+_MAX_BYTES = 5
+
+
+def encode_varint(values):
+    """LEB128 varint encoding of a 1D tensor of non-negative int64 values, vectorized: returns uint8 bytes."""
+    device = values.device
+    if values.numel() == 0: return torch.zeros(0, dtype=torch.uint8, device=device)
+    lengths = torch.ones_like(values)
+    for k in range(1, _MAX_BYTES):
+        lengths += (values >> (7 * k)) > 0
+    starts = torch.cumsum(lengths, 0) - lengths
+    out = torch.empty(int(lengths.sum()), dtype=torch.uint8, device=device)
+    for k in range(_MAX_BYTES):
+        has = lengths > k
+        if not bool(has.any()): break
+        byte = (values[has] >> (7 * k)) & 0x7f
+        more = (lengths[has] > k + 1).long() << 7
+        out[starts[has] + k] = (byte | more).to(torch.uint8)
+    return out
+
+
+def decode_varint(data, count):
+    """Inverse of encode_varint for count values."""
+    device = data.device
+    if count == 0: return torch.zeros(0, dtype=torch.long, device=device)
+    data = data.long()
+    last = (data & 0x80) == 0
+    # value id of every byte and its position inside the value
+    value = torch.cumsum(last.long(), 0) - last.long()
+    first = torch.ones_like(last)
+    first[1:] = last[:-1]
+    starts = torch.nonzero(first).squeeze(1)
+    shift = 7 * (torch.arange(data.numel(), device=device) - starts[value])
+    out = torch.zeros(count, dtype=torch.long, device=device)
+    return out.index_add_(0, value, (data & 0x7f) << shift)
+
+
+def _deltas(index):
+    # sorted indices -> first index, then gaps (all >= 0)
+    if index.numel() == 0: return index
+    return torch.cat([index[:1], index[1:] - index[:-1]])
+
+
+class MaskDelta(object):
+    """Distributes a topology update computed on one rank as the indices it changed.
+
+    The source rank takes a snapshot of the masks before its update and sends
+    the difference afterwards: per layer the sorted flat indices of the
+    removed and of the grown weights, delta- and varint-coded into one byte
+    stream. The message is a header of 2 counts per layer plus the stream,
+    i.e. two broadcasts whose size scales with the number of changed
+    connections instead of the model size. The other ranks apply the indices
+    to their own masks in place. A few extra integers (e.g. the statistics
+    of the update) can ride along in the header.
+    """
+    def __init__(self, src=0):
+        self.src = src
+
+    def is_src(self):
+        return dist.get_rank() == self.src
+
+    def snapshot(self, masks):
+        return list(masks), pack_bucket(masks, list(masks))
+
+    def send(self, masks, snapshot, extra=()):
+        names, before = snapshot
+        counts, streams, start = [], [], 0
+        for name in names:
+            shape = masks.shape(name)
+            size = (shape.numel() + 7) // 8
+            old = unpack_bits(before[start:start + size], shape, dtype=torch.bool).view(-1)
+            start += size
+            new = (masks[name] != 0).view(-1)
+            removed = torch.nonzero(old & ~new).squeeze(1)
+            grown = torch.nonzero(new & ~old).squeeze(1)
+            counts += [removed.numel(), grown.numel()]
+            streams += [_deltas(removed), _deltas(grown)]
+        payload = encode_varint(torch.cat(streams))
+        header = torch.tensor(counts + [int(value) for value in extra] + [payload.numel()], dtype=torch.long, device=payload.device)
+        dist.broadcast(header, src=self.src)
+        dist.broadcast(payload, src=self.src)
+        return int(payload.numel())
+
+    def receive(self, masks, extra=0):
+        """Applies the update of the source rank to masks; returns the extra integers it sent along."""
+        names = list(masks)
+        device = masks.device
+        header = torch.zeros(2 * len(names) + extra + 1, dtype=torch.long, device=device)
+        dist.broadcast(header, src=self.src)
+        header = header.tolist()
+        payload = torch.empty(header[-1], dtype=torch.uint8, device=device)
+        dist.broadcast(payload, src=self.src)
+        counts, values = header[:2 * len(names)], header[2 * len(names):-1]
+        indices = decode_varint(payload, sum(counts)).split(counts)
+        for i, name in enumerate(names):
+            removed, grown = torch.cumsum(indices[2 * i], 0), torch.cumsum(indices[2 * i + 1], 0)
+            if removed.numel() == 0 and grown.numel() == 0: continue
+            mask = masks[name].clone().view(-1)
+            mask[removed] = 0
+            mask[grown] = 1
+            masks[name] = mask.view(masks.shape(name))
+        return values
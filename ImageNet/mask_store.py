@@ -0,0 +1,141 @@
+import torch
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+_BIT_WEIGHTS = [128, 64, 32, 16, 8, 4, 2, 1]
+_POPCOUNT = [bin(i).count('1') for i in range(256)]
+_tables = {}
+
+
+def _table(values, device):
+    key = (tuple(values), str(device))
+    if key not in _tables:
+        _tables[key] = torch.tensor(values, dtype=torch.uint8, device=device)
+    return _tables[key]
+
+
+def pack_bits(mask):
+    """Packs the nonzero pattern of a tensor into a flat uint8 tensor, 1 bit per element."""
+    flat = (mask.reshape(-1) != 0).to(torch.uint8)
+    pad = (-flat.numel()) % 8
+    if pad:
+        flat = torch.cat([flat, flat.new_zeros(pad)])
+    weights = _table(_BIT_WEIGHTS, flat.device)
+    return (flat.view(-1, 8) * weights).sum(1).to(torch.uint8)
+
+
+def unpack_bits(bits, shape, dtype=torch.float32):
+    """Inverse of pack_bits: returns a tensor of the given shape filled with 0/1."""
+    numel = torch.Size(shape).numel()
+    weights = _table(_BIT_WEIGHTS, bits.device)
+    flat = (bits.unsqueeze(1) & weights).ne(0).view(-1)[:numel]
+    return flat.reshape(shape).to(dtype)
+
+
+def popcount(bits):
+    """Number of set bits in a packed uint8 tensor (as a 0-dim device tensor)."""
+    return _table(_POPCOUNT, bits.device)[bits.long()].sum()
+
+
+def masked_mul_(tensors, masks):
+    """In-place tensors[i] *= masks[i], as one multi-tensor kernel when torch has foreach ops."""
+    if len(tensors) == 0: return
+    with torch.no_grad():
+        if hasattr(torch, '_foreach_mul_'):
+            torch._foreach_mul_(tensors, masks)
+        else:
+            for tensor, mask in zip(tensors, masks):
+                tensor.mul_(mask)
+
+
+class MaskStore(MutableMapping):
+    """Ordered name -> binary mask mapping used as Masking.masks.
+
+    Reading a mask returns a float32 tensor of the layer's shape, so the
+    existing masking code can use it as before. Masks must be written back
+    with `store[name] = mask`; every write bumps `version`, and writes that
+    add or remove a name also bump `keys_version`.
+
+    With packed=True only 1 bit per weight is kept and masks are unpacked on
+    access, which cuts mask memory 32x compared to float32 masks at the cost
+    of an unpack per read. With packed=False the dense float32 masks are kept
+    as well and reads are free.
+
+    state_dict()/load_state_dict() always use the packed format, which keeps
+    masks in checkpoints small in both modes.
+    """
+    def __init__(self, device=None, packed=False):
+        self.device = device
+        self.packed = packed
+        self.version = 0
+        self.keys_version = 0
+        self._masks = OrderedDict()
+        self._shapes = {}
+
+    def __setitem__(self, name, mask):
+        mask = mask.detach()
+        if self.device is not None:
+            mask = mask.to(self.device)
+        if name not in self._masks: self.keys_version += 1
+        self._shapes[name] = mask.shape
+        if self.packed:
+            self._masks[name] = pack_bits(mask)
+        else:
+            self._masks[name] = (mask != 0).float()
+        self.version += 1
+
+    def __getitem__(self, name):
+        if self.packed:
+            return unpack_bits(self._masks[name], self._shapes[name])
+        return self._masks[name]
+
+    def __delitem__(self, name):
+        del self._masks[name]
+        del self._shapes[name]
+        self.version += 1
+        self.keys_version += 1
+
+    def __iter__(self):
+        return iter(self._masks)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __contains__(self, name):
+        return name in self._masks
+
+    def shape(self, name):
+        return self._shapes[name]
+
+    def numel(self, name):
+        return self._shapes[name].numel()
+
+    def raw(self, name):
+        """The stored tensor itself (packed bits or dense mask), e.g. for in-place collectives."""
+        return self._masks[name]
+
+    def nonzeros(self, name):
+        if self.packed:
+            return int(popcount(self._masks[name]).item())
+        return int(self._masks[name].sum().item())
+
+    def memory_bytes(self):
+        return sum(t.numel() * t.element_size() for t in self._masks.values())
+
+    def state_dict(self):
+        state = OrderedDict()
+        for name, stored in self._masks.items():
+            bits = stored if self.packed else pack_bits(stored)
+            state[name] = {'shape': tuple(self._shapes[name]), 'bits': bits.cpu()}
+        return state
+
+    def load_state_dict(self, state):
+        for name, entry in state.items():
+            shape = torch.Size(entry['shape'])
+            bits = entry['bits']
+            if self.device is not None:
+                bits = bits.to(self.device)
+            self._shapes[name] = shape
+            self._masks[name] = bits if self.packed else unpack_bits(bits, shape)
+        self.version += 1
+        self.keys_version += 1
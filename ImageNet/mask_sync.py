@@ -0,0 +1,64 @@
+import torch
+import torch.distributed as dist
+from mask_store import pack_bits, unpack_bits
+
+
+def pack_bucket(masks, names):
+    """All masks as one flat uint8 tensor of packed bits, layer after layer."""
+    return torch.cat([masks.raw(name) if masks.packed else pack_bits(masks.raw(name)) for name in names])
+
+
+def unpack_bucket(masks, names, bucket):
+    """Inverse of pack_bucket: writes the masks in the bucket back into masks."""
+    start = 0
+    for name in names:
+        shape = masks.shape(name)
+        size = (shape.numel() + 7) // 8
+        bits = bucket[start:start + size]
+        masks[name] = unpack_bits(bits, shape)
+        start += size
+
+
+def checksum(bucket):
+    """Cheap position-sensitive checksum of a packed bucket, as a 0-dim int64 tensor on its device."""
+    weights = torch.arange(bucket.numel(), device=bucket.device) % 65521 + 1
+    return (bucket.long() * weights).sum()
+
+
+class MaskSync(object):
+    """Keeps the masks identical on all ranks with one collective per topology change.
+
+    sync(version) broadcasts all masks of rank src as a single packed-bit
+    bucket (1 bit per weight) when version differs from the last synced one,
+    and does nothing otherwise, so steps without a topology update have no
+    mask communication at all. Every check_every steps, check() all-reduces a
+    checksum of the local masks (one 2-element collective) and re-syncs all
+    ranks if they diverged.
+    """
+    def __init__(self, masks, src=0, check_every=None):
+        self.masks = masks
+        self.src = src
+        self.check_every = check_every
+        self.synced_version = None
+
+    def sync(self, version, force=False):
+        if not force and version == self.synced_version: return False
+        names = list(self.masks)
+        bucket = pack_bucket(self.masks, names)
+        dist.broadcast(bucket, src=self.src)
+        if dist.get_rank() != self.src:
+            unpack_bucket(self.masks, names, bucket)
+        self.synced_version = version
+        return True
+
+    def check(self, step):
+        """Returns True if the masks had diverged (they are re-synced then)."""
+        if not self.check_every or step % self.check_every != 0: return False
+        local = checksum(pack_bucket(self.masks, list(self.masks)))
+        # max(c) == -max(-c) iff all ranks have the same checksum
+        both = torch.stack([local, -local])
+        dist.all_reduce(both, op=dist.ReduceOp.MAX)
+        if int(both[0]) == -int(both[1]): return False
+        print('Masks diverged across ranks at step {0}, re-broadcasting the masks of rank {1}.'.format(step, self.src))
+        self.sync(self.synced_version, force=True)
+        return True
@@ -0,0 +1,143 @@
+import queue
+import threading
+import time
+import torch
+
+
+class _Raised(object):
+    def __init__(self, error):
+        self.error = error
+
+
+def background(iterable, depth):
+    """Runs iterable in a daemon thread, keeping up to depth items ready.
+
+    An exception of the iterable is raised in the consumer. If the consumer
+    stops early (break, or the generator is closed), the thread stops after
+    its current item instead of blocking on the full queue forever.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item): return
+        except Exception as error:
+            put(_Raised(error))
+            return
+        put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is done: return
+            if isinstance(item, _Raised): raise item.error
+            yield item
+    finally:
+        stop.set()
+
+
+class Prefetcher(object):
+    """Moves the batches of a loader to the device and prepares them there, depth batches ahead.
+
+    A background thread takes the batches from the loader, copies them to the
+    device (on a side CUDA stream when the device is a GPU, so the copies
+    overlap with compute) and prepares them there: uint8 images are scaled
+    and normalized with mean/std in one multiply-add, NHWC batches become
+    channels_last NCHW views, and the images are optionally cast to dtype or
+    made channels_last. Float batches are taken as already normalized. With
+    depth 0 the batches are prepared inline, without a thread.
+
+    The time the consumer spent waiting for the next batch is kept in wait
+    (seconds, for the current or last pass) and reported by summary().
+
+    Args:
+        loader          Iterable of (input, target) batches, e.g. a DataLoader.
+        device          Device the batches are moved to.
+        depth           Number of batches prepared ahead (0: none).
+        mean, std       Per-channel normalization of uint8 batches, in [0, 1] units.
+        channels_last   Return the images in channels_last memory format.
+        dtype           Cast the images to this dtype (e.g. torch.half).
+        nhwc            The loader's images are (N, H, W, C) (see collate.NHWCCollate).
+    """
+    def __init__(self, loader, device, depth=2, mean=(0.0,), std=(1.0,), channels_last=False, dtype=None, nhwc=False):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.channels_last = channels_last or nhwc
+        self.dtype = dtype
+        self.nhwc = nhwc
+        mean = torch.tensor(mean, dtype=torch.float32)
+        std = torch.tensor(std, dtype=torch.float32)
+        # (x/255 - mean)/std as x*scale + shift
+        self.scale = (1.0 / (255.0 * std)).view(1, -1, 1, 1).to(self.device)
+        self.shift = (-mean / std).view(1, -1, 1, 1).to(self.device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.wait = 0.0
+        self.batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _prepare(self, input, target):
+        input = input.to(self.device, non_blocking=True)
+        target = target.to(self.device, non_blocking=True)
+        if self.nhwc:
+            # NHWC batch -> NCHW view in channels_last memory format, no copy
+            input = input.permute(0, 3, 1, 2)
+        if input.dtype == torch.uint8:
+            input = torch.addcmul(self.shift, input.float(), self.scale)
+        if self.dtype is not None:
+            input = input.to(self.dtype)
+        if self.channels_last and input.dim() == 4:
+            input = input.contiguous(memory_format=torch.channels_last)
+        return input, target
+
+    def _prepared(self):
+        for input, target in self.loader:
+            if self.stream is None:
+                yield self._prepare(input, target), None
+                continue
+            with torch.cuda.device(self.device), torch.cuda.stream(self.stream):
+                batch = self._prepare(input, target)
+                ready = torch.cuda.Event()
+                ready.record(self.stream)
+            yield batch, ready
+
+    def __iter__(self):
+        self.wait, self.batches = 0.0, 0
+        batches = self._prepared() if self.depth <= 0 else background(self._prepared(), self.depth)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    (input, target), ready = next(batches)
+                except StopIteration:
+                    return
+                self.wait += time.time() - start
+                self.batches += 1
+                if ready is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(ready)
+                    # the batch was allocated on the side stream but is used on this one
+                    input.record_stream(current)
+                    target.record_stream(current)
+                yield input, target
+        finally:
+            batches.close()
+
+    def summary(self):
+        return 'Data wait: {:.2f}s over {} batches ({:.2f} ms/batch)'.format(
+            self.wait, self.batches, 1000.0 * self.wait / max(self.batches, 1))
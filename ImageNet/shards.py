@@ -0,0 +1,222 @@
+"""Pre-decoded, memory-mapped ImageNet shards.
+
+Converting once:
+
+    python shards.py /data/imagenet /data/imagenet-shards --split train --size 256
+    python shards.py /data/imagenet /data/imagenet-shards --split val --size 256
+
+packs the ImageFolder tree <src>/<split> into a few large sequential files in
+<dst>, so an epoch reads a handful of big files with mmap instead of ~1.3M
+small JPEGs, and (raw format) does no JPEG decoding at all.
+
+Formats:
+    raw     Every image is resized to --size on its short side and center
+            cropped to size x size, stored as uint8 HWC records. With size 256
+            this is exactly what the val transform Resize(256) +
+            CenterCrop(224) starts from; for training, RandomResizedCrop then
+            draws its crops from the central square instead of the full image.
+    jpeg    Short side resized to --size, aspect ratio kept, re-encoded with
+            --quality. Much smaller than raw, still a decode per image, but of
+            a small JPEG read sequentially.
+
+Layout of <dst>:
+    index.json              per split: format, record shape, number of images,
+                            classes and the shard files with their first index
+    <split>.labels.npy      int64 label of every image
+    <split>_00000.npy ...   raw shards, .npy arrays (count, size, size, 3) uint8
+    <split>_00000.jpg ...   jpeg shards: concatenated JPEG files, plus
+    <split>_00000.off.npy   their byte offsets (count + 1)
+"""
+import argparse
+import functools
+import io
+import json
+import math
+import os
+
+import numpy as np
+import torch
+import torch.utils.data
+import torchvision.datasets as datasets
+import torchvision.transforms as transforms
+from PIL import Image
+
+
+def _raw_record(img, size):
+    img = transforms.functional.resize(img, size)
+    return np.asarray(transforms.functional.center_crop(img, size), dtype=np.uint8)
+
+
+def _jpeg_record(img, size, quality):
+    buffer = io.BytesIO()
+    transforms.functional.resize(img, size).save(buffer, format='JPEG', quality=quality)
+    return np.frombuffer(buffer.getvalue(), dtype=np.uint8)
+
+
+def _identity(sample):
+    return sample
+
+
+def convert(src, dst, split, size=256, fmt='raw', quality=90, shard_size=8192, workers=8):
+    """Packs the ImageFolder <src>/<split> into shards in dst and records them in dst/index.json."""
+    os.makedirs(dst, exist_ok=True)
+    transform = functools.partial(_raw_record, size=size) if fmt == 'raw' else \
+        functools.partial(_jpeg_record, size=size, quality=quality)
+    folder = datasets.ImageFolder(os.path.join(src, split), transform)
+    n = len(folder.samples)
+    labels = np.array([target for _, target in folder.samples], dtype=np.int64)
+    np.save(os.path.join(dst, '{}.labels.npy'.format(split)), labels)
+
+    # decode in parallel, write sequentially
+    images = iter(torch.utils.data.DataLoader(folder, batch_size=None, shuffle=False, num_workers=workers,
+                                              collate_fn=_identity))
+
+    shards = []
+    for shard, start in enumerate(range(0, n, shard_size)):
+        count = min(shard_size, n - start)
+        name = '{}_{:05d}'.format(split, shard)
+        if fmt == 'raw':
+            records = np.lib.format.open_memmap(os.path.join(dst, name + '.npy'), mode='w+', dtype=np.uint8,
+                                                shape=(count, size, size, 3))
+            for i in range(count):
+                records[i] = next(images)[0]
+            records.flush()
+            del records
+            shards.append({'file': name + '.npy', 'start': start, 'count': count})
+        else:
+            offsets = np.zeros(count + 1, dtype=np.int64)
+            with open(os.path.join(dst, name + '.jpg'), 'wb') as f:
+                for i in range(count):
+                    data = next(images)[0]
+                    f.write(data.tobytes())
+                    offsets[i + 1] = offsets[i] + len(data)
+            np.save(os.path.join(dst, name + '.off.npy'), offsets)
+            shards.append({'file': name + '.jpg', 'offsets': name + '.off.npy', 'start': start, 'count': count})
+        print('{}: shard {} / {} written'.format(split, shard + 1, int(math.ceil(n / float(shard_size)))))
+
+    index_path = os.path.join(dst, 'index.json')
+    index = json.load(open(index_path)) if os.path.exists(index_path) else {}
+    index[split] = {'format': fmt, 'size': size, 'length': n, 'classes': folder.classes,
+                    'labels': '{}.labels.npy'.format(split), 'shards': shards}
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=1)
+
+
+class ShardDataset(torch.utils.data.Dataset):
+    """Map-style dataset over the shards of one split, returning (PIL image, label) like ImageFolder.
+
+    The shard files are memory mapped lazily, i.e. once in every DataLoader
+    worker, and pages are read by the OS as the records are touched.
+    """
+    def __init__(self, root, split, transform=None):
+        with open(os.path.join(root, 'index.json')) as f:
+            meta = json.load(f)[split]
+        self.root = root
+        self.transform = transform
+        self.format = meta['format']
+        self.size = meta['size']
+        self.classes = meta['classes']
+        self.shards = meta['shards']
+        self.starts = np.array([shard['start'] for shard in self.shards], dtype=np.int64)
+        self.targets = np.load(os.path.join(root, meta['labels']))
+        self._maps = None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def _open(self):
+        maps = []
+        for shard in self.shards:
+            path = os.path.join(self.root, shard['file'])
+            if self.format == 'raw':
+                maps.append(np.load(path, mmap_mode='r'))
+            else:
+                maps.append((np.memmap(path, dtype=np.uint8, mode='r'),
+                             np.load(os.path.join(self.root, shard['offsets']))))
+        self._maps = maps
+
+    def shard_of(self, index):
+        return int(np.searchsorted(self.starts, index, side='right')) - 1
+
+    def __getitem__(self, index):
+        if self._maps is None: self._open()
+        shard = self.shard_of(index)
+        i = index - self.shards[shard]['start']
+        if self.format == 'raw':
+            img = Image.fromarray(np.asarray(self._maps[shard][i]))
+        else:
+            data, offsets = self._maps[shard]
+            img = Image.open(io.BytesIO(data[offsets[i]:offsets[i + 1]])).convert('RGB')
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(self.targets[index])
+
+    def __getstate__(self):
+        # workers map the files themselves
+        state = self.__dict__.copy()
+        state['_maps'] = None
+        return state
+
+
+class ShardSampler(torch.utils.data.Sampler):
+    """Shard-level shuffle plus a shuffle inside every shard, split over the ranks like DistributedSampler.
+
+    Every epoch (set_epoch) the shard order and the order inside every shard
+    are drawn from seed + epoch, identically on all ranks. The resulting
+    sequence is padded to a multiple of num_replicas and every rank takes a
+    contiguous part of it, so a rank only touches the pages of a few shards at
+    a time. Without shuffle the indices are in storage order.
+    """
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = int(math.ceil(len(dataset) / float(num_replicas)))
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _order(self):
+        if not self.shuffle:
+            return np.arange(len(self.dataset))
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = []
+        for shard in rng.permutation(len(self.dataset.shards)):
+            start, count = self.dataset.shards[shard]['start'], self.dataset.shards[shard]['count']
+            order.append(start + rng.permutation(count))
+        return np.concatenate(order)
+
+    def __iter__(self):
+        order = self._order()
+        order = np.concatenate([order, order[:self.total_size - len(order)]])
+        part = order[self.rank * self.num_samples:(self.rank + 1) * self.num_samples]
+        return iter(part.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack an ImageNet ImageFolder tree into memory-mapped shards')
+    parser.add_argument('src', help='ImageNet root with train/ and val/')
+    parser.add_argument('dst', help='output directory')
+    parser.add_argument('--split', default='train', help='split (sub folder of src) to convert')
+    parser.add_argument('--format', default='raw', choices=['raw', 'jpeg'], help='raw uint8 records or re-encoded JPEGs')
+    parser.add_argument('--size', type=int, default=256, help='short side (raw: and crop) size')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the jpeg format')
+    parser.add_argument('--shard-size', type=int, default=8192, help='images per shard')
+    parser.add_argument('-j', '--workers', type=int, default=8, help='decoding workers')
+    args = parser.parse_args()
+    convert(args.src, args.dst, args.split, args.size, args.format, args.quality, args.shard_size, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,37 +5,14 @@ import torch.nn.functional as F
 import math
 import copy
 from torch.autograd import Variable
+from selection import kth_largest
+from collate import is_nhwc
+from prefetch import Prefetcher
 
-def prefetched_loader(loader, fp16):
-    mean = torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255]).cuda().view(1, 3, 1, 1)
-    std = torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255]).cuda().view(1, 3, 1, 1)
-    if fp16:
-        mean = mean.half()
-        std = std.half()
-
-    stream = torch.cuda.Stream()
-    first = True
-
-    for next_input, next_target in loader:
-        with torch.cuda.stream(stream):
-            next_input = next_input.cuda(non_blocking=True)
-            next_target = next_target.cuda(non_blocking=True)
-            if fp16:
-                next_input = next_input.half()
-            else:
-                next_input = next_input.float()
-            next_input = next_input.sub_(mean).div_(std)
-
-        if not first:
-            yield input, target
-        else:
-            first = False
-
-        torch.cuda.current_stream().wait_stream(stream)
-        input = next_input
-        target = next_target
-
-    yield input, target
+def prefetched_loader(loader, fp16, device=None, depth=2):
+    if device is None: device = torch.device('cuda')
+    return Prefetcher(loader, device, depth=depth, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225),
+                      dtype=torch.half if fp16 else None, nhwc=is_nhwc(loader))
 
 def snip_forward_conv2d(self, x):
         return F.conv2d(x, self.weight * self.weight_mask, self.bias,
@@ -47,10 +24,11 @@ def snip_forward_linear(self, x):
 
 
 def SNIP(net, keep_ratio, train_dataloader, device, masks, args):
+    if device is None: device = next(net.parameters()).device
     # TODO: shuffle?
 
     # Grab a single batch from the training dataset
-    for i, (input, target) in enumerate(prefetched_loader(train_dataloader, fp16=args.fp16)):
+    for i, (input, target) in enumerate(prefetched_loader(train_dataloader, fp16=args.fp16, device=device)):
         if i > 0:
             break
         input_var = Variable(input)
@@ -69,24 +47,21 @@ def SNIP(net, keep_ratio, train_dataloader, device, masks, args):
             if name not in masks: continue
             grads_abs.append(torch.abs(weight*weight.grad))
 
-        # Gather all scores in a single vector and normalise
-        all_scores = torch.cat([torch.flatten(x) for x in grads_abs])
-
-
-        num_params_to_keep = int(len(all_scores) * keep_ratio)
-        threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-        acceptable_score = threshold[-1]
+        # global threshold found layer by layer, without concatenating all scores
+        num_params_to_keep = int(sum(x.numel() for x in grads_abs) * keep_ratio)
+        acceptable_score = kth_largest(grads_abs, num_params_to_keep)
 
         keep_masks = []
         for g in grads_abs:
             keep_masks.append(((g) >= acceptable_score).float())
 
-        print(torch.sum(torch.cat([torch.flatten(x == 1) for x in keep_masks])))
+        print(sum(torch.sum(x == 1) for x in keep_masks))
 
         net.zero_grad()
         return keep_masks
 
 def SNIP_training(net, keep_ratio, train_dataloader, device, masks, death_rate):
+    if device is None: device = next(net.parameters()).device
     # TODO: shuffle?
 
     # Grab a single batch from the training dataset
@@ -189,7 +164,8 @@ def count_fc_parameters(net):
     return total
 
 
-def GraSP(net, ratio, train_dataloader, device, num_classes=10, samples_per_class=25, num_iters=1, T=200, reinit=True):
+def GraSP(net, ratio, train_dataloader, device=None, num_classes=10, samples_per_class=25, num_iters=1, T=200, reinit=True):
+    if device is None: device = next(net.parameters()).device
     eps = 1e-10
     keep_ratio = ratio
     old_net = net
@@ -282,16 +258,12 @@ def GraSP(net, ratio, train_dataloader, device, num_classes=10, samples_per_clas
         if isinstance(layer, nn.Conv2d) or isinstance(layer, nn.Linear):
             grads[old_modules[idx]] = -layer.weight.data * layer.weight.grad  # -theta_q Hg
 
-    # Gather all scores in a single vector and normalise
-    all_scores = torch.cat([torch.flatten(x) for x in grads.values()])
-    norm_factor = torch.abs(torch.sum(all_scores)) + eps
+    # Normalise and find the global threshold layer by layer, without concatenating all scores
+    norm_factor = torch.abs(sum(torch.sum(x) for x in grads.values())) + eps
     print("** norm factor:", norm_factor)
-    all_scores.div_(norm_factor)
 
-    num_params_to_rm = int(len(all_scores) * (1-keep_ratio))
-    threshold, _ = torch.topk(all_scores, num_params_to_rm, sorted=True)
-    # import pdb; pdb.set_trace()
-    acceptable_score = threshold[-1]
+    num_params_to_rm = int(sum(x.numel() for x in grads.values()) * (1-keep_ratio))
+    acceptable_score = kth_largest(lambda: (x / norm_factor for x in grads.values()), num_params_to_rm)
     print('** accept: ', acceptable_score)
     keep_masks = []
     for m, g in grads.items():
@@ -301,7 +273,8 @@ def GraSP(net, ratio, train_dataloader, device, num_classes=10, samples_per_clas
 
     return keep_masks
 
-def GraSP_Training(net, ratio, train_dataloader, device, num_classes=10, samples_per_class=25, num_iters=1, T=200, reinit=False):
+def GraSP_Training(net, ratio, train_dataloader, device=None, num_classes=10, samples_per_class=25, num_iters=1, T=200, reinit=False):
+    if device is None: device = next(net.parameters()).device
     eps = 1e-10
     death_rate = ratio
 
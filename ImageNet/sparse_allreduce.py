@@ -0,0 +1,180 @@
+"""Mask-aware gradient all-reduce for torch DistributedDataParallel.
+
+Self-check on one CPU machine (2 gloo ranks): python sparse_allreduce.py
+"""
+import copy
+import os
+
+import torch
+import torch.distributed as dist
+
+
+class SparseAllReduceState(object):
+    """State of sparse_allreduce_hook.
+
+    masks   MaskStore with the masks, keyed by parameter name.
+    names   id(parameter) -> parameter name.
+    dense   All-reduce the full gradients on the next backward pass, e.g. the
+            last step before a topology update that scores inactive weights.
+    """
+    def __init__(self, masks, names, process_group=None):
+        self.masks = masks
+        self.names = names
+        self.process_group = process_group
+        self.dense = False
+        self.elements = 0
+        self.dense_elements = 0
+        self._indices = {}
+
+    def indices(self, bucket):
+        """Positions of the bucket's flat buffer to communicate: the active weights plus all unmasked parameters."""
+        params = bucket.parameters()
+        # DDP may rebuild its buckets after the first iteration, so the key includes the parameters
+        key = (self.masks.version, tuple(id(param) for param in params))
+        cached = self._indices.get(bucket.index())
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        parts, offset = [], 0
+        device = bucket.buffer().device
+        for param in params:
+            name = self.names.get(id(param))
+            if name is not None and name in self.masks:
+                active = torch.nonzero(self.masks[name].reshape(-1) != 0).squeeze(1).to(device)
+                parts.append(active + offset)
+            else:
+                parts.append(torch.arange(offset, offset + param.numel(), device=device))
+            offset += param.numel()
+        indices = torch.cat(parts)
+        self._indices[bucket.index()] = (key, indices)
+        return indices
+
+    def summary(self):
+        return 'Gradient all-reduce: {0} of {1} elements ({2:.1f}% of dense)'.format(
+            self.elements, self.dense_elements, 100.0 * self.elements / max(self.dense_elements, 1))
+
+
+def sparse_allreduce_hook(state, bucket):
+    """DDP communication hook that averages only the gradients of the active weights.
+
+    The gradients at the active positions of every masked parameter (and all
+    gradients of unmasked parameters such as biases and BatchNorm) are gathered
+    into one compact buffer, averaged with a single all-reduce and scattered
+    back. At density d this sends about d of the masked gradients. Gradients
+    of pruned weights are left as the local ones, so the momentum of pruned
+    weights differs across ranks; apply_mask discards their updates, and
+    reset_inactive_momentum must zero that momentum when weights are regrown.
+    When state.dense is set, the whole bucket is averaged as usual. The masks
+    must agree across ranks (Masking syncs them), so all ranks communicate
+    buffers of the same size.
+    """
+    group = state.process_group if state.process_group is not None else dist.group.WORLD
+    world_size = dist.get_world_size(group)
+    buffer = bucket.buffer()
+    state.dense_elements += buffer.numel()
+    if state.dense:
+        state.elements += buffer.numel()
+        buffer.div_(world_size)
+        return dist.all_reduce(buffer, group=group, async_op=True).get_future().then(lambda fut: fut.value()[0])
+
+    indices = state.indices(bucket)
+    compact = buffer[indices].div_(world_size)
+    state.elements += compact.numel()
+
+    def scatter(fut):
+        buffer[indices] = fut.value()[0]
+        return buffer
+
+    return dist.all_reduce(compact, group=group, async_op=True).get_future().then(scatter)
+
+
+def register_sparse_allreduce(ddp_model, masks, process_group=None):
+    """Registers sparse_allreduce_hook on a torch DDP model; returns its state.
+
+    masks is keyed by the parameter names of ddp_model, as Masking.masks is
+    when the DDP model itself was passed to Masking.add_module.
+    """
+    names = {id(param): name for name, param in ddp_model.named_parameters()}
+    state = SparseAllReduceState(masks, names, process_group)
+    ddp_model.register_comm_hook(state, sparse_allreduce_hook)
+    return state
+
+
+def reset_inactive_momentum(optimizer, weights):
+    """Zeroes the momentum of the zero weights, i.e. the inactive and just regrown ones.
+
+    Call it after a topology update, before the new masks are applied. Under
+    sparse_allreduce_hook the momentum of inactive weights is built from local
+    gradients; without the reset a regrown weight would start from a
+    different momentum on every rank and the replicas would drift apart.
+    """
+    for weight in weights:
+        state = optimizer.state.get(weight)
+        if state and state.get('momentum_buffer') is not None:
+            state['momentum_buffer'].mul_(weight != 0)
+
+
+def _regrow(masks, generator):
+    # moves a tenth of the active weights of every layer to random inactive positions, the same on all ranks
+    for name in list(masks):
+        mask = masks[name].clone().view(-1)
+        active = torch.nonzero(mask).squeeze(1)
+        inactive = torch.nonzero(mask == 0).squeeze(1)
+        k = max(1, active.numel() // 10)
+        mask[active[torch.randperm(active.numel(), generator=generator)[:k]]] = 0
+        mask[inactive[torch.randperm(inactive.numel(), generator=generator)[:k]]] = 1
+        masks[name] = mask.view(masks.shape(name))
+
+
+def _check(rank, world_size, density):
+    # gloo on CPU: the hook must give the dense average at the active positions,
+    # and momentum SGD with a prune/regrow step must keep the replicas equal
+    from mask_store import MaskStore
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29517')
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 3), torch.nn.ReLU(), torch.nn.Flatten(), torch.nn.Linear(16 * 6 * 6, 10))
+    reference = torch.nn.parallel.DistributedDataParallel(copy.deepcopy(model))
+    sparse = torch.nn.parallel.DistributedDataParallel(model)
+    masks = MaskStore()
+    generator = torch.Generator().manual_seed(1)
+    for name, param in sparse.named_parameters():
+        if param.dim() > 1:
+            masks[name] = (torch.rand(param.shape, generator=generator) < density).float()
+    state = register_sparse_allreduce(sparse, masks)
+
+    torch.manual_seed(rank)
+    data = torch.randn(4, 3, 8, 8)
+    reference(data).sum().backward()
+    sparse(data).sum().backward()
+    for (name, param), dense in zip(sparse.named_parameters(), reference.parameters()):
+        active = masks[name] != 0 if name in masks else torch.ones_like(param, dtype=torch.bool)
+        assert torch.allclose(param.grad[active], dense.grad[active], atol=1e-6), name
+
+    optimizer = torch.optim.SGD(sparse.parameters(), lr=0.1, momentum=0.9)
+    weights = [param for name, param in sparse.named_parameters() if name in masks]
+    for step in range(6):
+        if step > 0:
+            sparse(torch.randn(4, 3, 8, 8)).sum().backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        if step == 2:
+            _regrow(masks, generator)
+            reset_inactive_momentum(optimizer, weights)
+        with torch.no_grad():
+            for name, param in sparse.named_parameters():
+                if name in masks: param.mul_(masks[name])
+    for name, param in sparse.named_parameters():
+        gathered = [torch.empty_like(param) for _ in range(world_size)]
+        dist.all_gather(gathered, param.detach())
+        assert all(torch.equal(gathered[0], other) for other in gathered[1:]), name
+    if rank == 0:
+        print('sparse all-reduce matches dense at the active weights, {0}/{1} gradient elements sent'.format(
+            state.elements, state.dense_elements))
+        print('parameters equal on all ranks after a prune/regrow step')
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    import torch.multiprocessing as mp
+    mp.spawn(_check, args=(2, 0.1), nprocs=2)
@@ -0,0 +1,73 @@
+import torch
+from collections import OrderedDict
+
+
+def nonzero_counts(tensors):
+    """Number of nonzeros of every tensor, as one int64 tensor on the device of the first one.
+
+    The per-tensor reductions are only queued on the device, nothing is copied
+    to the host.
+    """
+    if len(tensors) == 0: return torch.zeros(0, dtype=torch.long)
+    device = tensors[0].device
+    # (t != 0).sum() rather than torch.count_nonzero, which needs torch 1.7
+    return torch.stack([(tensor != 0).sum().to(device) for tensor in tensors])
+
+
+class SparsityStats(object):
+    """Per-layer nonzero counts of named tensors (masks, weights, fired masks, ...).
+
+    The counts of all layers are reduced into one device tensor, which is
+    copied to the host once: on CUDA with a non_blocking copy into pinned
+    memory, which is only waited for when a value is first read. A mask update
+    or a status print then costs one synchronisation instead of one .item()
+    per layer.
+
+    Args:
+        named_tensors   Iterable of (name, tensor), e.g. Masking.layers.named_parameters().
+    """
+    def __init__(self, named_tensors):
+        named_tensors = list(named_tensors)
+        self.names = [name for name, tensor in named_tensors]
+        self.numels = [tensor.numel() for name, tensor in named_tensors]
+        counts = nonzero_counts([tensor.detach() for name, tensor in named_tensors])
+        self._event = None
+        self._values = None
+        if counts.is_cuda:
+            self._host = torch.empty(counts.shape, dtype=counts.dtype, pin_memory=True)
+            self._host.copy_(counts, non_blocking=True)
+            self._event = torch.cuda.Event()
+            self._event.record()
+        else:
+            self._host = counts
+
+    def counts(self):
+        """The nonzero counts as a list of python ints."""
+        if self._values is None:
+            if self._event is not None: self._event.synchronize()
+            self._values = self._host.tolist()
+        return self._values
+
+    def nonzeros(self):
+        return OrderedDict(zip(self.names, self.counts()))
+
+    def zeros(self):
+        return OrderedDict((name, numel - n) for name, numel, n in zip(self.names, self.numels, self.counts()))
+
+    def density(self):
+        return OrderedDict((name, n / float(numel)) for name, numel, n in zip(self.names, self.numels, self.counts()))
+
+    def removed(self, before):
+        """Per layer the nonzeros of `before` (stats taken earlier) minus the nonzeros now."""
+        previous = before.nonzeros()
+        return OrderedDict((name, previous[name] - n) for name, n in zip(self.names, self.counts()))
+
+    def grown(self, before):
+        """Per layer the nonzeros now minus the nonzeros of `before`."""
+        return OrderedDict((name, -n) for name, n in self.removed(before).items())
+
+    def total_nonzeros(self):
+        return sum(self.counts())
+
+    def total_numel(self):
+        return sum(self.numels)